@@ -0,0 +1,166 @@
+import constants
+import ismrmrd
+import ctypes
+import asyncio
+import io
+import logging
+import numpy as np
+
+from connection import Connection
+
+# Socket-like wrapper that lets the Connection.send_* methods write into an
+# asyncio StreamWriter.  Writes are buffered by the transport and flushed by
+# AsyncConnection.drain().
+class StreamWriterSocket:
+    def __init__(self, writer):
+        self.writer = writer
+
+    # writelines() joins the buffers into a copy, which is avoided for a single
+    # (e.g. pre-serialized) buffer
+    def sendmsg(self, buffers):
+        if (len(buffers) == 1):
+            self.writer.write(buffers[0])
+        else:
+            self.writer.writelines(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+
+# Asynchronous version of Connection for use with an asyncio event loop.
+#
+# Each message is framed by awaiting exactly the number of bytes it occupies on
+# the wire.  The complete message is then parsed by the regular Connection
+# handlers (read_acquisition, read_image, etc.), which read from the in-memory
+# frame instead of the socket.  Sending uses the unchanged Connection.send_*
+# methods followed by "await connection.drain()".
+#
+# With savedata, parsing a message waits for the background writer when its
+# queue is full, and closing the file waits for the writer thread.  Such
+# messages are parsed in a thread instead, and the files are only closed by
+# close_files_async() at the end of the session, so that a slow save does not
+# stall the other sessions on the event loop.
+class AsyncConnection(Connection):
+    def __init__(self, reader, writer, savedata, savedataFile = "", savedataFolder = "", savedataGroup = "dataset"):
+        # Messages are read from self.frame, so no receive buffer is needed
+        super().__init__(StreamWriterSocket(writer), savedata, savedataFile, savedataFolder, savedataGroup, recvBufferSize=0)
+        self.reader  = reader
+        self.writer  = writer
+        self.frame   = io.BytesIO()
+        self.framers = {
+            constants.MRD_MESSAGE_CONFIG_FILE:         self.frame_config_file,
+            constants.MRD_MESSAGE_CONFIG_TEXT:         self.frame_text,
+            constants.MRD_MESSAGE_METADATA_XML_TEXT:   self.frame_text,
+            constants.MRD_MESSAGE_CLOSE:               self.frame_close,
+            constants.MRD_MESSAGE_TEXT:                self.frame_text,
+            constants.MRD_MESSAGE_ISMRMRD_ACQUISITION: self.frame_acquisition,
+            constants.MRD_MESSAGE_ISMRMRD_WAVEFORM:    self.frame_waveform,
+            constants.MRD_MESSAGE_ISMRMRD_IMAGE:       self.frame_image
+        }
+
+    def __iter__(self):
+        raise TypeError("AsyncConnection must be iterated with 'async for'")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if (self.is_exhausted is True):
+            raise StopAsyncIteration
+        return await self.next()
+
+    async def drain(self):
+        await self.writer.drain()
+
+    # Called by send_close() and read_close().  See close_files_async().
+    def close_files(self):
+        pass
+
+    async def close_files_async(self):
+        await asyncio.get_running_loop().run_in_executor(None, Connection.close_files, self)
+
+    def read(self, nbytes):
+        return self.frame.read(nbytes)
+
+    def read_into(self, array):
+        array[...] = np.frombuffer(self.read(array.nbytes), dtype=array.dtype).reshape(array.shape)
+
+    async def read_exactly(self, nbytes):
+        data = await self.reader.readexactly(nbytes)
+        if (self.captureFile is not None):
+            self.captureFile.write(data)
+        return data
+
+    async def next(self):
+        id, frame = await self.next_frame()
+        if id is None:
+            return
+        writer = getattr(self, 'dset', None)
+        if ((writer is not None) and writer.full()):
+            return await asyncio.get_running_loop().run_in_executor(None, self.parse, id, frame)
+        return self.parse(id, frame)
+
+    # The ID of the next message and the bytes following it, without parsing
+    # them.  Returns (None, None) at the end of the stream.
+    async def next_frame(self):
+        try:
+            identifier_bytes = await self.read_exactly(constants.SIZEOF_MRD_MESSAGE_IDENTIFIER)
+        except asyncio.IncompleteReadError:
+            self.is_exhausted = True
+            return None, None
+
+        id = constants.MrdMessageIdentifier.unpack(identifier_bytes)[0]
+
+        framer = self.framers.get(id)
+        if framer is None:
+            logging.error("Received unknown message type: %d", id)
+            self.is_exhausted = True
+            return None, None
+
+        return id, await framer()
+
+    # Parse a message framed by next_frame() with the Connection handlers
+    def parse(self, id, frame):
+        self.frame = io.BytesIO(frame)
+        start = self.metrics.clock()
+        item = self.handlers[id]()
+        self.metrics.received(id, item, start)
+        return item
+
+    # ----- Message framing ----------------------------------------------------
+    # Each framer returns the bytes following the message ID, as expected by
+    # the corresponding Connection.read_* handler.
+    async def frame_config_file(self):
+        return await self.read_exactly(constants.SIZEOF_MRD_MESSAGE_CONFIGURATION_FILE)
+
+    async def frame_text(self):
+        length_bytes = await self.read_exactly(constants.SIZEOF_MRD_MESSAGE_LENGTH)
+        length = constants.MrdMessageLength.unpack(length_bytes)[0]
+        return length_bytes + await self.read_exactly(length)
+
+    async def frame_close(self):
+        return b''
+
+    async def frame_acquisition(self):
+        header_bytes = await self.read_exactly(ctypes.sizeof(ismrmrd.AcquisitionHeader))
+        header = ismrmrd.AcquisitionHeader.from_buffer_copy(header_bytes)
+
+        nbytes = header.number_of_samples * (header.trajectory_dimensions * ctypes.sizeof(ctypes.c_float) +
+                                             header.active_channels * ctypes.sizeof(ctypes.c_float * 2))
+        return header_bytes + await self.read_exactly(nbytes)
+
+    async def frame_image(self):
+        header_bytes = await self.read_exactly(ctypes.sizeof(ismrmrd.ImageHeader))
+        header = ismrmrd.ImageHeader.from_buffer_copy(header_bytes)
+
+        attribute_length_bytes = await self.read_exactly(ctypes.sizeof(ctypes.c_uint64))
+        attribute_length = ctypes.c_uint64.from_buffer_copy(attribute_length_bytes).value
+
+        nentries = header.channels * int(np.prod(header.matrix_size))
+        nbytes = attribute_length + nentries * ismrmrd.get_dtype_from_data_type(header.data_type).itemsize
+        return header_bytes + attribute_length_bytes + await self.read_exactly(nbytes)
+
+    async def frame_waveform(self):
+        header_bytes = await self.read_exactly(ctypes.sizeof(ismrmrd.WaveformHeader))
+        header = ismrmrd.WaveformHeader.from_buffer_copy(header_bytes)
+
+        nbytes = header.channels * header.number_of_samples * ctypes.sizeof(ctypes.c_uint32)
+        return header_bytes + await self.read_exactly(nbytes)
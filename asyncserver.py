@@ -0,0 +1,208 @@
+from asyncconnection import AsyncConnection
+from kspace import KSpaceBuffer
+
+import asyncio
+import concurrent.futures
+import logging
+import ismrmrd
+
+import debugdump
+import imagebatch
+import metrics
+import mrdheader
+import recons
+
+# Recons are registered with recons when imported
+import simplefft
+import invertcontrast
+
+class AsyncServer:
+    """
+    Single-process server that multiplexes all sessions on one asyncio event
+    loop.  Idle or slowly-feeding connections only cost their stream buffers;
+    reconstruction of each completed slice or image runs in a process pool.
+    The processRaw and processImage functions of the recon of each config run
+    in the pool, whose processes keep their recon contexts across sessions.
+    """
+
+    def __init__(self, address, port, savedata, savedataFolder, workers=0, maxPending=4):
+        logging.info("Starting asyncio server and listening for data at %s:%d", address, port)
+        if (savedata is True):
+            logging.debug("Saving incoming data is enabled.")
+
+        self.address = address
+        self.port = port
+        self.savedata = savedata
+        self.savedataFolder = savedataFolder
+        self.maxPending = maxPending
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=(workers if workers > 0 else None))
+
+    def serve(self):
+        logging.debug("Serving... ")
+        try:
+            asyncio.run(self.serve_forever())
+        finally:
+            self.executor.shutdown()
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self.handle, self.address, self.port, reuse_address=True)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        remote_addr, remote_port = writer.get_extra_info('peername')[0:2]
+        logging.info("Accepting connection from: %s:%d", remote_addr, remote_port)
+        session    = metrics.session()
+        connection = None
+
+        try:
+            connection = AsyncConnection(reader, writer, self.savedata, "", self.savedataFolder, "dataset")
+            connection.metrics = session
+
+            # First message is the config (file or text)
+            config = await connection.next()
+
+            # Break out if a connection was established but no data was received
+            if ((config is None) & (connection.is_exhausted is True)):
+                logging.info("Connection closed without any data received")
+                return
+
+            # Second messages is the metadata (text), parsed once per protocol
+            metadata = mrdheader.parse(await connection.next())
+            session.config = config
+
+            recon = recons.lookup(config)
+            if (config in recons.registry):
+                logging.info("Starting %s processing based on config", recon.name)
+            else:
+                logging.info("Unknown config '%s'.  Falling back to '%s'", config, recon.name)
+
+            recon.start(connection)
+            if (recon.processRaw is None):
+                await self.discard(connection)
+            else:
+                await self.process(connection, config, metadata, recon.processRaw, recon.processImage, recon.processImages)
+
+        except Exception as e:
+            logging.exception(e)
+
+        finally:
+            # Also for sessions that failed before a close message
+            if (connection is not None):
+                try:
+                    await connection.close_files_async()
+                except Exception as e:
+                    logging.exception(e)
+
+            session.close()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except:
+                pass
+            logging.info("Socket closed")
+
+    async def discard(self, connection):
+        try:
+            async for msg in connection:
+                if msg is None:
+                    break
+        finally:
+            connection.send_close()
+            await connection.drain()
+
+    # Read messages and assemble each slice in a KSpaceBuffer as simplefft and
+    # invertcontrast do.  Each completed slice is reconstructed in the process
+    # pool while this session keeps reading.  With image batching and
+    # processImages, images are reconstructed in batches instead.
+    # A separate task sends the resulting images back in order.  At most
+    # maxPending groups per session are in flight.
+    async def process(self, connection, config, metadata, processRaw, processImage, processImages=None):
+        loop = asyncio.get_running_loop()
+        pending = asyncio.Queue(maxsize=self.maxPending)
+        sender = asyncio.ensure_future(self.send_images(connection, pending))
+
+        # Dumps are written by the pool process that reconstructs the slice.
+        # Its stage times are returned with the image.
+        dumps = debugdump.Session(config)
+
+        async def submit(func, *args):
+            if sender.done():
+                sender.result()
+            await pending.put(loop.run_in_executor(self.executor, metrics.run_timed, func, *args, config, metadata, dumps.slice()))
+
+        items = connection
+        if ((processImages is not None) and imagebatch.enabled()):
+            items = self.batches(connection, imagebatch.ImageBatcher())
+
+        kspace = KSpaceBuffer(metadata)
+        try:
+            async for item in items:
+                if item is None:
+                    break
+
+                elif isinstance(item, ismrmrd.Acquisition):
+                    if (not item.is_flag_set(ismrmrd.ACQ_IS_PHASECORR_DATA)):
+                        kspace.add(item)
+
+                    if ((item.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)) and (len(kspace) > 0)):
+                        await submit(processRaw, *kspace.take())
+
+                elif isinstance(item, ismrmrd.Image) and (processImage is not None):
+                    await submit(processImage, item)
+
+                elif isinstance(item, list):
+                    logging.info("Processing a batch of %d images", len(item))
+                    await submit(processImages, item)
+
+                else:
+                    logging.error("Unsupported data type %s", type(item).__name__)
+
+        finally:
+            if not sender.done():
+                await pending.put(None)
+            await sender
+            connection.send_close()
+            await connection.drain()
+
+    # Messages of connection with its images in lists batched by batcher.  A
+    # pending batch is passed on when it is due, also while waiting for the
+    # next message.
+    async def batches(self, connection, batcher):
+        receiving = None
+        try:
+            while True:
+                if receiving is None:
+                    receiving = asyncio.ensure_future(connection.next())
+                if (len(batcher) > 0):
+                    done, _ = await asyncio.wait([receiving], timeout=batcher.remaining())
+                    if not done:
+                        yield batcher.flush()
+                        continue
+
+                item = await receiving
+                receiving = None
+                if isinstance(item, ismrmrd.Image):
+                    for images in batcher.add(item):
+                        yield images
+                    continue
+
+                if (len(batcher) > 0):
+                    yield batcher.flush()
+                yield item
+                if item is None:
+                    break
+        finally:
+            if receiving is not None:
+                receiving.cancel()
+
+    async def send_images(self, connection, pending):
+        while True:
+            future = await pending.get()
+            if future is None:
+                break
+
+            image, stages = await future
+            connection.metrics.merge(stages)
+            imagebatch.send(connection, image)
+            await connection.drain()
@@ -0,0 +1,873 @@
+#!/usr/bin/python3
+
+# Benchmarks for the MRD server.  Each benchmark is a subcommand, e.g.
+#   python3 benchmark.py startup -n 50
+# 'suite' runs the offline microbenchmarks at reduced sizes.  With --json, the
+# results of a run are appended to a file as one JSON object per line, with the
+# commit and versions they were measured with, so that they can be compared
+# between commits:
+#   python3 benchmark.py --json results.jsonl suite
+
+from server import Server
+from connection import Connection, AcquisitionBatch, FLUSH_BATCH
+from kspace import KSpaceBuffer
+from synthetic import make_acquisitions, make_image, make_images, make_header, make_phantom_kspace
+import fftengine
+import kernels
+import invertcontrast
+import simplefft
+import mrdheader
+import mrdwriter
+import wirecapture
+import constants
+
+import argparse
+import datetime
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import signal
+import socket
+import subprocess
+import threading
+import time
+import tracemalloc
+import ismrmrd
+import numpy as np
+
+defaults = {
+    'host': '127.0.0.1',
+}
+
+def free_port(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def run_server(server):
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+def start_server(host, savedataFolder="", **kwargs):
+    port = free_port(host)
+    server = Server(host, port, False, savedataFolder, **kwargs)
+    process = multiprocessing.Process(target=run_server, args=[server])
+    process.start()
+    server.socket.close()
+    return process, port
+
+def stop_server(process):
+    # SIGINT lets the server clean up its worker processes
+    os.kill(process.pid, signal.SIGINT)
+    process.join()
+
+def connect(host, port, timeout=10):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            return socket.create_connection((host, port))
+        except ConnectionRefusedError:
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.01)
+
+def percentiles(samples, pcts=(50, 90, 99)):
+    return {('p%d' % p): float(np.percentile(samples, p)) for p in pcts}
+
+# Serialize items as a stream of MRD messages, as Connection.send_* would
+def serialize_messages(items, identifier):
+    chunks = []
+    for item in items:
+        chunks.append(constants.MrdMessageIdentifier.pack(identifier))
+        item.serialize_into(chunks.append)
+    chunks.append(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CLOSE))
+    return b''.join(bytes(chunk) for chunk in chunks)
+
+# Results reported by this run, for --json
+collected = []
+
+def report(name, results):
+    collected.append({'name': name, 'results': dict(results)})
+    print(name)
+    for key, value in results.items():
+        if isinstance(value, float):
+            print("  %-24s %12.4f" % (key, value))
+        else:
+            print("  %-24s %12s" % (key, value))
+
+# Commit of the working tree, with "-dirty" if it has uncommitted changes
+def source_version():
+    try:
+        result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+def write_json(path, args):
+    record = {'benchmark': args.benchmark,
+              'time':      datetime.datetime.now().isoformat(timespec='seconds'),
+              'commit':    source_version(),
+              'host':      platform.node(),
+              'cpus':      os.cpu_count(),
+              'python':    platform.python_version(),
+              'numpy':     np.__version__,
+              'ismrmrd':   getattr(ismrmrd, '__version__', None),
+              'args':      {key: value for key, value in vars(args).items() if key not in ('func', 'json')},
+              'results':   collected}
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=lambda value: value.item() if isinstance(value, np.generic) else str(value)) + '\n')
+
+
+# ----- Session startup --------------------------------------------------------
+# Time from connect() until the server has accepted the connection, parsed the
+# config, metadata and close messages of a 'null' session and replied with
+# MRD_MESSAGE_CLOSE.  This is dominated by the accept-to-first-message latency
+# of the server, i.e. the cost of forking versus handing off to a warm worker.
+def run_null_session(host, port):
+    start = time.perf_counter()
+    sock = connect(host, port)
+    connection = Connection(sock, False)
+    connection.send_config_file("null")
+    connection.send_metadata("")
+    connection.send_close()
+
+    identifier = sock.recv(constants.SIZEOF_MRD_MESSAGE_IDENTIFIER, socket.MSG_WAITALL)
+    elapsed = time.perf_counter() - start
+    sock.close()
+
+    if (constants.MrdMessageIdentifier.unpack(identifier)[0] != constants.MRD_MESSAGE_CLOSE):
+        raise RuntimeError("Unexpected reply from server")
+    return elapsed
+
+def bench_startup(args):
+    modes = [('fork', {})]
+    if (args.workers > 0):
+        modes.append(('pool', {'workers': args.workers, 'maxSessions': args.maxSessions}))
+
+    for mode, kwargs in modes:
+        process, port = start_server(args.host, **kwargs)
+        try:
+            # First session absorbs interpreter and worker startup
+            run_null_session(args.host, port)
+            samples = [run_null_session(args.host, port)*1e3 for i in range(args.sessions)]
+        finally:
+            stop_server(process)
+
+        results = {'sessions': args.sessions, 'mean_ms': float(np.mean(samples))}
+        results.update({key + '_ms': value for key, value in percentiles(samples).items()})
+        report("startup (%s)" % mode, results)
+
+
+# ----- Message parsing --------------------------------------------------------
+# Parse a stream of acquisitions received over a socketpair with Connection.
+# The stream is sent from a separate thread so that parsing, not sending, is
+# the bottleneck.  'unbuffered' is the previous implementation, making one
+# recv(MSG_WAITALL) call per field.  'batched' decodes acquisitions into
+# AcquisitionBatch arrays instead of ismrmrd.Acquisition objects.
+class UnbufferedConnection(Connection):
+    def read(self, nbytes):
+        return self.socket.recv(nbytes, socket.MSG_WAITALL)
+
+def parse_stream(stream, connectionClass, **kwargs):
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=sender.sendall, args=[stream])
+    thread.start()
+
+    connection = connectionClass(receiver, False, **kwargs)
+    messages = 0
+    start = time.perf_counter()
+    for msg in connection:
+        if msg is None:
+            break
+        messages += len(msg) if isinstance(msg, AcquisitionBatch) else 1
+    elapsed = time.perf_counter() - start
+
+    thread.join()
+    sender.close()
+    receiver.close()
+    return messages, elapsed
+
+def bench_parse(args):
+    acquisitions = make_acquisitions(args.channels, args.samples, args.count)
+    stream = serialize_messages(acquisitions, constants.MRD_MESSAGE_ISMRMRD_ACQUISITION)
+
+    modes = [('unbuffered', UnbufferedConnection, {}),
+             ('buffered',   Connection,           {'recvBufferSize': args.bufferSize}),
+             ('batched',    Connection,           {'recvBufferSize': args.bufferSize, 'batchSize': args.batchSize})]
+
+    for mode, connectionClass, kwargs in modes:
+        messages, elapsed = min((parse_stream(stream, connectionClass, **kwargs) for i in range(args.repeat)), key=lambda result: result[1])
+        report("parse (%s)" % mode, {'messages':     messages,
+                                     'messages_per_s': messages/elapsed,
+                                     'MB_per_s':       len(stream)/elapsed/1e6})
+
+
+# ----- Saving received data ---------------------------------------------------
+# Parse a stream of acquisitions as above while saving them with --savedata.
+# 'legacy' is the previous implementation, appending each record to an
+# ismrmrd.Dataset on the parsing thread.  'writer' and 'batched' queue them to
+# a background mrdwriter.MrdWriter.  parse_s is the time until the last
+# message is parsed, total_s includes writing the rest of the file.  Saved
+# files are read back with ismrmrd.Dataset and compared to the input.
+# 'capture' and 'capture (zlib)' write a wire capture instead.  convert_s is
+# the time to convert it to HDF5 later with wirecapture.convert().
+class LegacySavingConnection(Connection):
+    def create_save_file(self):
+        if (self.savedata is True):
+            self.dset = ismrmrd.Dataset(self.savedataFile, self.savedataGroup)
+            self.dset._file.require_group(self.savedataGroup)
+
+def save_stream(stream, connectionClass, path, **kwargs):
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=sender.sendall, args=[stream])
+    thread.start()
+
+    if os.path.exists(path):
+        os.remove(path)
+    connection = connectionClass(receiver, True, path, **kwargs)
+    start = time.perf_counter()
+    for msg in connection:
+        if msg is None:
+            break
+    parsed = time.perf_counter() - start
+    connection.close_save_file()
+    elapsed = time.perf_counter() - start
+
+    thread.join()
+    sender.close()
+    receiver.close()
+    return parsed, elapsed, getattr(connection.dset, 'stats', dict)()
+
+def bench_savedata(args):
+    acquisitions = make_acquisitions(args.channels, args.samples, args.count)
+    stream = serialize_messages(acquisitions, constants.MRD_MESSAGE_ISMRMRD_ACQUISITION)
+    path = os.path.join(args.folder, "benchmark_savedata.h5")
+    mrdwriter.configure(chunkSize=args.chunkSize*1024, cacheSize=args.cacheSize*1024*1024)
+
+    modes = [('none',    Connection,             {'recvBufferSize': args.bufferSize}, False),
+             ('legacy',  LegacySavingConnection, {'recvBufferSize': args.bufferSize}, True),
+             ('writer',  Connection,             {'recvBufferSize': args.bufferSize}, True),
+             ('batched', Connection,             {'recvBufferSize': args.bufferSize, 'batchSize': args.batchSize}, True)]
+
+    for mode, connectionClass, kwargs, savedata in modes:
+        if (savedata is False):
+            messages, elapsed = parse_stream(stream, connectionClass, **kwargs)
+            parsed, stats = elapsed, {}
+        else:
+            parsed, elapsed, stats = save_stream(stream, connectionClass, path, **kwargs)
+
+            dset = ismrmrd.Dataset(path, "dataset", False)
+            saved = dset.number_of_acquisitions()
+            matches = all(np.array_equal(dset.read_acquisition(i).data, acquisitions[i].data) for i in range(0, saved, max(1, saved//100)))
+            dset.close()
+            os.remove(path)
+
+        results = {'messages_per_s': args.count/parsed,
+                   'parse_s':        parsed,
+                   'total_s':        elapsed,
+                   'MB_per_s':       len(stream)/elapsed/1e6}
+        if (savedata is True):
+            results.update({'saved': saved, 'matches': matches})
+        results.update(stats)
+        report("savedata (%s)" % mode, results)
+
+    for mode, compress in [('capture', False), ('capture (zlib)', True)]:
+        wirecapture.configure(False, args.folder, compress)
+        for capture in glob.glob(os.path.join(args.folder, "MRD_capture_*")):
+            os.remove(capture)
+        messages, elapsed = parse_stream(stream, Connection, recvBufferSize=args.bufferSize, capture=True)
+        capture = glob.glob(os.path.join(args.folder, "MRD_capture_*"))[0]
+        size = os.path.getsize(capture)
+
+        start = time.perf_counter()
+        wirecapture.convert(capture, path)
+        converted = time.perf_counter() - start
+        os.remove(capture)
+        os.remove(path)
+
+        report("savedata (%s)" % mode, {'messages_per_s': args.count/elapsed,
+                                        'parse_s':        elapsed,
+                                        'convert_s':      converted,
+                                        'MB_per_s':       len(stream)/elapsed/1e6,
+                                        'file_MB':        size/1e6})
+
+
+# ----- Image receive ----------------------------------------------------------
+# Receive a series of large images over a socketpair and report throughput and
+# peak Python/numpy memory allocated while parsing.  'copy' is the previous
+# implementation, which received each payload into a temporary bytes object
+# before copying it into the image.
+class CopyingConnection(UnbufferedConnection):
+    def read_into(self, array):
+        data_bytes = self.read(array.nbytes)
+        array.ravel()[:] = np.frombuffer(data_bytes, dtype=array.dtype)
+
+def send_repeated(sock, message, count):
+    for i in range(count):
+        sock.sendall(message)
+    sock.sendall(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CLOSE))
+
+def receive_images(message, count, connectionClass):
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=send_repeated, args=[sender, message, count])
+
+    connection = connectionClass(receiver, False)
+    tracemalloc.start()
+    thread.start()
+
+    images = 0
+    start = time.perf_counter()
+    for msg in connection:
+        if msg is None:
+            break
+        images += 1
+        del msg
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    thread.join()
+    sender.close()
+    receiver.close()
+    return images, elapsed, peak
+
+def bench_image(args):
+    image = make_image(args.channels, args.size, args.size, args.slices, args.dtype)
+    message = serialize_messages([image], constants.MRD_MESSAGE_ISMRMRD_IMAGE)[:-constants.SIZEOF_MRD_MESSAGE_IDENTIFIER]
+    del image
+
+    for mode, connectionClass in [('copy', CopyingConnection), ('direct', Connection)]:
+        images, elapsed, peak = receive_images(message, args.count, connectionClass)
+        report("image (%s)" % mode, {'images':         images,
+                                     'image_MB':       len(message)/1e6,
+                                     'series_MB':      images*len(message)/1e6,
+                                     'MB_per_s':       images*len(message)/elapsed/1e6,
+                                     'peak_alloc_MB':  peak/1e6})
+
+
+# ----- K-space assembly -------------------------------------------------------
+# Peak RSS and time from the last readout of a slice until its k-space is
+# assembled and until its image is ready.
+# 'list' is the previous implementation, which kept every acquisition until the
+# end of the slice and then sorted and stacked them.  'buffer' places readouts
+# into a KSpaceBuffer as they arrive.  Each mode runs in its own process so
+# that peak RSS is not shared between modes.
+# Each slicer yields (data, acquisition, time the last readout of the slice
+# arrived)
+def list_slices(acquisitions, lines):
+    group = []
+    for acq in acquisitions:
+        arrival = time.perf_counter()
+        group.append(acq)
+        if (acq.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)):
+            group.sort(key = lambda acq: acq.idx.kspace_encode_step_1)
+            yield np.stack([acq.data for acq in group], axis=-1), group[0], arrival
+            group = []
+
+def buffer_slices(acquisitions, lines):
+    kspace = KSpaceBuffer(None)
+    kspace.lines = lines
+    for acq in acquisitions:
+        arrival = time.perf_counter()
+        kspace.add(acq)
+        if (acq.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)):
+            yield kspace.take() + (arrival,)
+
+# Readouts are created as they are "received", in a shuffled line order
+def stream_acquisitions(channels, samples, lines, slices, seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal((channels, 2*samples), dtype=np.float32).view(np.complex64)
+    for slice in range(slices):
+        order = rng.permutation(lines)
+        for index, line in enumerate(order):
+            acq = ismrmrd.Acquisition.from_array(data)
+            acq.idx.kspace_encode_step_1 = int(line)
+            acq.idx.slice = slice
+            if (index == lines-1):
+                acq.set_flag(ismrmrd.ACQ_LAST_IN_SLICE)
+            yield acq
+
+def assemble_slices(slicer, args, results):
+    logging.disable(logging.CRITICAL)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = {'assemble': [], 'image': []}
+    for data, acq, arrival in slicer(stream_acquisitions(args.channels, args.samples, args.lines, args.slices), args.lines):
+        latencies['assemble'].append((time.perf_counter() - arrival)*1e3)
+        image = invertcontrast.process_raw(data, acq, "", "")
+        latencies['image'].append((time.perf_counter() - arrival)*1e3)
+        del data, acq, image
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((latencies, (peak - baseline)/1024))
+
+def bench_kspace(args):
+    slicers = [('list', list_slices), ('buffer', buffer_slices)]
+    for mode, slicer in slicers:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=assemble_slices, args=[slicer, args, queue])
+        process.start()
+        latencies, peak = queue.get()
+        process.join()
+
+        results = {'slices':          args.slices,
+                   'kspace_MB':       args.channels*args.samples*args.lines*8/1e6,
+                   'peak_rss_MB':     peak}
+        for stage, samples in latencies.items():
+            results.update({stage + '_' + key + '_ms': value for key, value in percentiles(samples, (50, 90)).items()})
+        report("kspace (%s)" % mode, results)
+
+
+# ----- Metadata parsing -------------------------------------------------------
+# Cost per session of turning the MRD header XML into an MrdHeader, parsing
+# every session ('uncached') or reusing headers of repeated protocols from an
+# MrdHeaderCache ('cached').
+def bench_metadata(args):
+    xml = make_header(32, 512, 256)
+    cache = mrdheader.MrdHeaderCache()
+    for mode, parse in [('uncached', mrdheader.MrdHeader), ('cached', cache.get)]:
+        samples = []
+        for i in range(args.sessions):
+            start = time.perf_counter()
+            parse(xml)
+            samples.append((time.perf_counter() - start)*1e3)
+        results = {'sessions': args.sessions, 'mean_ms': float(np.mean(samples))}
+        results.update({key + '_ms': value for key, value in percentiles(samples).items()})
+        report("metadata (%s)" % mode, results)
+
+
+# ----- Pipelined sessions -----------------------------------------------------
+# Total time of a multi-slice simplefft session, with the client sending at a
+# limited rate to model the network.  Reported next to the network time alone
+# (a 'null' session with the same data) and the recon time alone (simplefft
+# run locally on each slice).  A sequential session takes about their sum and
+# a pipelined one should approach their maximum.  'parallel' additionally
+# reconstructs up to --threads slices at once.
+# Send at no more than rate bytes/s, like a link of that bandwidth.  Time spent
+# blocked because the receiver is not reading is lost, not caught up.
+def send_throttled(sock, data, rate, chunkSize=256*1024):
+    view = memoryview(data)
+    ready = time.perf_counter()
+    for offset in range(0, len(view), chunkSize):
+        sock.sendall(view[offset:offset+chunkSize])
+        if (rate > 0):
+            ready = max(ready, time.perf_counter()) + len(view[offset:offset+chunkSize])/rate
+            delay = ready - time.perf_counter()
+            if (delay > 0):
+                time.sleep(delay)
+
+def run_slice_session(host, port, config, xml, sliceStream, slices, rate):
+    sock = connect(host, port)
+    images = []
+
+    def receive():
+        for msg in Connection(sock, False):
+            if msg is None:
+                break
+            images.append(msg)
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+
+    start = time.perf_counter()
+    connection = Connection(sock, False, flushPolicy=FLUSH_BATCH)
+    connection.send_config_file(config)
+    connection.send_metadata(xml)
+    connection.flush()
+    for slice in range(slices):
+        send_throttled(sock, sliceStream, rate)
+    connection.send_close()
+    receiver.join()
+    elapsed = time.perf_counter() - start
+
+    sock.close()
+    return elapsed, len(images)
+
+def bench_pipeline(args):
+    logging.disable(logging.CRITICAL)
+    xml = make_header(args.channels, args.samples, args.lines)
+    acquisitions = make_acquisitions(args.channels, args.samples, args.lines)
+    sliceStream = serialize_messages(acquisitions, constants.MRD_MESSAGE_ISMRMRD_ACQUISITION)[:-constants.SIZEOF_MRD_MESSAGE_IDENTIFIER]
+    rate = args.rate*1e6
+
+    # Recon time alone
+    kspace = KSpaceBuffer(xml)
+    for acq in acquisitions:
+        kspace.add(acq)
+    data, acq = kspace.take()
+    del acquisitions
+    simplefft.process_group(data, acq, "simplefft", xml)
+    start = time.perf_counter()
+    for slice in range(args.slices):
+        simplefft.process_group(data, acq, "simplefft", xml)
+    compute = time.perf_counter() - start
+
+    modes = [('sequential', {'pipelined': False}), ('pipelined', {'pipelined': True})]
+    if (args.threads > 0):
+        modes.append(('parallel x%d' % args.threads, {'reconThreads': args.threads}))
+    for mode, kwargs in modes:
+        process, port = start_server(args.host, **kwargs)
+        try:
+            network = run_slice_session(args.host, port, "null", xml, sliceStream, args.slices, rate)[0]
+            elapsed, images = run_slice_session(args.host, port, "simplefft", xml, sliceStream, args.slices, rate)
+        finally:
+            stop_server(process)
+
+        report("pipeline (%s)" % mode, {'slices':      images,
+                                        'slice_MB':    len(sliceStream)/1e6,
+                                        'network_s':   network,
+                                        'compute_s':   compute,
+                                        'sum_s':       network + compute,
+                                        'max_s':       max(network, compute),
+                                        'session_s':   elapsed})
+
+
+# ----- FFT backends -----------------------------------------------------------
+# Centered inverse 2D FFT of one [cha RO PE] complex64 slice.  'shift' is the
+# previous implementation (numpy fftshift, ifft2 and ifftshift), the others are
+# fftengine.centered_ifft2() with each available backend.  Times are per slice,
+# after a first call that creates plans.
+def time_fft(func, data, repeat):
+    func(data)
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        samples.append((time.perf_counter() - start)*1e3)
+    return samples
+
+def shifted_ifft2(data):
+    data = np.fft.fftshift(data, axes=(1, 2))
+    data = np.fft.ifft2(data)
+    return np.fft.ifftshift(data, axes=(1, 2))
+
+def bench_fft(args):
+    rng = np.random.default_rng(0)
+    for shape in args.shapes:
+        channels, ro, pe = [int(n) for n in shape.split('x')]
+        data = rng.standard_normal((channels, ro, 2*pe), dtype=np.float32).view(np.complex64)
+        reference = shifted_ifft2(data)
+
+        baseline = None
+        modes = [('shift', shifted_ifft2)]
+        for backend in fftengine.available_backends():
+            engine = fftengine.create_engine(backend, args.threads)
+            modes.append((backend, lambda data, engine=engine: fftengine.centered_ifft2(data, axes=(1, 2), engine=engine)))
+
+        for mode, func in modes:
+            samples = time_fft(func, data, args.repeat)
+            baseline = baseline or np.median(samples)
+            error = np.abs(func(data) - reference).max() / np.abs(reference).max()
+            results = {'shape': shape, 'slice_MB': data.nbytes/1e6}
+            results.update({key + '_ms': value for key, value in percentiles(samples, (50, 90)).items()})
+            results.update({'speedup': baseline/np.median(samples), 'max_rel_error': float(error)})
+            report("fft (%s)" % mode, results)
+
+# ----- Coil combination and quantization ---------------------------------------
+# Time and peak numpy memory from an assembled [cha RO PE] complex64 slice to an
+# int16 image: centered FFT, root sum of squares and quantization.  'legacy' is
+# the previous implementation in float64, with a new temporary for every step.
+# 'double' and 'single' use the in-place kernels at each precision.  Accuracy
+# is the largest difference to the legacy image, in int16 steps.
+def legacy_image(data):
+    data = np.fft.fftshift(data.astype(np.complex128), axes=(1, 2))
+    data = np.fft.ifft2(data)
+    data = np.fft.ifftshift(data, axes=(1, 2))
+    data = np.abs(data)
+    data = np.square(data)
+    data = np.sum(data, axis=0)
+    data = np.sqrt(data)
+    data *= 32767/data.max()
+    data = np.around(data)
+    return data.astype(np.int16)
+
+def kernel_image(data):
+    data = fftengine.centered_ifft2(data, axes=(1, 2), dtype=kernels.complexType)
+    return kernels.quantize(kernels.rss(data))
+
+def bench_combine(args):
+    rng = np.random.default_rng(0)
+    for shape in args.shapes:
+        channels, ro, pe = [int(n) for n in shape.split('x')]
+        data = rng.standard_normal((channels, ro, 2*pe), dtype=np.float32).view(np.complex64)
+        reference = legacy_image(data).astype(np.int32)
+
+        for mode, precision, func in [('legacy', None, legacy_image), ('double', kernels.PRECISION_DOUBLE, kernel_image), ('single', kernels.PRECISION_SINGLE, kernel_image)]:
+            if (precision is not None):
+                kernels.configure(precision)
+            samples = time_fft(func, data, args.repeat)
+
+            tracemalloc.start()
+            image = func(data)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            difference = np.abs(image - reference)
+            results = {'shape': shape, 'slice_MB': data.nbytes/1e6}
+            results.update({key + '_ms': value for key, value in percentiles(samples, (50, 90)).items()})
+            results.update({'peak_alloc_MB':    peak/1e6,
+                            'max_error':        int(difference.max()),
+                            'pixels_differing': int(np.count_nonzero(difference))})
+            report("combine (%s)" % mode, results)
+
+# ----- Readout oversampling ----------------------------------------------------
+# Time and peak numpy memory from an assembled [cha RO PE] slice to the cropped
+# int16 image, with the readout oversampling removed from the final image
+# ('full') or between the readout and phase encoding FFTs ('crop').  The slice
+# is a phantom inside the field of view, seen by coils with smooth
+# sensitivities, with 2x readout oversampling and noise.  Accuracy is the
+# largest difference to the 'full' image, in int16 steps.
+def oversampled_image(data, crop):
+    image = kernels.quantize(kernels.rss(kernels.ifft_image(data, crop=crop)))
+    if (not crop):
+        image = image[kernels.readout_fov(image.shape[0]), :]
+    return image
+
+def bench_crop(args):
+    kernels.configure(args.precision)
+    for shape in args.shapes:
+        channels, ro, pe = [int(n) for n in shape.split('x')]
+        data = make_phantom_kspace(channels, ro, pe)
+        reference = oversampled_image(data, False).astype(np.int32)
+
+        baseline = None
+        for mode, crop in [('full', False), ('crop', True)]:
+            func = lambda data, crop=crop: oversampled_image(data, crop)
+            samples = time_fft(func, data, args.repeat)
+            baseline = baseline or np.median(samples)
+
+            tracemalloc.start()
+            image = func(data)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            difference = np.abs(image - reference)
+            results = {'shape': shape, 'precision': args.precision}
+            results.update({key + '_ms': value for key, value in percentiles(samples, (50, 90)).items()})
+            results.update({'speedup':          baseline/np.median(samples),
+                            'peak_alloc_MB':    peak/1e6,
+                            'max_error':        int(difference.max()),
+                            'pixels_differing': int(np.count_nonzero(difference))})
+            report("crop (%s)" % mode, results)
+
+
+# ----- Recon kernels ------------------------------------------------------------
+# Time and peak numpy memory of the recon functions the server runs for every
+# slice or image: simplefft.process_group and invertcontrast.process_raw on an
+# assembled [cha RO PE] phantom slice, and invertcontrast.process_image on a
+# single-channel image of the reconstructed size.
+def bench_recon(args):
+    kernels.configure(args.precision)
+    for shape in args.shapes:
+        channels, ro, pe = [int(n) for n in shape.split('x')]
+        data = make_phantom_kspace(channels, ro, pe)
+        acquisition = ismrmrd.Acquisition.from_array(np.ascontiguousarray(data[:, :, 0]))
+        metadata = mrdheader.parse(make_header(channels, ro, pe))
+        image = make_image(1, ro//2, pe, 1, args.dtype)
+
+        modes = [('simplefft.process_group',     data,  lambda data: simplefft.process_group(data, acquisition, "simplefft", metadata)),
+                 ('invertcontrast.process_raw',   data,  lambda data: invertcontrast.process_raw(data, acquisition, "invertcontrast", metadata)),
+                 ('invertcontrast.process_image', image, lambda image: invertcontrast.process_image(image, "invertcontrast", metadata))]
+        for mode, input, func in modes:
+            samples = time_fft(func, input, args.repeat)
+
+            tracemalloc.start()
+            func(input)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            results = {'shape': shape, 'precision': args.precision, 'input_MB': input.data.nbytes/1e6}
+            results.update({key + '_ms': value for key, value in percentiles(samples, (50, 90)).items()})
+            results.update({'per_s':         1e3/np.median(samples),
+                            'peak_alloc_MB': peak/1e6})
+            report("recon (%s)" % mode, results)
+
+
+# ----- Image series -------------------------------------------------------------
+# Time per image of invertcontrast on a series of small images, including their
+# serialization for sending: one by one with process_image() as without image
+# batching, and in batches of each size with process_images().
+def bench_series(args):
+    kernels.configure(args.precision)
+    images = make_images(args.count, 1, args.size, args.size, 1, args.dtype)
+    metadata = mrdheader.parse(make_header(1, 2*args.size, args.size))
+    discard = lambda chunk: None
+
+    def one_by_one(images):
+        for image in images:
+            invertcontrast.process_image(image, "invertcontrast", metadata).serialize_into(discard)
+
+    def batched(images, size):
+        for offset in range(0, len(images), size):
+            discard(invertcontrast.process_images(images[offset:offset + size], "invertcontrast", metadata).buffer)
+
+    modes = [('process_image', one_by_one)]
+    modes += [('process_images x%d' % size, lambda images, size=size: batched(images, size)) for size in args.batches]
+    for mode, func in modes:
+        samples = [elapsed*1e3/len(images) for elapsed in time_fft(func, images, args.repeat)]
+        results = {'images': len(images), 'size': args.size, 'dtype': args.dtype, 'precision': args.precision}
+        results.update({key + '_us': value for key, value in percentiles(samples, (50, 90)).items()})
+        results['images_per_s'] = 1e6/np.median(samples)
+        report("series (%s)" % mode, results)
+
+
+# ----- Suite --------------------------------------------------------------------
+# Offline microbenchmarks of the parse, recon and save paths, at sizes that run
+# in a few minutes.  Benchmarks that start servers are not included.
+SUITE = [
+    ['parse',    '-n', '5000'],
+    ['savedata', '-n', '2000'],
+    ['image',    '-n', '10', '-z', '16'],
+    ['metadata'],
+    ['kspace',   '-c', '16', '-s', '256', '-l', '128'],
+    ['fft',      '-m', '32x256x256', '-r', '5'],
+    ['combine',  '-m', '32x256x256', '-r', '5'],
+    ['crop',     '-m', '32x512x256', '-r', '5'],
+    ['recon',    '-r', '5'],
+    ['series',   '-n', '1000', '-r', '3'],
+]
+
+def bench_suite(args):
+    parser = create_parser()
+    for argv in SUITE:
+        print("# %s" % ' '.join(argv))
+        benchmark = parser.parse_args(argv)
+        benchmark.func(benchmark)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks for the MRD server',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-H', '--host',    type=str,            help='Host for benchmark servers')
+    parser.add_argument('-j', '--json',    type=str,            help='Append the results to this file as a line of JSON')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output.')
+    parser.set_defaults(**defaults)
+
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    startup = subparsers.add_parser('startup', help='Connection accept to first parsed message',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    startup.add_argument('-n', '--sessions',    type=int, default=50, help='Number of sessions per mode')
+    startup.add_argument('-w', '--workers',     type=int, default=4,  help='Pool workers (0 to skip pool mode)')
+    startup.add_argument('-r', '--maxSessions', type=int, default=0,  help='Recycle pool workers after this many sessions')
+    startup.set_defaults(func=bench_startup)
+
+    parse = subparsers.add_parser('parse', help='Acquisition parsing throughput over a socketpair',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parse.add_argument('-n', '--count',      type=int, default=20000,   help='Number of acquisitions')
+    parse.add_argument('-c', '--channels',   type=int, default=16,      help='Receive channels')
+    parse.add_argument('-s', '--samples',    type=int, default=256,     help='Samples per readout')
+    parse.add_argument('-b', '--bufferSize', type=int, default=1048576, help='Receive buffer size in bytes')
+    parse.add_argument('-B', '--batchSize',  type=int, default=256,     help='Acquisitions per batch in batched mode')
+    parse.add_argument('-r', '--repeat',     type=int, default=3,       help='Repetitions (best is reported)')
+    parse.set_defaults(func=bench_parse)
+
+    savedata = subparsers.add_parser('savedata', help='Acquisition parsing throughput while saving data',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    savedata.add_argument('-n', '--count',      type=int, default=20000,   help='Number of acquisitions')
+    savedata.add_argument('-c', '--channels',   type=int, default=16,      help='Receive channels')
+    savedata.add_argument('-s', '--samples',    type=int, default=256,     help='Samples per readout')
+    savedata.add_argument('-b', '--bufferSize', type=int, default=1048576, help='Receive buffer size in bytes')
+    savedata.add_argument('-B', '--batchSize',  type=int, default=256,     help='Acquisitions per batch in batched mode')
+    savedata.add_argument('-k', '--chunkSize',  type=int, default=mrdwriter.SAVE_CHUNK_SIZE//1024, help='HDF5 chunk size in KB')
+    savedata.add_argument('-K', '--cacheSize',  type=int, default=mrdwriter.SAVE_CACHE_SIZE//(1024*1024), help='HDF5 chunk cache size in MB')
+    savedata.add_argument('-f', '--folder',     type=str, default='/tmp',  help='Folder for the saved file')
+    savedata.set_defaults(func=bench_savedata)
+
+    image = subparsers.add_parser('image', help='Image receive throughput and peak memory',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    image.add_argument('-n', '--count',    type=int, default=20,          help='Number of images in the series')
+    image.add_argument('-c', '--channels', type=int, default=1,           help='Channels per image')
+    image.add_argument('-m', '--size',     type=int, default=256,         help='Matrix size (x and y)')
+    image.add_argument('-z', '--slices',   type=int, default=64,          help='Matrix size (z)')
+    image.add_argument('-d', '--dtype',    type=str, default='complex64', help='Image data type')
+    image.set_defaults(func=bench_image)
+
+    kspace = subparsers.add_parser('kspace', help='K-space assembly peak memory and last readout to image latency',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    kspace.add_argument('-c', '--channels', type=int, default=32,  help='Receive channels')
+    kspace.add_argument('-s', '--samples',  type=int, default=512, help='Samples per readout')
+    kspace.add_argument('-l', '--lines',    type=int, default=256, help='Phase encoding lines per slice')
+    kspace.add_argument('-z', '--slices',   type=int, default=5,   help='Number of slices')
+    kspace.set_defaults(func=bench_kspace)
+
+    metadata = subparsers.add_parser('metadata', help='MRD header parsing cost per session',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    metadata.add_argument('-n', '--sessions', type=int, default=200, help='Number of sessions')
+    metadata.set_defaults(func=bench_metadata)
+
+    pipelined = subparsers.add_parser('pipeline', help='Sequential versus pipelined multi-slice session time',
+                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    pipelined.add_argument('-c', '--channels', type=int,   default=16,  help='Receive channels')
+    pipelined.add_argument('-s', '--samples',  type=int,   default=256, help='Samples per readout')
+    pipelined.add_argument('-l', '--lines',    type=int,   default=256, help='Phase encoding lines per slice')
+    pipelined.add_argument('-z', '--slices',   type=int,   default=10,  help='Number of slices')
+    pipelined.add_argument('-R', '--rate',     type=float, default=100, help='Client send rate in MB/s (0 for unlimited)')
+    pipelined.add_argument('-t', '--threads',  type=int,   default=4,   help='Recon threads per session in parallel mode (0 to skip)')
+    pipelined.set_defaults(func=bench_pipeline)
+
+    fft = subparsers.add_parser('fft', help='FFT backend comparison on single slices',
+                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    fft.add_argument('-m', '--shapes',  type=str, nargs='+', default=['32x256x256', '32x512x512'], help='Slice shapes as CHAxROxPE')
+    fft.add_argument('-t', '--threads', type=int, default=0,  help='Threads for the scipy and pyfftw backends (0 for all cores)')
+    fft.add_argument('-r', '--repeat',  type=int, default=10, help='Repetitions per backend')
+    fft.set_defaults(func=bench_fft)
+
+    combine = subparsers.add_parser('combine', help='FFT, coil combination and int16 quantization of single slices',
+                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    combine.add_argument('-m', '--shapes', type=str, nargs='+', default=['32x256x256', '32x512x512'], help='Slice shapes as CHAxROxPE')
+    combine.add_argument('-r', '--repeat', type=int, default=10, help='Repetitions per mode')
+    combine.set_defaults(func=bench_combine)
+
+    crop = subparsers.add_parser('crop', help='Readout oversampling removal from the image versus before the phase encoding FFT',
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    crop.add_argument('-m', '--shapes',    type=str, nargs='+', default=['32x512x256', '32x1024x512'], help='Slice shapes as CHAxROxPE, with 2x readout oversampling')
+    crop.add_argument('-d', '--precision', type=str, default=kernels.PRECISION_DOUBLE, choices=[kernels.PRECISION_SINGLE, kernels.PRECISION_DOUBLE], help='Recon precision')
+    crop.add_argument('-r', '--repeat',    type=int, default=10, help='Repetitions per mode')
+    crop.set_defaults(func=bench_crop)
+
+    recon = subparsers.add_parser('recon', help='Recon functions run per slice or image',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    recon.add_argument('-m', '--shapes',    type=str, nargs='+', default=['16x256x128', '32x512x256'], help='Slice shapes as CHAxROxPE, with 2x readout oversampling')
+    recon.add_argument('-d', '--precision', type=str, default=kernels.PRECISION_DOUBLE, choices=[kernels.PRECISION_SINGLE, kernels.PRECISION_DOUBLE], help='Recon precision')
+    recon.add_argument('-t', '--dtype',     type=str, default='int16', help='Data type of the input images of process_image')
+    recon.add_argument('-r', '--repeat',    type=int, default=10, help='Repetitions per function')
+    recon.set_defaults(func=bench_recon)
+
+    series = subparsers.add_parser('series', help='invertcontrast on a series of small images, one by one versus batched',
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    series.add_argument('-n', '--count',     type=int, default=4000, help='Images in the series')
+    series.add_argument('-z', '--size',      type=int, default=64, help='Image size')
+    series.add_argument('-b', '--batches',   type=int, nargs='+', default=[16, 256], help='Batch sizes')
+    series.add_argument('-d', '--precision', type=str, default=kernels.PRECISION_DOUBLE, choices=[kernels.PRECISION_SINGLE, kernels.PRECISION_DOUBLE], help='Recon precision')
+    series.add_argument('-t', '--dtype',     type=str, default='int16', help='Data type of the input images')
+    series.add_argument('-r', '--repeat',    type=int, default=5, help='Repetitions per mode')
+    series.set_defaults(func=bench_series)
+
+    suite = subparsers.add_parser('suite', help='Offline microbenchmarks of the parse, recon and save paths',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    suite.set_defaults(func=bench_suite)
+
+    return parser
+
+
+if __name__ == '__main__':
+    parser = create_parser()
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING)
+    if args.verbose:
+        logging.root.setLevel(logging.DEBUG)
+
+    args.func(args)
+
+    if args.json:
+        write_json(args.json, args)
@@ -3,6 +3,8 @@
 # from server import Server
 
 import argparse
+import asyncio
+import hashlib
 import logging
 import datetime
 import h5py
@@ -10,7 +12,11 @@ import socket
 import sys
 import ismrmrd
 import multiprocessing
-from connection import Connection
+from connection import Connection, FLUSH_BATCH, RECV_BUFFER_SIZE
+from asyncconnection import AsyncConnection
+import constants
+import mrdreader
+import wirecapture
 
 import time
 import os
@@ -20,9 +26,17 @@ defaults = {
     'port':      9002, 
     'outfile':   'out.h5',
     'out_group': str(datetime.datetime.now()),
-    'config':    'default.xml'
+    'config':    'default.xml',
+    'sink':      'hdf5'
 }
 
+# Outputs of --duplex for the messages received from the server:
+#   hdf5      images saved to outfile, as without --duplex
+#   discard   messages are only counted
+#   checksum  SHA-256 of the received bytes is logged, for regression checks
+#   capture   received bytes are written to a wire capture (see wirecapture.py)
+sinks = ('hdf5', 'discard', 'checksum', 'capture')
+
 # Wait for incoming data and cleanup
 def connection_receive_loop(sock, outfile, outgroup):
     incoming_connection = Connection(sock, True, outfile, "", outgroup)
@@ -32,6 +46,7 @@ def connection_receive_loop(sock, outfile, outgroup):
             if msg is None:
                 break
     finally:
+        incoming_connection.close_save_file()
         try:
             sock.shutdown(socket.SHUT_RDWR)
         except:
@@ -47,6 +62,13 @@ def main(args):
             logging.error("Could not find local config file %s", args.config_local)
             return
 
+    if wirecapture.is_capture(args.filename):
+        if args.duplex:
+            asyncio.run(run_duplex(args))
+        else:
+            replay_capture(args)
+        return
+
     dset = h5py.File(args.filename, 'r')
     if not dset:
         logging.error("Not a valid dataset: %s" % args.filename)
@@ -107,6 +129,10 @@ def main(args):
         logging.error("File does not contain properly formatted MRD raw or image data")
         return
 
+    if args.duplex:
+        asyncio.run(run_duplex(args))
+        return
+
     # ----- Open connection to server ------------------------------------------
     # Spawn a thread to connect and handle incoming data
     logging.info("Connecting to MRD server at %s:%d" % (args.address, args.port))
@@ -118,22 +144,18 @@ def main(args):
     process.start()
 
     # This connection is only used for outgoing data.  It should not be used for
-    # writing to the HDF5 file as multi-threading issues can occur
-    connection = Connection(sock, False)
+    # writing to the HDF5 file as multi-threading issues can occur.  Outgoing
+    # messages are coalesced into large writes and flushed by send_close().
+    connection = Connection(sock, False, flushPolicy=FLUSH_BATCH)
 
-    if (args.config_local):
-        fid = open(args.config_local, "r")
-        config_text = fid.read()
-        fid.close()
-        logging.info("Sending local config file '%s' with text:", args.config_local)
-        logging.info(config_text)
-        connection.send_config_text(config_text)
-    else:
-        logging.info("Sending remote config file name '%s'", args.config)
-        connection.send_config_file(args.config)
+    send_config(connection, args)
+
+    # --------------- Send data read in bulk ----------------------
+    if args.bulk:
+        send_bulk(connection, args)
 
     # --------------- Send raw data ----------------------
-    if isRaw:
+    elif isRaw:
         logging.info("Starting raw data session")
         dset = ismrmrd.Dataset(args.filename, args.in_group, False)
 
@@ -187,11 +209,196 @@ def main(args):
 
     return
 
+def send_config(connection, args):
+    if (args.config_local):
+        fid = open(args.config_local, "r")
+        config_text = fid.read()
+        fid.close()
+        logging.info("Sending local config file '%s' with text:", args.config_local)
+        logging.info(config_text)
+        connection.send_config_text(config_text)
+    else:
+        logging.info("Sending remote config file name '%s'", args.config)
+        connection.send_config_file(args.config)
+
+# Send the raw data or images of the input group as serialized by an MrdReader,
+# which reads the next blocks on a background thread while this one sends
+def send_bulk(connection, args):
+    logging.info("Starting data session, reading in blocks of %d MB", mrdreader.READ_BLOCK_SIZE//(1024*1024))
+    reader = mrdreader.MrdReader(args.filename, args.in_group)
+    start = time.perf_counter()
+    try:
+        xml_header = reader.xml_header()
+        connection.send_metadata(xml_header if xml_header is not None else "Dummy XML header")
+
+        for identifier, count, block in reader:
+            connection.send_serialized(identifier, block, count)
+        connection.flush()
+    finally:
+        reader.close()
+
+    elapsed = time.perf_counter() - start
+    stats   = reader.stats()
+    logging.info("Sent %d messages (%.1f MB) in %.2f s: %.1f MB/s, %.0f messages/s (reading took %.2f s in %d reads)",
+                 stats['messages'], stats['bytes']/1e6, elapsed, stats['bytes']/1e6/max(elapsed, 1e-9), stats['messages']/max(elapsed, 1e-9), stats['busy_s'], stats['reads'])
+
+# ----- Full-duplex client ---------------------------------------------------
+# Sends the input and receives the results on one socket from one asyncio event
+# loop, without a receiving process.  Like main(), it uses separate connections
+# for the two directions, so that sending MRD_MESSAGE_CLOSE does not close the
+# output.  Received messages are passed to the sink selected by --sink without
+# being parsed, except by the hdf5 sink.
+async def run_duplex(args):
+    logging.info("Connecting to MRD server at %s:%d", args.address, args.port)
+    reader, writer = await asyncio.open_connection(args.address, args.port, limit=RECV_BUFFER_SIZE)
+    outgoing = AsyncConnection(reader, writer, False)
+    incoming = AsyncConnection(reader, writer, args.sink == 'hdf5', args.outfile, "", args.out_group)
+    sink = create_sink(args, incoming)
+
+    start  = time.perf_counter()
+    sender = asyncio.ensure_future(send_capture(outgoing, args) if wirecapture.is_capture(args.filename) else send_file(outgoing, args))
+    received, receivedBytes = 0, 0
+    try:
+        while True:
+            identifier, frame = await incoming.next_frame()
+            if identifier is None:
+                break
+            sink.write(identifier, frame)
+            received      += 1
+            receivedBytes += constants.SIZEOF_MRD_MESSAGE_IDENTIFIER + len(frame)
+            if (identifier == constants.MRD_MESSAGE_CLOSE):
+                break
+        sentBytes = await sender
+    finally:
+        sender.cancel()
+        sink.close()
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    logging.info("Sent %.1f MB and received %d messages (%.1f MB) in %.2f s: %.1f MB/s sent, %.1f MB/s received",
+                 sentBytes/1e6, received, receivedBytes/1e6, elapsed, sentBytes/1e6/max(elapsed, 1e-9), receivedBytes/1e6/max(elapsed, 1e-9))
+    logging.info("Session complete")
+
+# Send the input group as read by an MrdReader.  Blocks are taken from the
+# reader's thread in the default executor, so that the event loop keeps
+# receiving while the next block is read.  Returns the bytes sent.
+async def send_file(connection, args):
+    loop   = asyncio.get_running_loop()
+    reader = mrdreader.MrdReader(args.filename, args.in_group)
+    try:
+        send_config(connection, args)
+        xml_header = reader.xml_header()
+        connection.send_metadata(xml_header if xml_header is not None else "Dummy XML header")
+        await connection.drain()
+
+        blocks = iter(reader)
+        while True:
+            block = await loop.run_in_executor(None, next, blocks, None)
+            if block is None:
+                break
+            identifier, count, buffer = block
+            connection.send_serialized(identifier, buffer, count)
+            await connection.drain()
+
+        connection.send_close()
+        await connection.drain()
+    finally:
+        reader.close()
+    return reader.stats()['bytes']
+
+async def send_capture(connection, args):
+    capture = wirecapture.CaptureSocket(args.filename)
+    sentBytes = 0
+    try:
+        for chunk in capture.read_all():
+            connection.writer.write(chunk)
+            sentBytes += len(chunk)
+            await connection.drain()
+    finally:
+        capture.close()
+    return sentBytes
+
+def create_sink(args, connection):
+    if (args.sink == 'hdf5'):
+        return Hdf5Sink(connection)
+    elif (args.sink == 'checksum'):
+        return ChecksumSink()
+    elif (args.sink == 'capture'):
+        path = args.outfile if wirecapture.is_capture(args.outfile) else os.path.splitext(args.outfile)[0] + wirecapture.CAPTURE_EXTENSION
+        return CaptureSink(path)
+    return DiscardSink()
+
+# Each sink is given the ID and the bytes following it of every received
+# message, including MRD_MESSAGE_CLOSE, and closed at the end of the session
+class DiscardSink:
+    def write(self, identifier, frame):
+        pass
+
+    def close(self):
+        pass
+
+class ChecksumSink:
+    def __init__(self):
+        self.hash = hashlib.sha256()
+
+    def write(self, identifier, frame):
+        self.hash.update(constants.MrdMessageIdentifier.pack(identifier))
+        self.hash.update(frame)
+
+    def close(self):
+        logging.info("SHA-256 of received data: %s", self.hash.hexdigest())
+
+class CaptureSink:
+    def __init__(self, path):
+        logging.info("Capturing received data to %s", path)
+        self.capture = wirecapture.CaptureWriter(path, path.endswith(wirecapture.CAPTURE_COMPRESSED_EXTENSION))
+
+    def write(self, identifier, frame):
+        self.capture.write(constants.MrdMessageIdentifier.pack(identifier))
+        self.capture.write(frame)
+
+    def close(self):
+        self.capture.close()
+
+# Images are saved by the connection's MrdWriter while they are parsed
+class Hdf5Sink:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, identifier, frame):
+        self.connection.parse(identifier, frame)
+
+    def close(self):
+        self.connection.close_save_file()
+
+# Send a wire capture as it was received by the server, including its config,
+# metadata and close messages.  The config options are not used.
+def replay_capture(args):
+    logging.info("Replaying capture %s to MRD server at %s:%d" % (args.filename, args.address, args.port))
+    capture = wirecapture.CaptureSocket(args.filename)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((args.address, args.port))
+
+    process = multiprocessing.Process(target=connection_receive_loop, args=[sock, args.outfile, args.out_group])
+    process.daemon = True
+    process.start()
+
+    try:
+        for chunk in capture.read_all():
+            sock.sendall(chunk)
+    finally:
+        capture.close()
+
+    # Wait for incoming data and cleanup
+    logging.debug("Waiting for threads to finish")
+    process.join()
+    logging.info("Session complete")
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Example client for MRD streaming format',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('filename',                             help='Input file')
+    parser.add_argument('filename',                             help='Input file (MRD HDF5 file or wire capture)')
     parser.add_argument('-a', '--address',                      help='Address (hostname) of MRD server')
     parser.add_argument('-p', '--port',              type=int,  help='Port')
     parser.add_argument('-o', '--outfile',                      help='Output file')
@@ -199,6 +406,9 @@ if __name__ == '__main__':
     parser.add_argument('-G', '--out-group',                    help='Output group name')
     parser.add_argument('-c', '--config',                       help='Remote configuration file')
     parser.add_argument('-C', '--config-local',                 help='Local configuration file')
+    parser.add_argument('-b', '--bulk',    action='store_true', help='Read the input in large blocks on a separate thread and send them pre-serialized')
+    parser.add_argument('-d', '--duplex',  action='store_true', help='Send and receive on one socket from one process, reading the input as with --bulk')
+    parser.add_argument('-k', '--sink',              type=str,  help='Output of --duplex for received messages', choices=sinks)
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose mode')
     parser.add_argument('-l', '--logfile',           type=str,  help='Path to log file')
 
@@ -2,24 +2,137 @@
 
 import constants
 import ismrmrd
+import ismrmrd.hdf5
 import ctypes
+import struct
 import os
 from datetime import datetime
-import h5py
-import random
+import logsetup
+import metrics
+import mrdwriter
+import wirecapture
+import itertools
 
 import logging
 import socket
 import numpy as np
 
+# Default size of the reusable receive buffer.  Messages larger than this are
+# received into a dedicated buffer of their own.
+RECV_BUFFER_SIZE = 1024*1024
+
+# Policies for when queued outgoing messages are written to the socket:
+#   FLUSH_MESSAGE  Each message is written as soon as it is complete
+#   FLUSH_BATCH    Messages are written once flushBytes are queued, or when
+#                  flush() or send_close() is called
+FLUSH_MESSAGE = 'message'
+FLUSH_BATCH   = 'batch'
+SEND_BATCH_SIZE = 4*1024*1024
+
+# Maximum number of buffers passed to a single sendmsg() call
+SEND_MAX_BUFFERS = 1024
+
+# Numbers the --savedata files of the sessions of a process
+saveCounter = itertools.count()
+
+# Offsets of the packed AcquisitionHeader fields inspected while batching
+# readouts, so that headers can be checked without creating numpy scalars
+ACQ_HEADER_DTYPE       = ismrmrd.hdf5.acquisition_header_dtype
+ACQ_FLAGS_OFFSET       = ACQ_HEADER_DTYPE.fields['flags'][1]
+ACQ_CHANNELS_OFFSET    = ACQ_HEADER_DTYPE.fields['number_of_samples'][1]      # number_of_samples, available_channels, active_channels
+ACQ_TRAJ_DIMS_OFFSET   = ACQ_HEADER_DTYPE.fields['trajectory_dimensions'][1]
+ACQ_LAST_IN_SLICE_MASK = 1 << (ismrmrd.ACQ_LAST_IN_SLICE - 1)
+AcqFlags               = struct.Struct('<Q')
+AcqChannels            = struct.Struct('<HHH')
+AcqTrajDims            = struct.Struct('<H')
+
+# (number_of_samples, available_channels, active_channels, trajectory_dimensions)
+def acquisition_dimensions(buffer, offset=0):
+    return AcqChannels.unpack_from(buffer, offset + ACQ_CHANNELS_OFFSET) + AcqTrajDims.unpack_from(buffer, offset + ACQ_TRAJ_DIMS_OFFSET)
+
+# A block of consecutive acquisitions stored in numpy arrays instead of one
+# ismrmrd.Acquisition object per readout:
+#   head  structured array with the AcquisitionHeader fields, shape [N]
+#   data  k-space samples, complex64 [N cha RO]
+#   traj  trajectory, float32 [N RO dims]
+# Indexing with a slice, mask or index array returns a new AcquisitionBatch,
+# e.g. batch[np.argsort(batch.idx['kspace_encode_step_1'])]
+class AcquisitionBatch:
+    def __init__(self, head, data, traj):
+        self.head = head
+        self.data = data
+        self.traj = traj
+
+    @staticmethod
+    def empty(capacity, channels, samples, trajectoryDimensions):
+        return AcquisitionBatch(np.zeros(capacity, dtype=ismrmrd.hdf5.acquisition_header_dtype),
+                                np.empty((capacity, channels, samples), dtype=np.complex64),
+                                np.empty((capacity, samples, trajectoryDimensions), dtype=np.float32))
+
+    @staticmethod
+    def concatenate(batches):
+        if (len(batches) == 1):
+            return batches[0]
+        return AcquisitionBatch(np.concatenate([batch.head for batch in batches]),
+                                np.concatenate([batch.data for batch in batches]),
+                                np.concatenate([batch.traj for batch in batches]))
+
+    def __len__(self):
+        return len(self.head)
+
+    def __getitem__(self, index):
+        return AcquisitionBatch(self.head[index], self.data[index], self.traj[index])
+
+    @property
+    def idx(self):
+        return self.head['idx']
+
+    def is_flag_set(self, flag):
+        return (self.head['flags'] & np.uint64(1 << (flag - 1))) != 0
+
+    # Split into consecutive parts that each end where mask is True.  Returns a
+    # list of (part, ended) tuples, where ended is False for a trailing part.
+    def split_after(self, mask):
+        parts = []
+        start = 0
+        for end in np.flatnonzero(mask) + 1:
+            parts.append((self[start:end], True))
+            start = end
+        if (start < len(self)):
+            parts.append((self[start:], False))
+        return parts
+
+    def acquisition(self, index):
+        acq = ismrmrd.Acquisition(self.head[index:index+1].tobytes())
+        acq.data[:] = self.data[index]
+        acq.traj[:] = self.traj[index]
+        return acq
+
 class Connection:
-    def __init__(self, socket, savedata, savedataFile = "", savedataFolder = "", savedataGroup = "dataset"):
+    def __init__(self, socket, savedata, savedataFile = "", savedataFolder = "", savedataGroup = "dataset", recvBufferSize = RECV_BUFFER_SIZE, flushPolicy = FLUSH_MESSAGE, flushBytes = SEND_BATCH_SIZE, batchSize = 0, capture = None):
         self.savedata       = savedata
         self.savedataFile   = savedataFile
         self.savedataFolder = savedataFolder
         self.savedataGroup  = savedataGroup
         self.socket         = socket
         self.is_exhausted   = False
+        self.recvBuffer     = bytearray(recvBufferSize)
+        self.recvView       = memoryview(self.recvBuffer)
+        self.recvStart      = 0
+        self.recvEnd        = 0
+        self.flushPolicy    = flushPolicy
+        self.flushBytes     = flushBytes
+        self.sendQueue      = []
+        self.sendQueued     = 0
+        self.batchSize      = batchSize
+        self.saveClosed     = False
+        self.captureFile    = None
+        self.headerMessages = []
+        self.metrics        = metrics.disabled
+        self.sendIdentifier = None
+        self.sendStart      = 0
+        self.receivedLog    = logsetup.MessageLog("<-- Received")
+        self.sentLog        = logsetup.MessageLog("--> Sent")
         self.handlers       = {
             constants.MRD_MESSAGE_CONFIG_FILE:         self.read_config_file,
             constants.MRD_MESSAGE_CONFIG_TEXT:         self.read_config_text,
@@ -31,23 +144,68 @@ class Connection:
             constants.MRD_MESSAGE_ISMRMRD_IMAGE:       self.read_image
         }
         self.create_save_file()
+        if (capture if capture is not None else wirecapture.captureAll):
+            self.create_capture_file()
 
     def create_save_file(self):
         if (self.savedata is True):
             # Create savedata folder, if necessary
             if ((self.savedataFolder) and (not os.path.exists(self.savedataFolder))):
                 os.makedirs(self.savedataFolder)
-                logging.debug("Created folder " + self.savedataFolder + " to save incoming data")
+                logging.debug("Created folder %s to save incoming data", self.savedataFolder)
 
             if (self.savedataFile):
                 mrdFilePath = self.savedataFile
             else:
-                mrdFilePath = os.path.join(self.savedataFolder, "MRD_input_" + datetime.now().strftime("%Y-%m-%d-%H%M%S" + "_" + str(random.randint(0,100)) + ".h5"))
+                # Named by process and session, so that concurrent sessions
+                # never write to the same file
+                mrdFilePath = os.path.join(self.savedataFolder, "MRD_input_%s_%d_%d.h5" % (datetime.now().strftime("%Y-%m-%d-%H%M%S"), os.getpid(), next(saveCounter)))
 
-            # Create HDF5 file to store incoming MRD data
+            # Create HDF5 file to store incoming MRD data.  Messages are written
+            # by a background thread.
             logging.info("Incoming data will be saved to: '%s' in group '%s'", mrdFilePath, self.savedataGroup)
-            self.dset = ismrmrd.Dataset(mrdFilePath, self.savedataGroup)
-            self.dset._file.require_group(self.savedataGroup)
+            self.dset = mrdwriter.MrdWriter(mrdFilePath, self.savedataGroup)
+
+    # Write the remaining messages and close the file.  Called when either side
+    # closes the session, but only closes the file and records the writer's time
+    # in the save stage once.  Other writers than MrdWriter (e.g. a plain
+    # ismrmrd.Dataset) are closed without recording the stage.
+    def close_save_file(self):
+        if ((self.savedata is True) and (getattr(self, 'dset', None) is not None) and (not self.saveClosed)):
+            logging.debug("Closing file")
+            self.saveClosed = True
+            self.dset.close()
+            stats = getattr(self.dset, 'stats', None)
+            if (stats is not None):
+                stats = stats()
+                self.metrics.add(metrics.STAGE_SAVE, stats['busy_s'], stats['cpu_s'], stats['writes'])
+
+    # Append all bytes received from now on to a wire capture.  The config and
+    # metadata messages are re-encoded if they were already received, followed
+    # by any data received but not parsed yet.
+    def create_capture_file(self, path=None):
+        if (self.captureFile is not None):
+            return
+        if (path is None):
+            path = wirecapture.capture_path(wirecapture.captureFolder, wirecapture.captureCompress)
+
+        logging.info("Incoming data will be captured to: '%s'", path)
+        self.captureFile = wirecapture.CaptureWriter(path, path.endswith(wirecapture.CAPTURE_COMPRESSED_EXTENSION))
+        for message in self.headerMessages:
+            self.captureFile.write(message)
+        if (self.recvEnd > self.recvStart):
+            self.captureFile.write(self.recvView[self.recvStart:self.recvEnd])
+
+    def close_capture_file(self):
+        if (self.captureFile is not None):
+            self.captureFile.close()
+
+    # Close the save file and the capture, whichever are open
+    def close_files(self):
+        try:
+            self.close_save_file()
+        finally:
+            self.close_capture_file()
 
     def __iter__(self):
         while not self.is_exhausted:
@@ -56,17 +214,165 @@ class Connection:
     def __next__(self):
         return self.next()
 
+    # Return the next nbytes received as a memoryview.  Data is received in
+    # large chunks into a reusable buffer with recv_into(), so most calls do not
+    # need a system call.  The returned view is only valid until the next call
+    # to read().  Fewer than nbytes are returned if the socket was closed.
     def read(self, nbytes):
-        return self.socket.recv(nbytes, socket.MSG_WAITALL)
+        start = self.recvStart
+        end   = start + nbytes
+        if (end > self.recvEnd):
+            if (nbytes > len(self.recvBuffer)):
+                return self.read_large(nbytes)
+            self.fill(nbytes)
+            start = self.recvStart
+            end   = min(start + nbytes, self.recvEnd)
+
+        self.recvStart = end
+        return self.recvView[start:end]
+
+    # Receive until at least nbytes are buffered or the socket is closed
+    def fill(self, nbytes):
+        available = self.recvEnd - self.recvStart
+
+        # Move any remaining data to the start of the buffer to make space
+        if (self.recvStart + nbytes > len(self.recvBuffer)):
+            self.recvBuffer[0:available] = self.recvView[self.recvStart:self.recvEnd]
+            self.recvStart = 0
+            self.recvEnd   = available
+
+        while (self.recvEnd - self.recvStart < nbytes):
+            received = self.recv_into(self.recvView[self.recvEnd:])
+            if (received == 0):
+                break
+            self.recvEnd += received
+
+    # Return the next nbytes without consuming them.  Fewer than nbytes are
+    # returned if the socket was closed.
+    def peek(self, nbytes):
+        if (self.recvStart + nbytes > self.recvEnd):
+            self.fill(nbytes)
+        return self.recvView[self.recvStart:min(self.recvStart+nbytes, self.recvEnd)]
+
+    # Receive array.nbytes directly into the memory of a numpy array.  Large
+    # payloads are received straight into the array with recv_into(), without
+    # an intermediate bytes object.  Small payloads are copied from the receive
+    # buffer so that many small messages still share a single recv_into() call.
+    def read_into(self, array):
+        if ((not array.flags.c_contiguous) or (not array.flags.writeable)):
+            array[...] = np.frombuffer(self.read(array.nbytes), dtype=array.dtype).reshape(array.shape)
+            return
+        self.read_into_view(memoryview(array.reshape(-1).view(np.uint8)))
+
+    # Receive len(view) bytes into a writable, flat byte memoryview
+    def read_into_view(self, view):
+        nbytes = len(view)
+        if (nbytes < len(self.recvBuffer)//2):
+            data = self.read(nbytes)
+            if (len(data) < nbytes):
+                raise ConnectionError("Connection closed after %d of %d bytes of message data" % (len(data), nbytes))
+            view[:] = data
+            return
+
+        received = min(self.recvEnd - self.recvStart, nbytes)
+        view[0:received] = self.recvView[self.recvStart:self.recvStart+received]
+        self.recvStart += received
+
+        while (received < nbytes):
+            count = self.recv_into(view[received:])
+            if (count == 0):
+                raise ConnectionError("Connection closed after %d of %d bytes of message data" % (received, nbytes))
+            received += count
+
+    # All data is received here, so that it can be captured
+    def recv_into(self, view):
+        start = self.metrics.clock()
+        count = self.socket.recv_into(view)
+        self.metrics.stop(metrics.STAGE_RECEIVE, start)
+        if (self.captureFile is not None):
+            self.captureFile.write(view[0:count])
+        return count
+
+    # Messages larger than the receive buffer get a buffer of their own
+    def read_large(self, nbytes):
+        data = bytearray(nbytes)
+        view = memoryview(data)
+
+        available = self.recvEnd - self.recvStart
+        view[0:available] = self.recvView[self.recvStart:self.recvEnd]
+        self.recvStart = 0
+        self.recvEnd   = 0
+
+        while (available < nbytes):
+            received = self.recv_into(view[available:])
+            if (received == 0):
+                return view[0:available]
+            available += received
+
+        return view
+
+    # Queue data to be sent.  Each message is gathered from its pieces and
+    # written with a single sendmsg() call when it is flushed.
+    def write(self, data):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)  # e.g. ctypes header structures, which may be modified after queueing
+        data = memoryview(data).cast('B')
+        self.sendQueue.append(data)
+        self.sendQueued += len(data)
+
+    # Called before the pieces of each message are queued
+    def start_message(self, identifier):
+        self.sendIdentifier = identifier
+        self.sendStart      = self.sendQueued
+        self.write(constants.MrdMessageIdentifier.pack(identifier))
+
+    # Called after each message (or count messages) is queued to apply the
+    # flush policy
+    def end_message(self, count=1):
+        self.metrics.sent(self.sendIdentifier, self.sendQueued - self.sendStart, count)
+        if ((self.flushPolicy == FLUSH_MESSAGE) or (self.sendQueued >= self.flushBytes)):
+            self.flush()
+
+    # Queue count complete messages of type identifier, IDs included, that were
+    # serialized into one buffer elsewhere (e.g. by mrdreader.MrdReader)
+    def send_serialized(self, identifier, buffer, count=1):
+        self.sentLog.add(identifier, count)
+        self.sendIdentifier = identifier
+        self.sendStart      = self.sendQueued
+        self.write(buffer)
+        self.end_message(count)
+
+    # Write all queued data, resuming after partial writes
+    def flush(self):
+        start = self.metrics.clock()
+        buffers = self.sendQueue
+        first = 0
+        while (first < len(buffers)):
+            sent = self.socket.sendmsg(buffers[first:first+SEND_MAX_BUFFERS])
+            while (sent > 0):
+                if (sent >= len(buffers[first])):
+                    sent -= len(buffers[first])
+                    first += 1
+                else:
+                    buffers[first] = buffers[first][sent:]
+                    sent = 0
+
+        self.sendQueue  = []
+        self.sendQueued = 0
+        self.sendStart  = 0
+        self.metrics.stop(metrics.STAGE_SEND, start)
 
     def next(self):
+        start = self.metrics.clock()
         id = self.read_mrd_message_identifier()
 
         if (self.is_exhausted == True):
             return
 
         handler = self.handlers.get(id, lambda: Connection.unknown_message_identifier(id))
-        return handler()
+        item = handler()
+        self.metrics.received(id, item, start)
+        return item
 
     @staticmethod
     def unknown_message_identifier(identifier):
@@ -94,8 +400,9 @@ class Connection:
     #   Config file name (1024 bytes, char          )
     def send_config_file(self, filename):
         logging.info("--> Sending MRD_MESSAGE_CONFIG_FILE (1)")
-        self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CONFIG_FILE))
-        self.socket.send(constants.MrdMessageConfigurationFile.pack(filename.encode()))
+        self.start_message(constants.MRD_MESSAGE_CONFIG_FILE)
+        self.write(constants.MrdMessageConfigurationFile.pack(filename.encode()))
+        self.end_message()
 
     def read_config_file(self):
         logging.info("<-- Received MRD_MESSAGE_CONFIG_FILE (1)")
@@ -104,10 +411,9 @@ class Connection:
         config_file = config_file.split('\x00',1)[0]  # Strip off null terminators in fixed 1024 size
 
         if (self.savedata is True):
-            self.dset._file.require_group("dataset")
-            dsetConfigFile = self.dset._dataset.require_dataset('config_file',shape=(1,), dtype=h5py.special_dtype(vlen=bytes))
-            dsetConfigFile[0] = bytes(config_file, 'utf-8')
+            self.dset.write_config_file(config_file)
 
+        self.headerMessages.append(wirecapture.encode_config_file(config_file))
         return config_file
 
     # ----- MRD_MESSAGE_CONFIG_TEXT (2) --------------------------------------
@@ -119,21 +425,22 @@ class Connection:
     #   Config text data (  variable, char          )
     def send_config_text(self, contents):
         logging.info("--> Sending MRD_MESSAGE_CONFIG_TEXT (2)")
-        self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CONFIG_TEXT))
-        self.socket.send(constants.MrdMessageLength.pack(len(contents)+1)) # Add null terminator
-        self.socket.send('%s\0' % contents)                                # Add null terminator
+        contents_with_nul = ('%s\0' % contents).encode() # Add null terminator
+        self.start_message(constants.MRD_MESSAGE_CONFIG_TEXT)
+        self.write(constants.MrdMessageLength.pack(len(contents_with_nul)))
+        self.write(contents_with_nul)
+        self.end_message()
 
     def read_config_text(self):
         logging.info("<-- Received MRD_MESSAGE_CONFIG_TEXT (2)")
         length = self.read_mrd_message_length()
         config = self.read(length)
-        config = config.decode("utf-8").split('\x00',1)[0]  # Strip off null teminator
+        config = bytes(config).decode("utf-8").split('\x00',1)[0]  # Strip off null teminator
 
         if (self.savedata is True):
-            self.dset._file.require_group("dataset")
-            dsetConfig = self.dset._dataset.require_dataset('config',shape=(1,), dtype=h5py.special_dtype(vlen=bytes))
-            dsetConfig[0] = bytes(config, 'utf-8')
+            self.dset.write_config(config)
 
+        self.headerMessages.append(wirecapture.encode_text(constants.MRD_MESSAGE_CONFIG_TEXT, config))
         return config
 
     # ----- MRD_MESSAGE_METADATA_XML_TEXT (3) -----------------------------------
@@ -145,34 +452,43 @@ class Connection:
     #   Text xml data    (  variable, char          )
     def send_metadata(self, contents):
         logging.info("--> Sending MRD_MESSAGE_METADATA_XML_TEXT (3)")
-        self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_METADATA_XML_TEXT))
+        self.start_message(constants.MRD_MESSAGE_METADATA_XML_TEXT)
         contents_with_nul = '%s\0' % contents # Add null terminator
-        self.socket.send(constants.MrdMessageLength.pack(len(contents_with_nul.encode())))
-        self.socket.send(contents_with_nul.encode())
+        self.write(constants.MrdMessageLength.pack(len(contents_with_nul.encode())))
+        self.write(contents_with_nul.encode())
+        self.end_message()
 
     def read_metadata(self):
         logging.info("<-- Received MRD_MESSAGE_METADATA_XML_TEXT (3)")
         length = self.read_mrd_message_length()
         metadata = self.read(length)
-        metadata = metadata.decode("utf-8").split('\x00',1)[0]  # Strip off null teminator
+        metadata = bytes(metadata).decode("utf-8").split('\x00',1)[0]  # Strip off null teminator
 
         if (self.savedata is True):
-            self.dset.write_xml_header(bytes(metadata, 'utf-8'))
+            self.dset.write_xml_header(metadata)
 
+        self.headerMessages.append(wirecapture.encode_text(constants.MRD_MESSAGE_METADATA_XML_TEXT, metadata))
         return metadata
 
     # ----- MRD_MESSAGE_CLOSE (4) ----------------------------------------------
     # This message signals that all data has been sent (either from server or client).
+    # The save file and capture are closed even if the client has gone away and
+    # sending fails.
     def send_close(self):
         logging.info("--> Sending MRD_MESSAGE_CLOSE (4)")
-        self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CLOSE))
+        self.sentLog.log_totals()
+        try:
+            self.start_message(constants.MRD_MESSAGE_CLOSE)
+            self.end_message()
+            self.flush()
+        finally:
+            self.close_files()
 
     def read_close(self):
         logging.info("<-- Received MRD_MESSAGE_CLOSE (4)")
+        self.receivedLog.log_totals()
 
-        if (self.savedata is True):
-            logging.debug("Closing file")
-            self.dset.close()
+        self.close_files()
 
         self.is_exhausted = True
         return
@@ -185,15 +501,18 @@ class Connection:
     #   Text data        (  variable, char          )
     def send_text(self, contents):
         logging.info("--> Sending MRD_MESSAGE_TEXT (3)")
-        self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_TEXT))
-        self.socket.send(constants.MrdMessageLength.pack(len(contents)+1)) # Add null terminator
-        self.socket.send('%s\0' % contents)                                # Add null terminator
+        contents_with_nul = ('%s\0' % contents).encode() # Add null terminator
+        self.start_message(constants.MRD_MESSAGE_TEXT)
+        self.write(constants.MrdMessageLength.pack(len(contents_with_nul)))
+        self.write(contents_with_nul)
+        self.end_message()
 
     def read_text(self):
         logging.info("<-- Received MRD_MESSAGE_TEXT (3)")
         length = self.read_mrd_message_length()
         text = self.read(length)
-        text = text.decode("utf-8").split('\x00',1)[0]  # Strip off null teminator
+        text = bytes(text).decode("utf-8").split('\x00',1)[0]  # Strip off null teminator
+        logging.info("    %s", text)
         return text
 
     # ----- MRD_MESSAGE_ISMRMRD_ACQUISITION (1008) -----------------------------
@@ -204,19 +523,77 @@ class Connection:
     #   Trajectory       (  variable, float         )
     #   Raw k-space data (  variable, float         )
     def send_acquisition(self, acquisition):
-        logging.info("--> Sending MRD_MESSAGE_ISMRMRD_ACQUISITION (1008)")
-        self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION))
-        acquisition.serialize_into(self.socket.send)
+        self.sentLog.add(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION)
+        self.start_message(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION)
+        acquisition.serialize_into(self.write)
+        self.end_message()
 
     def read_acquisition(self):
-        logging.info("<-- Received MRD_MESSAGE_ISMRMRD_ACQUISITION (1008)")
-        acq = ismrmrd.Acquisition.deserialize_from(self.read)
+        if (self.batchSize > 0):
+            return self.read_acquisition_batch()
+
+        self.receivedLog.add(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION)
+        # Explicit version of deserialize_from(), consuming each piece before
+        # the next read() reuses the receive buffer
+        acq = ismrmrd.Acquisition(self.read(ctypes.sizeof(ismrmrd.AcquisitionHeader)))
+
+        trajectory = acq.traj
+        if (trajectory.size > 0):
+            self.read_into(trajectory)
+        self.read_into(acq.data)
 
         if (self.savedata is True):
             self.dset.append_acquisition(acq)
 
         return acq
 
+    # Decode consecutive acquisitions into an AcquisitionBatch.  The batch ends
+    # after a readout with ACQ_LAST_IN_SLICE set, when the next message is not
+    # an acquisition with the same dimensions, or after batchSize readouts.
+    def read_acquisition_batch(self):
+        headerSize = ACQ_HEADER_DTYPE.itemsize
+        idSize     = constants.SIZEOF_MRD_MESSAGE_IDENTIFIER
+        header     = bytes(self.read(headerSize))
+        dims       = acquisition_dimensions(header)
+
+        batch = AcquisitionBatch.empty(self.batchSize, dims[2], dims[0], dims[3])
+
+        # Readouts are copied into flat byte views of the batch arrays
+        headView  = memoryview(batch.head.view(np.uint8))
+        dataView  = memoryview(batch.data.reshape(-1).view(np.uint8))
+        trajView  = memoryview(batch.traj.reshape(-1).view(np.uint8))
+        dataBytes = batch.data[0].nbytes
+        trajBytes = batch.traj[0].nbytes
+        headView[0:headerSize] = header
+
+        count = 0
+        while True:
+            if (trajBytes > 0):
+                self.read_into_view(trajView[count*trajBytes:(count+1)*trajBytes])
+            self.read_into_view(dataView[count*dataBytes:(count+1)*dataBytes])
+            count += 1
+
+            if ((count == self.batchSize) or (AcqFlags.unpack_from(headView, (count-1)*headerSize + ACQ_FLAGS_OFFSET)[0] & ACQ_LAST_IN_SLICE_MASK)):
+                break
+
+            # Continue only if the next message is an acquisition of the same size
+            nextMessage = self.peek(idSize + headerSize)
+            if ((len(nextMessage) < idSize + headerSize)
+                or (constants.MrdMessageIdentifier.unpack_from(nextMessage)[0] != constants.MRD_MESSAGE_ISMRMRD_ACQUISITION)
+                or (acquisition_dimensions(nextMessage, idSize) != dims)):
+                break
+
+            self.recvStart += idSize
+            headView[count*headerSize:(count+1)*headerSize] = self.read(headerSize)
+
+        batch = batch[0:count]
+        self.receivedLog.add(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, count)
+
+        if (self.savedata is True):
+            self.dset.append_acquisitions(batch)
+
+        return batch
+
     # ----- MRD_MESSAGE_ISMRMRD_IMAGE (1022) -----------------------------------
     # This message contains raw k-space data from a single readout.
     # Message consists of:
@@ -226,29 +603,30 @@ class Connection:
     #   Attribute data   (  variable, char          )
     #   Image data       (  variable, variable      )
     def send_image(self, image):
-        logging.info("--> Sending MRD_MESSAGE_ISMRMRD_IMAGE (1022)")
-        self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_IMAGE))
-        image.serialize_into(self.socket.send)
+        self.sentLog.add(constants.MRD_MESSAGE_ISMRMRD_IMAGE)
+        self.start_message(constants.MRD_MESSAGE_ISMRMRD_IMAGE)
+        image.serialize_into(self.write)
+        self.end_message()
 
         # Explicit version of serialize_into() for more verbose debugging
-        # self.socket.send(image.getHead())
-        # self.socket.send(constants.MrdMessageAttribLength.pack(len(image.attribute_string)))
-        # self.socket.send(bytes(image.attribute_string, 'utf-8'))
-        # self.socket.send(bytes(image.data))
+        # self.write(image.getHead())
+        # self.write(constants.MrdMessageAttribLength.pack(len(image.attribute_string)))
+        # self.write(bytes(image.attribute_string, 'utf-8'))
+        # self.write(bytes(image.data))
 
     def read_image(self):
-        logging.info("<-- Received MRD_MESSAGE_ISMRMRD_IMAGE (1022)")
+        self.receivedLog.add(constants.MRD_MESSAGE_ISMRMRD_IMAGE)
         # return ismrmrd.Image.deserialize_from(self.read)
 
         # Explicit version of deserialize_from() for more verbose debugging
         logging.debug("   Reading in %d bytes of image header", ctypes.sizeof(ismrmrd.ImageHeader))
-        header_bytes = self.read(ctypes.sizeof(ismrmrd.ImageHeader))
+        header_bytes = bytes(self.read(ctypes.sizeof(ismrmrd.ImageHeader)))
 
         attribute_length_bytes = self.read(ctypes.sizeof(ctypes.c_uint64))
         attribute_length = ctypes.c_uint64.from_buffer_copy(attribute_length_bytes)
         logging.debug("   Reading in %d bytes of attributes", attribute_length.value)
 
-        attribute_bytes = self.read(attribute_length.value)
+        attribute_bytes = bytes(self.read(attribute_length.value))
         logging.debug("   Attributes: %s", attribute_bytes)
 
         image = ismrmrd.Image(header_bytes, attribute_bytes.decode('utf-8'))
@@ -261,12 +639,10 @@ class Connection:
         nbytes = nentries * ismrmrd.get_dtype_from_data_type(image.data_type).itemsize
 
         logging.debug("Reading in %d bytes of image data", nbytes)
-        data_bytes = self.read(nbytes)
-
-        image.data.ravel()[:] = np.frombuffer(data_bytes, dtype=ismrmrd.get_dtype_from_data_type(image.data_type))
+        self.read_into(image.data)
 
         if (self.savedata is True):
-            self.dset.append_image("images_%d" % image.image_series_index, image)
+            self.dset.append_image(image)
 
         return image
 
@@ -277,12 +653,13 @@ class Connection:
     #   Fixed header     ( 240 bytes, mixed         )
     #   Waveform data    (  variable, uint32_t      )
     def send_waveform(self, waveform):
-        logging.info("--> Sending MRD_MESSAGE_ISMRMRD_WAVEFORM (1026)")
-        self.socket.send(constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_WAVEFORM))
-        waveform.serialize_into(self.socket.send)
+        self.sentLog.add(constants.MRD_MESSAGE_ISMRMRD_WAVEFORM)
+        self.start_message(constants.MRD_MESSAGE_ISMRMRD_WAVEFORM)
+        waveform.serialize_into(self.write)
+        self.end_message()
 
     def read_waveform(self):
-        logging.info("<-- Received MRD_MESSAGE_ISMRMRD_WAVEFORM (1026)")
+        self.receivedLog.add(constants.MRD_MESSAGE_ISMRMRD_WAVEFORM)
         waveform = ismrmrd.Waveform.deserialize_from(self.read)
 
         if (self.savedata is True):
@@ -0,0 +1,175 @@
+import itertools
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import numpy as np
+
+import metrics
+
+# Intermediate arrays of the recons can be saved for debugging.  Each dump has
+# a level and is only written if it is at or below the configured level:
+#   none    nothing is written (default)
+#   images  final int16 images
+#   all     also raw k-space and intermediate float images
+DUMP_NONE   = 0
+DUMP_IMAGES = 1
+DUMP_ALL    = 2
+
+levels = {
+    'none':   DUMP_NONE,
+    'images': DUMP_IMAGES,
+    'all':    DUMP_ALL,
+}
+
+# Folder under which a directory is created for every session
+DEBUG_FOLDER = "/tmp/share/debug"
+
+# Dumps waiting to be written per process.  When the queue is full, further
+# dumps are dropped instead of blocking the recon.
+DEBUG_QUEUE_SIZE = 16
+
+# Seconds a session waits at its end for its dumps to be written
+DEBUG_FLUSH_TIMEOUT = 10
+
+level    = DUMP_NONE
+folder   = DEBUG_FOLDER
+configs  = None
+every    = 1
+compress = False
+
+# Set what is dumped: the level, the folder, the configs that are dumped (None
+# for all), every how many slices or images of a session are dumped and
+# whether files are compressed (.npz instead of .npy).  Like
+# fftengine.configure(), this should be called before sessions are started.
+def configure(dumpLevel='none', dumpFolder=DEBUG_FOLDER, dumpConfigs=None, dumpEvery=1, dumpCompress=False):
+    global level, folder, configs, every, compress
+    if dumpLevel not in levels:
+        raise ValueError("Unknown debug dump level '%s'" % dumpLevel)
+    if (dumpEvery < 1):
+        raise ValueError("Debug dumps must be written every 1 or more slices, not %d" % dumpEvery)
+
+    level    = levels[dumpLevel]
+    folder   = dumpFolder
+    configs  = set(dumpConfigs) if dumpConfigs else None
+    every    = dumpEvery
+    compress = dumpCompress
+    if (level > DUMP_NONE):
+        logging.info("Writing %s debug dumps of every %d slices for %s to %s", dumpLevel, every, ', '.join(sorted(configs)) if configs else "all configs", folder)
+
+
+# Background thread writing the dumps of all sessions of a process.  It is
+# started on first use, and again in forked children, which do not inherit it.
+class Writer:
+    def __init__(self, queueSize=DEBUG_QUEUE_SIZE):
+        self.queue   = queue.Queue(maxsize=queueSize)
+        self.lock    = threading.Lock()
+        self.pid     = None
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if (self.pid != os.getpid()):
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+                self.pid   = os.getpid()
+                threading.Thread(target=self.run, name="debug-dump", daemon=True).start()
+
+    # Returns False if the dump was dropped.  The full check comes before the
+    # copy so that a dropped dump costs nothing.
+    def put(self, path, name, data, compressed):
+        self.start()
+        if self.queue.full():
+            self.dropped += 1
+            logging.debug("Debug dump queue is full, dropped %s (%d dropped)", path, self.dropped)
+            return False
+        try:
+            self.queue.put_nowait((path, name, np.array(data, copy=True), compressed))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def run(self):
+        while True:
+            path, name, data, compressed = self.queue.get()
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if compressed:
+                    np.savez_compressed(path, **{name: data})
+                else:
+                    np.save(path, data)
+            except Exception as e:
+                logging.warning("Failed to write debug dump %s: %s", path, e)
+            finally:
+                self.queue.task_done()
+
+    # Wait up to timeout seconds for queued dumps to be written
+    def flush(self, timeout=DEBUG_FLUSH_TIMEOUT):
+        if (self.pid != os.getpid()):
+            return True
+        with self.queue.all_tasks_done:
+            return self.queue.all_tasks_done.wait_for(lambda: self.queue.unfinished_tasks == 0, timeout)
+
+writer = Writer()
+
+
+# Dumps of one slice or image, written to "<session folder>/<prefix><name>".
+# The recons call save() for every intermediate array.  A Dump is sent along
+# with the data to recon threads and processes.
+class Dump:
+    def __init__(self, folder=None, prefix="", level=DUMP_NONE, compress=False):
+        self.folder   = folder
+        self.prefix   = prefix
+        self.level    = level
+        self.compress = compress
+
+    @property
+    def enabled(self):
+        return (self.level > DUMP_NONE)
+
+    def save(self, name, data, dumpLevel=DUMP_ALL):
+        if (dumpLevel > self.level):
+            return
+        path = os.path.join(self.folder, self.prefix + name + (".npz" if self.compress else ".npy"))
+        writer.put(path, name, data, self.compress)
+
+# Used when dumps are not written
+disabled = Dump()
+
+
+# Config as used in directory names: metrics.config_label(), which is 'text'
+# for config text, with characters other than letters, digits, '.', '_' and '-'
+# replaced so that the config cannot add path components
+def config_folder_label(config):
+    return re.sub(r'[^A-Za-z0-9._-]', '_', metrics.config_label(config))
+
+
+# Debug dumps of a session, in their own directory named after the start time,
+# process and config.  slice() returns the Dump of the next slice or image,
+# which is disabled for the slices that are not sampled.
+class Session:
+    counter = itertools.count()
+
+    def __init__(self, config):
+        self.level = level if ((configs is None) or (config in configs)) else DUMP_NONE
+        self.count = 0
+        self.folder = None
+        if (self.level > DUMP_NONE):
+            name = "%s-%d-%d-%s" % (time.strftime("%Y%m%d-%H%M%S"), os.getpid(), next(Session.counter), config_folder_label(config))
+            self.folder = os.path.join(folder, name)
+            logging.info("Writing debug dumps to %s", self.folder)
+
+    def slice(self):
+        index = self.count
+        self.count += 1
+        if (self.level == DUMP_NONE) or (index % every != 0):
+            return disabled
+        return Dump(self.folder, "%04d_" % index, self.level, compress)
+
+    # Give queued dumps of this process some time to be written before the
+    # session ends, since session processes do not wait for daemon threads
+    def close(self):
+        if (self.level > DUMP_NONE) and (not writer.flush()):
+            logging.warning("Debug dumps of %s were not written within %d s", self.folder, DEBUG_FLUSH_TIMEOUT)
@@ -0,0 +1,160 @@
+import functools
+import logging
+import os
+import threading
+import numpy as np
+
+try:
+    import scipy.fft
+except ImportError:
+    scipy = None
+
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+# numpy.fft functions accept out= from numpy 2.0
+NUMPY_FFT_OUT = np.lib.NumpyVersion(np.__version__) >= '2.0.0'
+
+# Number of FFT plans and shift masks kept per process.  Plans are shared by
+# all slices and sessions with the same shape.
+FFT_PLAN_CACHE_SIZE = 16
+
+# FFT implementations used by the recon modules:
+#   numpy   numpy.fft, single-threaded
+#   scipy   scipy.fft with workers=threads
+#   pyfftw  FFTW plans created once per shape and reused, with threads
+# Backends that are not installed fall back to numpy.  ifftn() transforms over
+# the given axes, may overwrite data and returns an array of the same dtype.
+class NumpyEngine:
+    name = 'numpy'
+
+    def __init__(self, threads=1):
+        self.threads = 1
+
+    # With numpy 2.0 or later, transform in place one axis at a time
+    def ifftn(self, data, axes):
+        if NUMPY_FFT_OUT:
+            for axis in reversed(axes):
+                data = np.fft.ifft(data, axis=axis, out=data)
+            return data
+        return np.fft.ifftn(data, axes=axes).astype(data.dtype, copy=False)
+
+class ScipyEngine(NumpyEngine):
+    name = 'scipy'
+
+    def __init__(self, threads=1):
+        self.threads = threads
+
+    def ifftn(self, data, axes):
+        return scipy.fft.ifftn(data, axes=axes, workers=self.threads, overwrite_x=True).astype(data.dtype, copy=False)
+
+class FftwEngine(NumpyEngine):
+    name = 'pyfftw'
+
+    def __init__(self, threads=1):
+        self.threads = threads
+
+    def ifftn(self, data, axes):
+        plan, lock = fftw_plan(data.shape, data.dtype.str, tuple(axes), self.threads)
+        output = pyfftw.empty_aligned(plan.output_shape, dtype=plan.output_dtype)
+        with lock:
+            plan(data, output)
+        return output
+
+@functools.lru_cache(maxsize=FFT_PLAN_CACHE_SIZE)
+def fftw_plan(shape, dtype, axes, threads):
+    logging.debug("Creating FFTW plan for %s %s over axes %s", shape, dtype, axes)
+    template = pyfftw.empty_aligned(shape, dtype=dtype)
+    plan = pyfftw.builders.ifftn(template, axes=axes, threads=threads, planner_effort='FFTW_MEASURE', avoid_copy=False)
+    return plan, threading.Lock()
+
+backends = {
+    'numpy':  NumpyEngine,
+    'scipy':  ScipyEngine,
+    'pyfftw': FftwEngine,
+}
+
+def available_backends():
+    available = ['numpy']
+    if (scipy is not None):
+        available.append('scipy')
+    if (pyfftw is not None):
+        available.append('pyfftw')
+    return available
+
+def create_engine(backend='numpy', threads=0):
+    if (threads <= 0):
+        threads = os.cpu_count() or 1
+    if backend not in available_backends():
+        logging.warning("FFT backend '%s' is not available.  Using numpy", backend)
+        backend = 'numpy'
+    return backends[backend](threads)
+
+# Engine used by centered_ifftn() by default.  Set with configure() before
+# sessions are started so that forked session processes inherit it.
+defaultEngine = NumpyEngine()
+
+def configure(backend='numpy', threads=0):
+    global defaultEngine
+    defaultEngine = create_engine(backend, threads)
+    logging.info("Using %s FFT backend with %d threads", defaultEngine.name, defaultEngine.threads)
+
+
+# For an even length N, fftshift and ifftshift are the same circular shift by
+# N/2, and
+#   fftshift(ifft(ifftshift(x)))[k] = (-1)^(N/2) (-1)^k ifft((-1)^n x[n])[k]
+# so both shifts can be replaced by multiplying the input and output by an
+# alternating +1/-1 mask.  This avoids two full copies of the array.  Masks are
+# cached per shape, with size 1 along the axes they are broadcast over.
+@functools.lru_cache(maxsize=FFT_PLAN_CACHE_SIZE)
+def shift_masks(shape, axes):
+    mask = np.ones([1]*len(shape), dtype=np.float32)
+    sign = 1
+    for axis in axes:
+        n = shape[axis]
+        alternating = np.ones(n, dtype=np.float32)
+        alternating[1::2] = -1
+        mask = mask * alternating.reshape([n if (i == axis) else 1 for i in range(len(shape))])
+        sign *= (-1)**(n//2)
+    mask.setflags(write=False)
+    return mask, (mask if (sign == 1) else -mask)
+
+# Centered inverse FFT over axes, equivalent to
+#   fftshift(ifftn(ifftshift(data, axes), axes=axes), axes)
+# computed in the complex dtype given (by default that of data), i.e. with the
+# k-space centre at index N//2 as synthetic.py generates it.  The input is not
+# modified unless overwrite is set.  The conversion to dtype is done by the
+# same pass that applies the input mask, so only one array of the result size
+# is allocated, or none if data is overwritten and already of that dtype or an
+# array of the result's shape and dtype is given as out (e.g. a preallocated
+# buffer).  The result is then usually out itself, except with backends that
+# return a new array.  Odd sizes along any of the axes use the shifts instead
+# of the masks, and copy the result into out if one is given.
+def centered_ifftn(data, axes, engine=None, dtype=None, overwrite=False, out=None):
+    if (engine is None):
+        engine = defaultEngine
+    if (dtype is None):
+        dtype = np.result_type(data.dtype, np.complex64)
+    overwrite = overwrite and (data.dtype == dtype)
+
+    axes = tuple(axis % data.ndim for axis in axes)
+    if any(data.shape[axis] % 2 for axis in axes):
+        data = np.fft.ifftshift(data, axes=axes).astype(dtype, copy=False)
+        data = np.fft.fftshift(engine.ifftn(data, axes), axes=axes)
+        if (out is None):
+            return data
+        out[...] = data
+        return out
+
+    inputMask, outputMask = shift_masks(tuple(data.shape[axis] if (axis in axes) else 1 for axis in range(data.ndim)), axes)
+    if (out is None) and overwrite:
+        out = data
+    data = engine.ifftn(np.multiply(data, inputMask, out=out, dtype=dtype), axes)
+    data *= outputMask
+    return data
+
+def centered_ifft2(data, axes=(-2, -1), engine=None, dtype=None, out=None):
+    return centered_ifftn(data, axes, engine, dtype, out=out)
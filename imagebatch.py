@@ -0,0 +1,127 @@
+import collections
+import logging
+import time
+import ismrmrd
+import ismrmrd.hdf5
+import ismrmrd.image
+import numpy as np
+
+import constants
+
+# Batching of incoming image series for recons with a processImages function
+# (see recons.Recon).  Consecutive images with the same shape, data type and
+# image_series_index are collected into one batch, which the recon processes
+# as a single stack and returns as SerializedImages, the MRD messages of all
+# its images in one buffer.  This avoids the Python overhead per image of
+# ismrmrd.Image, whose attribute string is parsed when set and serialized
+# again when sent.
+#
+# A batch is processed when it has batchSize images, when an image of another
+# shape or series or a slice of raw data arrives, when the input ends, or at
+# the latest batchLatency seconds after its first image arrived.  The pipelined
+# and asyncio servers process a batch as soon as it is due.  Without a
+# pipeline, the session only notices this when the next message arrives.
+
+# Maximum images per batch (0 to process images one by one)
+IMAGE_BATCH_SIZE = 0
+
+# Seconds an image may wait for its batch to fill
+IMAGE_BATCH_LATENCY = 0.05
+
+IMAGE_ID = constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_IMAGE)
+
+batchSize    = IMAGE_BATCH_SIZE
+batchLatency = IMAGE_BATCH_LATENCY
+
+# Like fftengine.configure(), this should be called before sessions are started
+def configure(size=IMAGE_BATCH_SIZE, latency=IMAGE_BATCH_LATENCY):
+    global batchSize, batchLatency
+    batchSize    = size
+    batchLatency = latency
+
+def enabled():
+    return batchSize > 1
+
+# count MRD image messages, IDs included, for Connection.send_serialized()
+SerializedImages = collections.namedtuple('SerializedImages', ['count', 'buffer'])
+
+# Send an ismrmrd.Image or SerializedImages returned by a recon
+def send(connection, item):
+    if isinstance(item, SerializedImages):
+        logging.debug("Sending %d images to client", item.count)
+        connection.send_serialized(constants.MRD_MESSAGE_ISMRMRD_IMAGE, item.buffer, item.count)
+    else:
+        logging.debug("Sending image to client:\n%s", item)
+        connection.send_image(item)
+
+# Serialize images given as their header structs, one attribute string and a
+# [image ...] stack of their data, as in ismrmrd.Image.serialize_into().  The
+# data type and attribute length of the headers are set here.
+def serialize(heads, attributes, data):
+    heads = np.frombuffer(b''.join(bytes(head) for head in heads), dtype=ismrmrd.hdf5.image_header_dtype).copy()
+    attributes = attributes.encode('utf-8')
+    heads['data_type']            = ismrmrd.image.get_data_type_from_dtype(data.dtype)
+    heads['attribute_string_len'] = len(attributes)
+
+    headSize = heads.dtype.itemsize
+    headView = memoryview(heads.view(np.uint8))
+    prefix   = constants.MrdMessageAttribLength.pack(len(attributes)) + attributes
+    data     = np.ascontiguousarray(data)
+
+    pieces = []
+    for index in range(len(heads)):
+        pieces += (IMAGE_ID, headView[index*headSize:(index+1)*headSize], prefix, data[index])
+    return SerializedImages(len(heads), b''.join(pieces))
+
+
+# Collects images into batches.  add() returns the batches that are complete
+# after adding an image, and flush() the pending one, if any.
+class ImageBatcher:
+    def __init__(self, size=None, latency=None):
+        self.size    = size if (size is not None) else batchSize
+        self.latency = latency if (latency is not None) else batchLatency
+        self.images  = []
+        self.key     = None
+        self.started = None
+
+    def __len__(self):
+        return len(self.images)
+
+    def add(self, image):
+        key = (image.data.shape, image.data_type, image.image_series_index)
+        ready = []
+        if (self.images and (key != self.key)):
+            ready.append(self.flush())
+        if (not self.images):
+            self.key     = key
+            self.started = time.perf_counter()
+        self.images.append(image)
+        if (len(self.images) >= self.size):
+            ready.append(self.flush())
+        return ready
+
+    def flush(self):
+        images, self.images = self.images, []
+        return images if images else None
+
+    # Seconds until the pending batch is due, or None if there is none
+    def remaining(self):
+        if (not self.images):
+            return None
+        return max(self.started + self.latency - time.perf_counter(), 0)
+
+# Replace the images of items (e.g. kspace.slices()) by batches of them
+def batches(items, batcher):
+    for item in items:
+        if (batcher.images and (batcher.remaining() == 0)):
+            yield batcher.flush()
+
+        if isinstance(item, ismrmrd.Image):
+            yield from batcher.add(item)
+        else:
+            if batcher.images:
+                yield batcher.flush()
+            yield item
+
+    if batcher.images:
+        yield batcher.flush()
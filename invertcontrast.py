@@ -5,116 +5,90 @@ import itertools
 import logging
 import numpy as np
 import numpy.fft as fft
-
-# Folder for debug output files
-debugFolder = "/tmp/share/debug"
+import debugdump
+import imagebatch
+import kernels
+import metrics
+import recons
+from kspace import KSpaceBuffer, slices
 
 def process(connection, config, metadata):
     logging.info("Config: \n%s", config)
     logging.info("Metadata: \n%s", metadata)
 
-    for group in process_data(connection):
-        if isinstance(group[0], ismrmrd.Image):
-            logging.info("Processing an image")
-            image = process_image(group[0], config, metadata)
-        else:
-            logging.info("Processing a group of k-space data")
-            image = process_raw(group, config, metadata)
-
-        logging.debug("Sending image to client:\n%s", image)
-        connection.send_image(image)
-
-
-# Continuously parse incoming data parsed from MRD messages
-def process_data(iterable):
-    group = []
+    batcher = imagebatch.ImageBatcher() if imagebatch.enabled() else None
+    dumps   = debugdump.Session(config)
     try:
-        for item in iterable:
-            if item is None:
-                break
-
-            elif isinstance(item, ismrmrd.Acquisition):
-                if (not item.is_flag_set(ismrmrd.ACQ_IS_PHASECORR_DATA)):
-                    group.append(item)
-
-                if (item.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)):
-                    yield group
-                    group = []
-
+        for item in process_data(connection, KSpaceBuffer(metadata), batcher):
+            if isinstance(item, list):
+                logging.info("Processing a batch of %d images", len(item))
+                image = process_images(item, config, metadata, dumps.slice())
             elif isinstance(item, ismrmrd.Image):
-                group.append(item)
-                yield group
-                group = []
-
+                logging.info("Processing an image")
+                image = process_image(item, config, metadata, dumps.slice())
             else:
-                logging.error("Unsupported data type %s", type(item).__name__)
+                logging.info("Processing a group of k-space data")
+                data, acquisition = item
+                image = process_raw(data, acquisition, config, metadata, dumps.slice())
 
+            imagebatch.send(connection, image)
     finally:
-        iterable.send_close()
-
+        dumps.close()
 
-def process_raw(group, config, metadata):
-    # Create folder, if necessary
-    if not os.path.exists(debugFolder):
-        os.makedirs(debugFolder)
-        logging.debug("Created folder " + debugFolder + " for debug output files")
 
-    # Sort by line number (incoming data may be interleaved)
-    lin = [acquisition.idx.kspace_encode_step_1 for acquisition in group]
-    logging.debug("Incoming lin ordering: " + str(lin))
-
-    group.sort(key = lambda acq: acq.idx.kspace_encode_step_1)
-    sortedLin = [acquisition.idx.kspace_encode_step_1 for acquisition in group]
-    logging.debug("Sorted lin ordering: " + str(sortedLin))
+# Continuously parse incoming data parsed from MRD messages.  Readouts are
+# placed into kspace by line as they arrive, and the assembled (data,
+# acquisition) is yielded for each completed slice.  Images are yielded as is,
+# or in lists of images batched by batcher.
+def process_data(iterable, kspace, batcher=None):
+    try:
+        items = slices(iterable, kspace)
+        if (batcher is not None):
+            items = imagebatch.batches(items, batcher)
+        yield from items
+    finally:
+        iterable.send_close()
 
-    # Format data into single [cha RO PE] array
-    data = [acquisition.data for acquisition in group]
-    data = np.stack(data, axis=-1)
 
-    logging.debug("Raw data is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "raw.npy", data)
+# data is the [cha RO PE] k-space of one slice and acquisition is a readout
+# from it, used for the image header.  Intermediate arrays are saved to dump.
+def process_raw(data, acquisition, config, metadata, dump=debugdump.disabled):
+    logging.debug("Raw data is size %s", data.shape)
+    dump.save("raw", data, debugdump.DUMP_ALL)
 
-    # Fourier Transform
-    data = fft.fftshift(data, axes=(1, 2))
-    data = fft.ifft2(data)
-    data = fft.ifftshift(data, axes=(1, 2))
+    # Buffers and MetaAttributes are kept across sessions of the protocol
+    context = recons.context(config, metadata)
 
-    # Sum of squares coil combination
-    data = np.abs(data)
-    data = np.square(data)
-    data = np.sum(data, axis=0)
-    data = np.sqrt(data)
+    # Fourier Transform into a buffer of the context.  With kernels.cropReadout,
+    # the readout oversampling is already removed here.
+    with context.buffer(kernels.image_shape(data.shape), kernels.complexType) as buffer:
+        with metrics.stage(metrics.STAGE_FFT):
+            data = kernels.ifft_image(data, out=buffer)
 
-    logging.debug("Image data is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "img.npy", data)
+        # Sum of squares coil combination
+        with metrics.stage(metrics.STAGE_COMBINE):
+            data = kernels.rss(data)
 
-    # Normalize and convert to int16
-    data *= 32767/data.max()
-    data = np.around(data)
-    data = data.astype(np.int16)
+    logging.debug("Image data is size %s", data.shape)
+    dump.save("img", data, debugdump.DUMP_ALL)
 
-    # Invert image contrast
-    data = 32767-data
-    data = np.abs(data)
-    data = data.astype(np.int16)
-    np.save(debugFolder + "/" + "imgInverted.npy", data)
+    # Normalize, convert to int16 and invert image contrast
+    with metrics.stage(metrics.STAGE_QUANTIZE):
+        data = kernels.quantize(data, invert=True)
+    dump.save("imgInverted", data, debugdump.DUMP_IMAGES)
 
     # Remove phase oversampling
-    nRO = np.size(data,0)
-    data = data[int(nRO/4):int(nRO*3/4),:]
-    logging.debug("Image without oversampling is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "imgCrop.npy", data)
+    if (not kernels.cropReadout):
+        data = data[kernels.readout_fov(np.size(data,0)),:]
+    logging.debug("Image without oversampling is size %s", data.shape)
+    dump.save("imgCrop", data, debugdump.DUMP_IMAGES)
 
     # Format as ISMRMRD image data
-    image = ismrmrd.Image.from_array(data, acquisition=group[0])
+    image = ismrmrd.Image.from_array(data, acquisition=acquisition)
     image.image_index = 1
 
-    # Set ISMRMRD Meta Attributes
-    meta = ismrmrd.Meta({'DataRole':               'Image',
-                         'ImageProcessingHistory': ['FIRE', 'PYTHON'],
-                         'WindowCenter':           '16384',
-                         'WindowWidth':            '32768'})
-    xml = meta.serialize()
+    # Set ISMRMRD Meta Attributes, serialized once per context
+    xml = context.attributes
     logging.debug("Image MetaAttributes: %s", xml)
     logging.debug("Image data has %d elements", image.data.size)
 
@@ -122,51 +96,75 @@ def process_raw(group, config, metadata):
     return image
 
 
-def process_image(image, config, metadata):
-    # Create folder, if necessary
-    if not os.path.exists(debugFolder):
-        os.makedirs(debugFolder)
-        logging.debug("Created folder " + debugFolder + " for debug output files")
-
+def process_image(image, config, metadata, dump=debugdump.disabled):
     logging.debug("Incoming image data of type %s", ismrmrd.get_dtype_from_data_type(image.data_type))
 
     # Extract image data itself
     data = image.data
-    logging.debug("Original image data is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "imgOrig.npy", data)
+    logging.debug("Original image data is size %s", data.shape)
+    dump.save("imgOrig", data, debugdump.DUMP_ALL)
 
-    # Normalize and convert to int16
-    data = data.astype(np.float64)
-    data *= 32767/data.max()
-    data = np.around(data)
-    data = data.astype(np.int16)
+    context = recons.context(config, metadata)
 
-    # Invert image contrast
-    data = 32767-data
-    data = np.abs(data)
-    data = data.astype(np.int16)
-    np.save(debugFolder + "/" + "imgInverted.npy", data)
+    # Normalize, convert to int16 and invert image contrast
+    with metrics.stage(metrics.STAGE_QUANTIZE):
+        data = kernels.quantize(data.astype(kernels.realType), invert=True)
+    dump.save("imgInverted", data, debugdump.DUMP_IMAGES)
 
     # Create new MRD instance for the inverted image
     imageInverted = ismrmrd.Image.from_array(data.transpose())
     data_type = imageInverted.data_type
 
-    np.save(debugFolder + "/" + "imgInvertedMrd.npy", imageInverted.data)
+    dump.save("imgInvertedMrd", imageInverted.data, debugdump.DUMP_IMAGES)
 
     # Copy the fixed header information
     oldHeader = image.getHead()
     oldHeader.data_type = data_type
     imageInverted.setHead(oldHeader)
 
-    # Set ISMRMRD Meta Attributes
-    meta = ismrmrd.Meta({'DataRole':               'Image',
-                         'ImageProcessingHistory': ['FIRE', 'PYTHON'],
-                         'WindowCenter':           '16384',
-                         'WindowWidth':            '32768'})
-    xml = meta.serialize()
+    # Set ISMRMRD Meta Attributes, serialized once per context
+    xml = context.attributes
     logging.debug("Image MetaAttributes: %s", xml)
     logging.debug("Image data has %d elements", image.data.size)
 
     imageInverted.attribute_string = xml
 
-    return imageInverted
\ No newline at end of file
+    return imageInverted
+
+
+# images is a list of images of the same shape, data type and series, e.g. from
+# an imagebatch.ImageBatcher.  They are processed as in process_image() as one
+# stack and returned as imagebatch.SerializedImages.
+def process_images(images, config, metadata, dump=debugdump.disabled):
+    logging.debug("Incoming batch of %d images of type %s", len(images), ismrmrd.get_dtype_from_data_type(images[0].data_type))
+
+    context = recons.context(config, metadata)
+
+    # Stack the image data, converting it to the recon precision on the way
+    data = np.empty((len(images),) + images[0].data.shape, dtype=kernels.realType)
+    for index, image in enumerate(images):
+        data[index] = image.data
+    logging.debug("Original image data is size %s", data.shape)
+    dump.save("imgOrig", data, debugdump.DUMP_ALL)
+
+    # Normalize each image, convert to int16 and invert image contrast
+    with metrics.stage(metrics.STAGE_QUANTIZE):
+        data = kernels.quantize_images(data, invert=True)
+    dump.save("imgInverted", data, debugdump.DUMP_IMAGES)
+
+    # As in process_image(), the data of each image is sent transposed with the
+    # header of the incoming image
+    data = data.transpose((0,) + tuple(range(data.ndim - 1, 0, -1)))
+    return imagebatch.serialize([image.getHead() for image in images], context.attributes, data)
+
+
+@recons.register('invertcontrast')
+class InvertContrast(recons.Recon):
+    processRaw    = staticmethod(process_raw)
+    processImage  = staticmethod(process_image)
+    processImages = staticmethod(process_images)
+    process       = staticmethod(process)
+    meta          = {'DataRole':               'Image',
+                     'ImageProcessingHistory': ['FIRE', 'PYTHON'],
+                     'WindowCenter':           '16384',
+                     'WindowWidth':            '32768'}
@@ -0,0 +1,110 @@
+import logging
+import numpy as np
+
+import fftengine
+
+# Numeric precision of the recon:
+#   single  complex64 k-space and float32 images end to end
+#   double  data are converted to complex128 before the FFT, as numpy.fft did
+#           before numpy 2.0, and images are float64
+PRECISION_SINGLE = 'single'
+PRECISION_DOUBLE = 'double'
+
+complexType = np.complex128
+realType    = np.float64
+
+# Remove the 2x readout oversampling between the readout and phase encoding
+# FFTs (in hybrid x-ky space) instead of from the final image, so that the
+# phase encoding FFT and coil combination only process the central half of
+# the readout.  Images are the same except for the scaling when the maximum of
+# the oversampled image lies outside the central half.
+cropReadout = False
+
+# Set the precision and readout cropping used by the recon modules.  Like
+# fftengine.configure(), this should be called before sessions are started.
+def configure(precision=PRECISION_DOUBLE, crop=False):
+    global complexType, realType, cropReadout
+    if (precision == PRECISION_SINGLE):
+        complexType, realType = np.complex64, np.float32
+    elif (precision == PRECISION_DOUBLE):
+        complexType, realType = np.complex128, np.float64
+    else:
+        raise ValueError("Unknown precision '%s'" % precision)
+    cropReadout = crop
+    logging.info("Using %s precision recon%s", precision, " with readout oversampling removed before the phase encoding FFT" if crop else "")
+
+# Central half of a readout of length n, the field of view without the 2x
+# readout oversampling
+def readout_fov(n):
+    return slice(int(n/4), int(n*3/4))
+
+# Centered 2D inverse FFT of [cha RO PE] k-space at the configured precision.
+# With crop, the result only has the central half of the readout: each channel
+# is transformed along the readout and cropped into the output, which is then
+# transformed along the phase encoding direction in place.  Only the cropped
+# output and one channel are allocated.  The output may be given as out, a
+# complexType array of shape image_shape(data.shape, crop).
+def ifft_image(data, crop=None, engine=None, out=None):
+    if (crop is None):
+        crop = cropReadout
+    if (not crop):
+        return fftengine.centered_ifft2(data, axes=(1, 2), engine=engine, dtype=complexType, out=out)
+
+    fov   = readout_fov(data.shape[1])
+    image = out if (out is not None) else np.empty(image_shape(data.shape, crop), dtype=complexType)
+    for channel in range(data.shape[0]):
+        image[channel] = fftengine.centered_ifftn(data[channel], axes=(0,), engine=engine, dtype=complexType)[fov]
+    return fftengine.centered_ifftn(image, axes=(2,), engine=engine, overwrite=True)
+
+# Shape of the ifft_image() of [cha RO PE] k-space of the given shape
+def image_shape(shape, crop=None):
+    if (crop is None):
+        crop = cropReadout
+    if (not crop):
+        return tuple(shape)
+    fov = readout_fov(shape[1])
+    return (shape[0], fov.stop - fov.start, shape[2])
+
+# Root sum of squares coil combination of complex [cha ...] data, i.e.
+#   sqrt(sum(abs(data)**2, axis=0))
+# The real and imaginary parts are squared in place, so data is overwritten.
+# Only the image-sized result is allocated, instead of a full-size temporary for
+# each of abs, square, sum and sqrt.
+def rss(data):
+    if (not data.flags.c_contiguous):
+        data = np.ascontiguousarray(data)
+
+    parts = data.view(data.real.dtype)    # [cha ... 2*n] real, imaginary pairs
+    np.square(parts, out=parts)
+
+    power = parts[0].copy()
+    for channel in range(1, parts.shape[0]):
+        power += parts[channel]
+
+    power = power.reshape(power.shape[:-1] + (-1, 2))
+    image = np.add(power[..., 0], power[..., 1])
+    return np.sqrt(image, out=image)
+
+# Scale a float image so that its maximum is 32767, round to the nearest
+# integer and convert to int16.  With invert, the int16 values v are replaced
+# by abs(32767-v).  image is overwritten.
+def quantize(image, invert=False):
+    image *= 32767/image.max()
+    np.rint(image, out=image)
+    data = image.astype(np.int16)
+    if invert:
+        np.subtract(32767, data, out=data)
+        np.abs(data, out=data)
+    return data
+
+# quantize() of each image of a [image ...] stack, scaled by its own maximum,
+# in one pass over the stack
+def quantize_images(images, invert=False):
+    peaks = images.reshape(len(images), -1).max(axis=1)
+    images *= (32767/peaks).reshape((-1,) + (1,)*(images.ndim - 1))
+    np.rint(images, out=images)
+    data = images.astype(np.int16)
+    if invert:
+        np.subtract(32767, data, out=data)
+        np.abs(data, out=data)
+    return data
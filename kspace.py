@@ -0,0 +1,136 @@
+import ismrmrd
+import logging
+import numpy as np
+import mrdheader
+
+from connection import AcquisitionBatch
+
+# Zero-fill the k-space of a slice to the encoding limits of the metadata, with
+# lines that are not acquired (e.g. partial Fourier or undersampled data) left
+# zero.  Otherwise only the acquired lines are returned, in line order, as the
+# recons did by sorting and stacking the acquisitions.  Both are the same for
+# fully sampled data.
+ZERO_FILL = False
+
+zeroFill = ZERO_FILL
+
+# Like fftengine.configure(), this should be called before sessions are started
+def configure(fill=ZERO_FILL):
+    global zeroFill
+    zeroFill = fill
+
+# Assembles the k-space of one slice as readouts arrive.  Each readout (or
+# AcquisitionBatch) is copied to its kspace_encode_step_1 position in a single
+# preallocated array, so no list of acquisitions is kept and no sorting or
+# stacking is needed once the slice is complete.  Lines that are not acquired
+# are zero-filled or left out, see zeroFill.
+#
+# The buffer holds [cha RO PE], the layout used by the recon, so that the FFT
+# runs on a contiguous array.  It is sized from the encoding limits of the
+# metadata (an MrdHeader or XML text) and allocated on the first readout of
+# each slice, when the number of channels and samples is known.  Without
+# encoding limits (or for lines beyond them) it grows as needed.
+class KSpaceBuffer:
+    def __init__(self, metadata, fill=None):
+        self.lines = mrdheader.parse(metadata).lines if (metadata is not None) else None
+        self.fill  = fill if (fill is not None) else zeroFill
+        self.reset()
+
+    def reset(self):
+        self.data        = None
+        self.acquired    = None  # Whether each line was received
+        self.received    = 0     # Number of distinct lines received
+        self.filled      = 0     # One more than the highest line received
+        self.first       = None  # Acquisition (or batch row) with the lowest line
+        self.firstLine   = None
+
+    def __len__(self):
+        return self.filled
+
+    def allocate(self, channels, samples, lines):
+        if (self.data is None):
+            self.data     = np.zeros((channels, samples, max(lines, self.lines or 0)), dtype=np.complex64)
+            self.acquired = np.zeros(self.data.shape[2], dtype=bool)
+        elif (lines > self.data.shape[2]):
+            grown = np.zeros((channels, samples, max(lines, 2*self.data.shape[2])), dtype=np.complex64)
+            grown[:, :, :self.data.shape[2]] = self.data
+            self.data     = grown
+            self.acquired = np.concatenate((self.acquired, np.zeros(grown.shape[2] - len(self.acquired), dtype=bool)))
+
+    def add(self, item):
+        if isinstance(item, AcquisitionBatch):
+            self.add_batch(item)
+            return
+
+        line = item.idx.kspace_encode_step_1
+        self.allocate(item.active_channels, item.number_of_samples, line+1)
+        self.data[:, :, line] = item.data
+        self.filled = max(self.filled, line+1)
+        if (not self.acquired[line]):
+            self.acquired[line] = True
+            self.received += 1
+
+        if ((self.firstLine is None) or (line < self.firstLine)):
+            self.first, self.firstLine = item, line
+
+    def add_batch(self, batch):
+        if (len(batch) == 0):
+            return
+
+        lines = batch.idx['kspace_encode_step_1']
+        last = int(lines.max())
+        self.allocate(batch.data.shape[1], batch.data.shape[2], last+1)
+        self.data[:, :, lines] = batch.data.transpose(1, 2, 0)
+        self.filled = max(self.filled, last+1)
+        self.acquired[lines] = True
+        self.received = int(np.count_nonzero(self.acquired))
+
+        lowest = int(np.argmin(lines))
+        if ((self.firstLine is None) or (lines[lowest] < self.firstLine)):
+            self.first, self.firstLine = batch[lowest:lowest+1], int(lines[lowest])
+
+    # Return the assembled [cha RO PE] k-space and the acquisition with the
+    # lowest line (for the image header), and start a new slice.  The returned
+    # array is handed over to the caller rather than copied, unless lines are
+    # missing without zero-filling.
+    def take(self):
+        if (self.data is None):
+            raise ValueError("No readouts were received for this slice")
+
+        if self.fill:
+            data = self.data[:, :, :max(self.filled, self.lines or 0)]
+        elif (self.received == self.filled):
+            data = self.data[:, :, :self.filled]
+        else:
+            data = self.data[:, :, self.acquired]
+        first = self.first.acquisition(0) if isinstance(self.first, AcquisitionBatch) else self.first
+        self.reset()
+        return data, first
+
+
+# Assemble the readouts of a stream of MRD messages into kspace.  Yields the
+# (data, acquisition) of each completed slice; images are passed through and
+# phase correction readouts are skipped.
+def slices(iterable, kspace):
+    for item in iterable:
+        if item is None:
+            break
+
+        elif isinstance(item, ismrmrd.Acquisition):
+            if (not item.is_flag_set(ismrmrd.ACQ_IS_PHASECORR_DATA)):
+                kspace.add(item)
+
+            if ((item.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)) and (len(kspace) > 0)):
+                yield kspace.take()
+
+        elif isinstance(item, AcquisitionBatch):
+            for part, ended in item.split_after(item.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)):
+                kspace.add(part[~part.is_flag_set(ismrmrd.ACQ_IS_PHASECORR_DATA)])
+                if ((ended) and (len(kspace) > 0)):
+                    yield kspace.take()
+
+        elif isinstance(item, ismrmrd.Image):
+            yield item
+
+        else:
+            logging.error("Unsupported data type %s", type(item).__name__)
@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+
+# Load test for the MRD server: N concurrent sessions, as if N scanners were
+# streaming at once, for each of a list of configs, e.g.
+#   python3 loadtest.py -n 20 -t 5
+#   python3 loadtest.py -n 8 -f raw.h5 -m simplefft invertcontrast
+#   python3 loadtest.py -n 4 -a scanner-host -p 9002 -P 1234
+# A local server is started for every config unless --port is given.  Sessions
+# send synthetic readouts, or the acquisitions or images of an MRD HDF5 file or
+# wire capture, with Connection.send_*, each from its own process.
+
+from benchmark import start_server, stop_server, connect, percentiles, report
+from synthetic import make_acquisitions, make_header
+from connection import Connection, FLUSH_BATCH
+import wirecapture
+
+import argparse
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import ismrmrd
+import numpy as np
+
+defaults = {
+    'address':     '127.0.0.1',
+    'port':        0,
+    'serverPid':   0,
+    'sessions':    8,
+    'rounds':      1,
+    'configs':     ['simplefft', 'invertcontrast', 'null', 'savedataonly'],
+    'channels':    16,
+    'samples':     256,
+    'lines':       128,
+    'slices':      4,
+    'tr':          0,
+    'workers':     0,
+    'batchSize':   0,
+    'pipelined':   False,
+    'interval':    0.1,
+}
+
+# Seconds of CPU time per clock tick in /proc/<pid>/stat
+CLOCK_TICK = 1/os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 0.01
+
+
+# ----- Workload ---------------------------------------------------------------
+# The metadata and messages sent by every session.  items are
+# ismrmrd.Acquisitions or ismrmrd.Images.  An image is expected back for every
+# readout flagged ACQ_LAST_IN_SLICE and for every image sent.
+class Workload:
+    def __init__(self, name, xml, items):
+        self.name  = name
+        self.xml   = xml
+        self.items = items
+        self.bytes = sum(item.data.nbytes for item in items)
+
+def synthetic_workload(channels, samples, lines, slices):
+    return Workload("synthetic %dx%dx%d, %d slices" % (channels, samples, lines, slices),
+                    make_header(channels, samples, lines, slices),
+                    make_acquisitions(channels, samples, lines, slices))
+
+def file_workload(path, group=None):
+    if wirecapture.is_capture(path):
+        return capture_workload(path)
+
+    dset = ismrmrd.Dataset(path, group or 'dataset', False)
+    groups = dset.list()
+    xml = dset.read_xml_header() if ('xml' in groups) else "Dummy XML header"
+    if ('data' in groups):
+        items = [dset.read_acquisition(idx) for idx in range(dset.number_of_acquisitions())]
+    else:
+        items = []
+        for name in groups:
+            if name in ('config', 'xml', 'waveforms'):
+                continue
+            for idx in range(dset.number_of_images(name)):
+                image = dset.read_image(name, idx)
+                if isinstance(image.attribute_string, bytes):
+                    image.attribute_string = image.attribute_string.decode('utf-8')
+                items.append(image)
+    dset.close()
+    return Workload(path, xml, items)
+
+# The config of a capture is replaced by the config under test
+def capture_workload(path):
+    capture = wirecapture.CaptureSocket(path)
+    connection = Connection(capture, False)
+    try:
+        next(connection)
+        xml = next(connection)
+        items = []
+        for msg in connection:
+            if msg is None:
+                break
+            if isinstance(msg, (ismrmrd.Acquisition, ismrmrd.Image)):
+                items.append(msg)
+    finally:
+        capture.close()
+    return Workload(path, xml, items)
+
+def expects_image(item):
+    return isinstance(item, ismrmrd.Image) or item.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)
+
+
+# ----- Sessions ---------------------------------------------------------------
+# Set in the client processes by init_client().  With fork, the workload is
+# shared with the parent instead of being pickled.
+workload = None
+
+def init_client(sharedWorkload):
+    global workload
+    workload = sharedWorkload
+
+# One session.  Messages are coalesced into large writes and flushed at the end
+# of every slice, so that the image latency (end of a slice sent to its image
+# received) does not include waiting for more data.  With tr, readout i is sent
+# tr seconds after readout i-1 is due and flushed immediately, like a scanner.
+def run_session(host, port, config, tr):
+    sock = connect(host, port)
+    received = []
+
+    def receive():
+        for msg in Connection(sock, False):
+            if msg is None:
+                break
+            if isinstance(msg, ismrmrd.Image):
+                received.append(time.perf_counter())
+
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+
+    start = time.perf_counter()
+    connection = Connection(sock, False, flushPolicy=FLUSH_BATCH)
+    connection.send_config_file(config)
+    connection.send_metadata(workload.xml)
+
+    sent = []
+    for index, item in enumerate(workload.items):
+        if (tr > 0):
+            delay = start + index*tr - time.perf_counter()
+            if (delay > 0):
+                time.sleep(delay)
+
+        if isinstance(item, ismrmrd.Acquisition):
+            connection.send_acquisition(item)
+        else:
+            connection.send_image(item)
+
+        if expects_image(item):
+            connection.flush()
+            sent.append(time.perf_counter())
+        elif (tr > 0):
+            connection.flush()
+
+    connection.send_close()
+    receiver.join()
+    elapsed = time.perf_counter() - start
+    sock.close()
+
+    return {'elapsed':   elapsed,
+            'images':    len(received),
+            'latencies': [done - due for due, done in zip(sent, received)]}
+
+def client_session(task):
+    return run_session(*task)
+
+
+# ----- Server resources -------------------------------------------------------
+# CPU time and memory of a process and all its descendants, i.e. the server and
+# its session or worker processes, from /proc.  Memory is the proportional set
+# size (PSS), so that pages shared by forked processes are only counted once,
+# or the RSS where smaps_rollup is not available.
+def process_table():
+    table = {}
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/%s/stat' % name) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            table[int(name)] = (int(fields[1]), sum(int(field) for field in fields[11:15]))
+    return table
+
+def process_tree(pid, table):
+    tree = [pid]
+    for parent in tree:
+        tree.extend(child for child, (ppid, ticks) in table.items() if (ppid == parent))
+    return [pid for pid in tree if pid in table]
+
+# User and system time of the processes, including that of their children that
+# have exited and been waited for
+def tree_cpu(pid):
+    table = process_table()
+    return sum(table[pid][1] for pid in process_tree(pid, table))*CLOCK_TICK
+
+def process_memory(pid):
+    for path, field in (('/proc/%d/smaps_rollup' % pid, 'Pss:'), ('/proc/%d/status' % pid, 'VmRSS:')):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1])*1024
+        except OSError:
+            pass
+    return 0
+
+def tree_memory(pid):
+    return sum(process_memory(member) for member in process_tree(pid, process_table()))
+
+# Samples the memory of a process tree in the background and keeps the peak
+class ResourceMonitor:
+    def __init__(self, pid, interval):
+        self.pid      = pid
+        self.interval = interval
+        self.peak     = 0
+        self.stopped  = threading.Event()
+        self.cpu      = tree_cpu(pid)
+        self.thread   = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, tree_memory(self.pid))
+            self.stopped.wait(self.interval)
+
+    # Returns the CPU seconds used since the monitor was started
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return tree_cpu(self.pid) - self.cpu
+
+
+# ----- Load test --------------------------------------------------------------
+def client_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run_config(args, config, host, port, serverPid):
+    tasks = [(host, port, config, args.tr/1000)]*(args.sessions*args.rounds)
+    monitor = ResourceMonitor(serverPid, args.interval) if serverPid else None
+    clientStart = client_cpu()
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.sessions, initializer=init_client, initargs=(workload,)) as pool:
+        sessions = pool.map(client_session, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    elapsed = time.perf_counter() - start
+
+    clientTime = client_cpu() - clientStart
+    serverTime = monitor.stop() if monitor else None
+
+    latencies = [latency*1000 for session in sessions for latency in session['latencies']]
+    readouts  = sum(1 for item in workload.items if isinstance(item, ismrmrd.Acquisition))
+
+    results = {'sessions':        len(sessions),
+               'concurrent':      args.sessions,
+               'images':          sum(session['images'] for session in sessions),
+               'wall_s':          elapsed,
+               'sessions_per_s':  len(sessions)/elapsed,
+               'readouts_per_s':  readouts*len(sessions)/elapsed,
+               'MB_per_s':        workload.bytes*len(sessions)/elapsed/1e6}
+    for key, value in percentiles([session['elapsed'] for session in sessions], (50, 99)).items():
+        results['session_s_' + key] = value
+    if latencies:
+        for key, value in percentiles(latencies).items():
+            results['latency_ms_' + key] = value
+        results['latency_ms_max'] = max(latencies)
+    results['client_cpu_s'] = clientTime
+    if monitor:
+        results['server_cpu_s']   = serverTime
+        results['server_cpu_pct'] = 100*serverTime/elapsed
+        results['server_peak_MB'] = monitor.peak/1e6
+    return results
+
+def main(args):
+    global workload
+    if args.filename:
+        workload = file_workload(args.filename, args.group)
+    else:
+        workload = synthetic_workload(args.channels, args.samples, args.lines, args.slices)
+    print("Workload: %s, %d messages, %.1f MB per session%s" % (workload.name, len(workload.items), workload.bytes/1e6,
+                                                                 ", TR %.1f ms" % args.tr if (args.tr > 0) else ""))
+
+    serverKwargs = {'workers': args.workers, 'batchSize': args.batchSize, 'pipelined': args.pipelined}
+    for config in args.configs:
+        if args.port:
+            results = run_config(args, config, args.address, args.port, args.serverPid)
+        else:
+            # Data saved by savedataonly is discarded
+            savedataFolder = tempfile.mkdtemp(prefix='loadtest-')
+            process, port = start_server(args.address, savedataFolder, **serverKwargs)
+            try:
+                results = run_config(args, config, args.address, port, process.pid)
+            finally:
+                stop_server(process)
+                shutil.rmtree(savedataFolder, ignore_errors=True)
+        report("%s (%d sessions)" % (config, args.sessions), results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test for the MRD server with concurrent sessions',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-f', '--filename',    type=str,            help='MRD HDF5 file or wire capture to send (default: synthetic readouts)')
+    parser.add_argument('-g', '--group',       type=str,            help='Input data group of the HDF5 file')
+    parser.add_argument('-m', '--configs',     type=str, nargs='+', help='Configs to test, one after another')
+    parser.add_argument('-n', '--sessions',    type=int,            help='Concurrent sessions')
+    parser.add_argument('-N', '--rounds',      type=int,            help='Sessions run one after another by each client')
+    parser.add_argument('-c', '--channels',    type=int,            help='Receive channels of synthetic readouts')
+    parser.add_argument('-s', '--samples',     type=int,            help='Samples per synthetic readout')
+    parser.add_argument('-l', '--lines',       type=int,            help='Phase encoding lines per synthetic slice')
+    parser.add_argument('-S', '--slices',      type=int,            help='Synthetic slices per session')
+    parser.add_argument('-t', '--tr',          type=float,          help='Send one message every TR milliseconds (0 for as fast as possible)')
+    parser.add_argument('-a', '--address',     type=str,            help='Address of the server')
+    parser.add_argument('-p', '--port',        type=int,            help='Port of a running server (0 to start a local server for every config)')
+    parser.add_argument('-P', '--serverPid',   type=int,            help='Process ID of the running server, to measure its CPU and memory use')
+    parser.add_argument('-w', '--workers',     type=int,            help='Worker processes of local servers (0 for a process per session)')
+    parser.add_argument('-b', '--batchSize',   type=int,            help='Acquisition batch size of local servers')
+    parser.add_argument('-e', '--pipelined',   action='store_true', help='Pipelined recons on local servers')
+    parser.add_argument('-i', '--interval',    type=float,          help='Seconds between server memory samples')
+    parser.add_argument('-v', '--verbose',     action='store_true', help='Verbose output.')
+    parser.set_defaults(**defaults)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING)
+    if args.verbose:
+        logging.root.setLevel(logging.DEBUG)
+
+    main(args)
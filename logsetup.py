@@ -0,0 +1,136 @@
+import constants
+
+import atexit
+import collections
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+
+# Logging of the server and its worker processes.  Every process puts its
+# records on one queue without waiting, and a single listener process writes
+# them to the console and the log file, so that sessions never block on the
+# terminal or the disk and lines of concurrent workers are not interleaved.
+#
+# Readouts and waveforms are not logged one line each.  Each Connection counts
+# them by type in a MessageLog, which logs the first and then every logEvery-th
+# message at DEBUG and the totals when the session closes.
+
+LOG_FORMAT = '%(asctime)s - %(message)s'
+
+# Records waiting for the listener.  When the listener falls behind, further
+# records are dropped instead of blocking the session, and the number dropped
+# is noted on the next record that fits.
+LOG_QUEUE_SIZE = 10000
+
+# Log every Nth readout or waveform of a session at DEBUG
+LOG_EVERY = 1000
+
+# Seconds to wait at exit for the listener to write the remaining records
+LOG_STOP_TIMEOUT = 5
+
+# Names of message identifiers as used in the log, e.g. 1008:
+# 'MRD_MESSAGE_ISMRMRD_ACQUISITION'
+MESSAGE_NAMES = dict((value, name) for name, value in vars(constants).items() if name.startswith('MRD_MESSAGE_') and isinstance(value, int))
+
+logEvery = LOG_EVERY
+handler  = None
+listener = None
+owner    = None
+
+def configure(verbose=False, logfile=None, every=LOG_EVERY):
+    global logEvery, handler, listener, owner
+    logEvery = max(every, 1)
+
+    records  = multiprocessing.Queue(LOG_QUEUE_SIZE)
+    listener = multiprocessing.Process(target=listen, args=(records, logfile), name="log", daemon=True)
+    listener.start()
+    owner    = os.getpid()
+
+    # Worker processes forked later inherit the handler
+    handler = QueueHandler(records)
+    for existing in list(logging.root.handlers):
+        logging.root.removeHandler(existing)
+    logging.root.addHandler(handler)
+    logging.root.setLevel(logging.DEBUG if verbose else logging.INFO)
+    atexit.register(stop)
+
+# Write the records still queued and stop the listener.  Records logged after
+# this are handled by logging's last resort handler (warnings and errors only).
+def stop():
+    global listener
+    if ((listener is None) or (os.getpid() != owner)):
+        return
+    logging.root.removeHandler(handler)
+    handler.queue.put(None)
+    listener.join(LOG_STOP_TIMEOUT)
+    if (listener.is_alive()):
+        listener.terminate()
+        handler.queue.cancel_join_thread()
+    listener = None
+
+# Main loop of the listener process.  Ctrl-C is ignored, so that the records of
+# a server being interrupted are still written; the server stops the listener
+# when it exits.
+def listen(records, logfile):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if logfile:
+        handlers = [logging.FileHandler(logfile), logging.StreamHandler(sys.stdout)]
+    else:
+        handlers = [logging.StreamHandler()]
+    for output in handlers:
+        output.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    while True:
+        record = records.get()
+        if (record is None):
+            break
+        for output in handlers:
+            output.handle(record)
+
+    for output in handlers:
+        output.close()
+
+# Puts records on the listener's queue without blocking.  prepare() of the base
+# class merges the arguments into the message in the logging process, so that
+# records are always picklable.
+class QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if (self.dropped > 0):
+            record.msg = "(%d log records dropped) %s" % (self.dropped, record.msg)
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+def message_name(identifier):
+    return "%s (%d)" % (MESSAGE_NAMES.get(identifier, 'MRD_MESSAGE_UNKNOWN'), identifier)
+
+# Counts of the messages of one direction of a session by type, e.g.
+# MessageLog("<-- Received").  add() logs the first message of each type and
+# then every logEvery-th at DEBUG.
+class MessageLog:
+    def __init__(self, direction):
+        self.direction = direction
+        self.counts    = collections.Counter()
+
+    def add(self, identifier, count=1):
+        previous = self.counts[identifier]
+        total    = previous + count
+        self.counts[identifier] = total
+        if (((previous == 0) or (total//logEvery > previous//logEvery)) and logging.root.isEnabledFor(logging.DEBUG)):
+            logging.debug("%s %s, %d so far", self.direction, message_name(identifier), total)
+
+    # Log the totals at INFO, e.g. "<-- Received 4096 x MRD_MESSAGE_ISMRMRD_ACQUISITION (1008)"
+    def log_totals(self):
+        if (self.counts):
+            logging.info("%s %s", self.direction, ', '.join("%d x %s" % (count, message_name(identifier)) for identifier, count in sorted(self.counts.items())))
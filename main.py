@@ -1,20 +1,77 @@
 #!/usr/bin/python3
 
-from server import Server
+from server import Server, ADMISSION_QUEUE_SIZE, ADMISSION_TIMEOUT
+from asyncserver import AsyncServer
+
+import debugdump
+import fftengine
+import imagebatch
+import kernels
+import kspace
+import logsetup
+import metrics
+import mrdwriter
+import recons
+import wirecapture
 
 import argparse
-import logging
-import sys
 
 defaults = {
-    'host':           '0.0.0.0',
-    'port':           9002,
-    'savedataFolder': '/tmp/share/saved_data'
+    'host':             '0.0.0.0',
+    'port':             9002,
+    'savedataFolder':   '/tmp/share/saved_data',
+    'workers':          0,
+    'maxSessions':      0,
+    'asyncio':          False,
+    'batchSize':        0,
+    'pipelined':        False,
+    'reconThreads':     0,
+    'maxRecons':        0,
+    'maxActive':        0,
+    'maxQueued':        ADMISSION_QUEUE_SIZE,
+    'memoryBudget':     0,
+    'queueTimeout':     ADMISSION_TIMEOUT,
+    'fft':              'numpy',
+    'fftThreads':       0,
+    'precision':        'double',
+    'cropReadout':      False,
+    'zeroFill':         kspace.ZERO_FILL,
+    'reconCacheSize':   recons.RECON_CACHE_SIZE,
+    'reconCacheMemory': recons.RECON_CACHE_MEMORY//(1024*1024),
+    'imageBatch':       imagebatch.IMAGE_BATCH_SIZE,
+    'imageLatency':     imagebatch.IMAGE_BATCH_LATENCY*1000,
+    'debugLevel':       'none',
+    'debugFolder':      '/tmp/share/debug',
+    'debugConfigs':     None,
+    'debugEvery':       1,
+    'debugCompress':    False,
+    'saveQueueSize':    mrdwriter.SAVE_QUEUE_SIZE,
+    'saveChunkSize':    mrdwriter.SAVE_CHUNK_SIZE//1024,
+    'saveCacheSize':    mrdwriter.SAVE_CACHE_SIZE//(1024*1024),
+    'capture':          False,
+    'captureCompress':  False,
+    'metrics':          False,
+    'metricsPort':      0,
+    'logEvery':         logsetup.LOG_EVERY
 }
 
 def main(args):
+    fftengine.configure(args.fft, args.fftThreads)
+    kernels.configure(args.precision, args.cropReadout)
+    kspace.configure(args.zeroFill)
+    recons.configure(args.reconCacheSize, args.reconCacheMemory*1024*1024)
+    imagebatch.configure(args.imageBatch, args.imageLatency/1000)
+    wirecapture.configure(args.capture, args.savedataFolder, args.captureCompress)
+    mrdwriter.configure(queueSize=args.saveQueueSize, chunkSize=args.saveChunkSize*1024, cacheSize=args.saveCacheSize*1024*1024)
+    debugdump.configure(args.debugLevel, args.debugFolder, args.debugConfigs, args.debugEvery, args.debugCompress)
+    metrics.configure(args.metrics, args.metricsPort, args.host)
+
     # Start a multi-threaded dispatcher to handle incoming connections
-    server = Server(args.host, args.port, args.savedata, args.savedataFolder)
+    if args.asyncio:
+        server = AsyncServer(args.host, args.port, args.savedata, args.savedataFolder, args.workers)
+    else:
+        server = Server(args.host, args.port, args.savedata, args.savedataFolder, args.workers, args.maxSessions, args.batchSize, args.pipelined, args.reconThreads, args.maxRecons,
+                        args.maxActive, args.maxQueued, args.memoryBudget*1024*1024, args.queueTimeout)
     server.serve()
 
 if __name__ == '__main__':
@@ -26,24 +83,51 @@ if __name__ == '__main__':
     parser.add_argument('-H', '--host',           type=str,            help='Host')
     parser.add_argument('-v', '--verbose',        action='store_true', help='Verbose output.')
     parser.add_argument('-l', '--logfile',        type=str,            help='Path to log file')
+    parser.add_argument('-e', '--logEvery',       type=int,            help='Log every Nth readout or waveform of a session in verbose mode (totals are logged when a session closes)')
     parser.add_argument('-s', '--savedata',       action='store_true', help='Save incoming data')
     parser.add_argument('-S', '--savedataFolder', action='store_true', help='Folder to save incoming data')
+    parser.add_argument('-c', '--capture',        action='store_true', help='Capture the received bytes of every session to savedataFolder (see wirecapture.py)')
+    parser.add_argument('-C', '--captureCompress', action='store_true', help='Compress captures with zlib')
+    parser.add_argument('-q', '--saveQueueSize',  type=int,            help='Received messages waiting to be saved before parsing waits for the file')
+    parser.add_argument('-k', '--saveChunkSize',  type=int,            help='HDF5 chunk size in KB for saved data files, except image data which is chunked by image')
+    parser.add_argument('-K', '--saveCacheSize',  type=int,            help='HDF5 chunk cache size in MB for saved data files')
+    parser.add_argument('-w', '--workers',        type=int,            help='Number of pre-forked worker processes (0 to fork per connection)')
+    parser.add_argument('-r', '--maxSessions',    type=int,            help='Recycle pool workers after this many sessions (0 to never recycle)')
+    parser.add_argument('-b', '--batchSize',      type=int,            help='Decode up to this many consecutive acquisitions into one batch (0 to disable)')
+    parser.add_argument('-P', '--pipelined',      action='store_true', help='Overlap receiving, reconstruction and sending within each session')
+    parser.add_argument('-t', '--reconThreads',   type=int,            help='Reconstruct up to this many slices of a session in parallel (implies --pipelined)')
+    parser.add_argument('-T', '--maxRecons',      type=int,            help='Maximum slices reconstructed at once across all sessions (0 for no limit)')
+    parser.add_argument('-A', '--maxActive',      type=int,            help='Maximum sessions processed at once, further sessions wait for admission (0 for no limit)')
+    parser.add_argument('-Q', '--maxQueued',      type=int,            help='Sessions that may wait for admission, further sessions are rejected')
+    parser.add_argument('-B', '--memoryBudget',   type=int,            help='Memory in MB for the estimated memory of the sessions processed at once, further sessions wait for admission (0 for no limit)')
+    parser.add_argument('-W', '--queueTimeout',   type=float,          help='Seconds a session may wait for admission before it is rejected (0 for no limit)')
+    parser.add_argument('-f', '--fft',            type=str,            help='FFT backend (%s)' % ', '.join(fftengine.backends))
+    parser.add_argument('-F', '--fftThreads',     type=int,            help='Threads per FFT for the scipy and pyfftw backends (0 for all cores)')
+    parser.add_argument('-d', '--precision',      type=str,            help='Recon precision (single: complex64/float32, double: complex128/float64)', choices=[kernels.PRECISION_SINGLE, kernels.PRECISION_DOUBLE])
+    parser.add_argument('-o', '--cropReadout',    action='store_true', help='Remove readout oversampling before the phase encoding FFT')
+    parser.add_argument('-Z', '--zeroFill',       action='store_true', help='Zero-fill k-space lines that were not acquired up to the encoding limits of the metadata')
+    parser.add_argument('-x', '--reconCacheSize', type=int,            help='Recon contexts (buffers, MetaAttributes) kept per process for repeated protocols')
+    parser.add_argument('-X', '--reconCacheMemory', type=int,          help='Memory in MB of the buffers of the recon contexts kept per process')
+    parser.add_argument('-i', '--imageBatch',     type=int,            help='Process incoming images of the same shape and series in batches of up to this many (0 to process them one by one)')
+    parser.add_argument('-I', '--imageLatency',   type=float,          help='Milliseconds an incoming image may wait for its batch to fill')
+    parser.add_argument('-D', '--debugLevel',     type=str,            help='Debug dumps of intermediate arrays (none, images: final images, all: also raw data)', choices=list(debugdump.levels))
+    parser.add_argument('-g', '--debugFolder',    type=str,            help='Folder for the debug dump directory of each session')
+    parser.add_argument('-G', '--debugConfigs',   type=str, nargs='+', help='Only write debug dumps for these configs (None for all)')
+    parser.add_argument('-n', '--debugEvery',     type=int,            help='Write debug dumps of every Nth slice or image of a session')
+    parser.add_argument('-z', '--debugCompress',  action='store_true', help='Compress debug dumps (.npz)')
+    parser.add_argument('-M', '--metrics',        action='store_true', help='Time the stages of every session and log a summary when it closes')
+    parser.add_argument('-m', '--metricsPort',    type=int,            help='Serve metrics aggregated over all sessions on this port at /metrics (Prometheus) and /sessions (JSON), implies --metrics (0 to disable)')
+    parser.add_argument('-a', '--asyncio',        action='store_true', help='Serve all connections from one asyncio event loop (workers sets the recon process pool size)')
 
     parser.set_defaults(**defaults)
 
     args = parser.parse_args()
 
+    # Records of all processes are written by one listener process
     if args.logfile:
         print("Logging to file: ", args.logfile)
-        logging.basicConfig(filename=args.logfile, format='%(asctime)s - %(message)s', level=logging.WARNING)
-        logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
     else:
         print("No logfile provided")
-        logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING)
-
-    if args.verbose:
-        logging.root.setLevel(logging.DEBUG)
-    else:
-        logging.root.setLevel(logging.INFO)
+    logsetup.configure(args.verbose, args.logfile, args.logEvery)
 
     main(args)
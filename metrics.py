@@ -0,0 +1,410 @@
+import collections
+import constants
+import contextlib
+import ctypes
+import http.server
+import json
+import logging
+import multiprocessing
+import threading
+import time
+import ismrmrd
+
+# Instrumentation of sessions: wall and CPU time per stage, messages and bytes
+# by type and direction, and the latency from the last readout of a slice (or
+# an incoming image) until its image is sent.  Each session has a Session,
+# which the Connection and the recon modules record into.  When a session
+# closes, its summary is logged and sent to the server process, which
+# aggregates the sessions of all worker processes and serves them on a side
+# port:
+#   /metrics   Prometheus text format
+#   /sessions  summaries of the most recent sessions as JSON
+
+# Stages recorded by the Connection
+STAGE_RECEIVE  = 'receive'     # waiting for and copying data from the socket
+STAGE_PARSE    = 'parse'       # deserializing messages (receive excluded)
+STAGE_SEND     = 'send'        # writing to the socket
+STAGE_SAVE     = 'save'        # HDF5 writer thread of --savedata
+
+# Stages recorded by the server
+STAGE_QUEUE    = 'queue'       # waiting for admission (see server.Admission)
+
+# Stages recorded by the recon modules
+STAGE_FFT      = 'fft'
+STAGE_COMBINE  = 'combine'
+STAGE_QUANTIZE = 'quantize'
+
+MESSAGE_NAMES = {
+    constants.MRD_MESSAGE_CONFIG_FILE:         'config_file',
+    constants.MRD_MESSAGE_CONFIG_TEXT:         'config_text',
+    constants.MRD_MESSAGE_METADATA_XML_TEXT:   'metadata',
+    constants.MRD_MESSAGE_CLOSE:               'close',
+    constants.MRD_MESSAGE_TEXT:                'text',
+    constants.MRD_MESSAGE_ISMRMRD_ACQUISITION: 'acquisition',
+    constants.MRD_MESSAGE_ISMRMRD_IMAGE:       'image',
+    constants.MRD_MESSAGE_ISMRMRD_WAVEFORM:    'waveform',
+}
+
+# Upper bounds in seconds of the slice latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Session summaries kept for /sessions
+METRICS_RECENT_SESSIONS = 32
+
+enabled  = False
+registry = None
+
+# Start collecting metrics and serve them on port (0 to only log session
+# summaries).  Like fftengine.configure(), this must be called before sessions
+# are started, so that forked session processes share the queue to the server.
+def configure(enable=False, port=0, address='0.0.0.0'):
+    global enabled, registry
+    enabled = enable or (port > 0)
+    if (not enabled):
+        return
+    registry = Registry()
+    registry.start()
+    if (port > 0):
+        serve(registry, address, port)
+        logging.info("Serving metrics at http://%s:%d/metrics", address, port)
+
+
+# Timer of one stage.  Records into the session when the block ends.
+class Timer:
+    def __init__(self, session, name):
+        self.session = session
+        self.name    = name
+
+    def __enter__(self):
+        self.start = (time.perf_counter(), time.thread_time())
+        return self
+
+    def __exit__(self, *exc):
+        self.session.add(self.name, time.perf_counter() - self.start[0], time.thread_time() - self.start[1])
+        return False
+
+# Metrics of one session.  The Connection and pipeline threads record into the
+# same Session, so updates are locked.
+class Session:
+    enabled = True
+
+    def __init__(self, config=None, publish=True):
+        self.config    = config
+        self.started   = time.time()
+        self.lock      = threading.Lock()
+        self.stages    = {}                    # name: [calls, wall seconds, CPU seconds]
+        self.messages  = {}                    # (direction, type): [messages, bytes]
+        self.latencies = []
+        self.pending   = collections.deque()   # times slices ended, waiting for their image
+        self.receiving = [0.0, 0.0]            # wall and CPU seconds in STAGE_RECEIVE
+        self.closed    = not publish
+        if publish:
+            publish_event(('start', None))
+
+    def stage(self, name):
+        return Timer(self, name)
+
+    def add(self, name, wall, cpu, calls=1):
+        with self.lock:
+            stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+            stage[0] += calls
+            stage[1] += wall
+            stage[2] += cpu
+
+    # Start and stop of a stage timed without a with block
+    def clock(self):
+        return (time.perf_counter(), time.thread_time(), self.receiving[0], self.receiving[1])
+
+    def stop(self, name, start):
+        wall, cpu = time.perf_counter() - start[0], time.thread_time() - start[1]
+        if (name == STAGE_RECEIVE):
+            self.receiving[0] += wall
+            self.receiving[1] += cpu
+        self.add(name, wall, cpu)
+
+    # A message was parsed since start.  Time spent receiving in between is
+    # not counted as parsing.
+    def received(self, identifier, item, start):
+        wall = time.perf_counter() - start[0] - (self.receiving[0] - start[2])
+        cpu  = time.thread_time()  - start[1] - (self.receiving[1] - start[3])
+        self.add(STAGE_PARSE, wall, cpu)
+
+        count, nbytes, ended = message_size(identifier, item)
+        self.count('received', identifier, count, nbytes)
+        if ended:
+            now = time.perf_counter()
+            with self.lock:
+                self.pending.extend([now]*ended)
+
+    def sent(self, identifier, nbytes, count=1):
+        self.count('sent', identifier, count, nbytes)
+        if (identifier == constants.MRD_MESSAGE_ISMRMRD_IMAGE):
+            now = time.perf_counter()
+            with self.lock:
+                for _ in range(min(count, len(self.pending))):
+                    self.latencies.append(now - self.pending.popleft())
+
+    def count(self, direction, identifier, count, nbytes):
+        key = (direction, MESSAGE_NAMES.get(identifier, str(identifier)))
+        with self.lock:
+            messages = self.messages.setdefault(key, [0, 0])
+            messages[0] += count
+            messages[1] += nbytes
+
+    # Stage times recorded elsewhere, e.g. by a recon process
+    def merge(self, stages):
+        for name, (calls, wall, cpu) in (stages or {}).items():
+            self.add(name, wall, cpu, calls)
+
+    # Recon functions called from this thread record into this session
+    @contextlib.contextmanager
+    def bind(self):
+        previous = getattr(local, 'session', disabled)
+        local.session = self
+        try:
+            yield self
+        finally:
+            local.session = previous
+
+    def summary(self):
+        with self.lock:
+            return {'config':      config_label(self.config),
+                    'started':     self.started,
+                    'duration_s':  time.time() - self.started,
+                    'stages':      {name: {'calls': calls, 'wall_s': wall, 'cpu_s': cpu} for name, (calls, wall, cpu) in self.stages.items()},
+                    'messages':    {'%s_%s' % key: {'count': count, 'bytes': nbytes} for key, (count, nbytes) in self.messages.items()},
+                    'latencies_s': list(self.latencies)}
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        summary = self.summary()
+        logging.info("Session summary: %s", format_summary(summary))
+        publish_event(('close', summary))
+        return summary
+
+    # End a session rejected by admission control for reason, e.g. 'memory'.
+    # It is counted as rejected instead of completed.
+    def reject(self, reason):
+        if self.closed:
+            return
+        self.closed = True
+        publish_event(('reject', reason))
+
+# Used when metrics are not collected
+class DisabledSession(Session):
+    enabled = False
+
+    def __init__(self):
+        self.config = None
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def add(self, name, wall, cpu, calls=1):
+        pass
+
+    def clock(self):
+        return None
+
+    def stop(self, name, start):
+        pass
+
+    def received(self, identifier, item, start):
+        pass
+
+    def sent(self, identifier, nbytes, count=1):
+        pass
+
+    def merge(self, stages):
+        pass
+
+    def close(self):
+        pass
+
+    def reject(self, reason):
+        pass
+
+disabled = DisabledSession()
+
+def session(config=None):
+    return Session(config) if enabled else disabled
+
+# Session of the current thread, see Session.bind()
+local = threading.local()
+
+def current():
+    return getattr(local, 'session', disabled)
+
+def stage(name):
+    return current().stage(name)
+
+# Run func(*args) with a new session bound and return its result with the
+# stage times, for recons run in another process
+def run_timed(func, *args):
+    if (not enabled):
+        return func(*args), None
+    # The recon is part of a session that is already counted
+    timed = Session(publish=False)
+    with timed.bind():
+        result = func(*args)
+    return result, timed.stages
+
+# (messages, bytes on the wire, slices ended) of a parsed message
+def message_size(identifier, item):
+    idSize = constants.SIZEOF_MRD_MESSAGE_IDENTIFIER
+    if isinstance(item, ismrmrd.Acquisition):
+        return 1, idSize + ctypes.sizeof(ismrmrd.AcquisitionHeader) + item.data.nbytes + item.traj.nbytes, int(item.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE))
+    if isinstance(item, ismrmrd.Image):
+        return 1, idSize + ctypes.sizeof(ismrmrd.ImageHeader) + ctypes.sizeof(ctypes.c_uint64) + len(item.attribute_string) + item.data.nbytes, 1
+    if isinstance(item, ismrmrd.Waveform):
+        return 1, idSize + ctypes.sizeof(ismrmrd.WaveformHeader) + item.data.nbytes, 0
+    if (identifier == constants.MRD_MESSAGE_CONFIG_FILE):
+        return 1, idSize + constants.SIZEOF_MRD_MESSAGE_CONFIGURATION_FILE, 0
+    if isinstance(item, str):
+        return 1, idSize + constants.SIZEOF_MRD_MESSAGE_LENGTH + len(item) + 1, 0
+    if (item is None):
+        return 1, idSize, 0
+    # connection.AcquisitionBatch
+    return len(item), len(item)*(idSize + ctypes.sizeof(ismrmrd.AcquisitionHeader)) + item.data.nbytes + item.traj.nbytes, int(item.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE).sum())
+
+# Configs sent as text are not used as labels
+def config_label(config):
+    if (config is None) or (len(config) > 64) or ('\n' in config):
+        return 'text' if config else ''
+    return config
+
+def format_summary(summary):
+    stages = ', '.join("%s %.3f s (%.3f s CPU)" % (name, stage['wall_s'], stage['cpu_s']) for name, stage in sorted(summary['stages'].items()))
+    messages = ', '.join("%d %s (%.1f MB)" % (message['count'], name, message['bytes']/1e6) for name, message in sorted(summary['messages'].items()))
+    latencies = sorted(summary['latencies_s'])
+    latency = ("slice latency median %.3f s, max %.3f s" % (latencies[len(latencies)//2], latencies[-1])) if latencies else "no images"
+    return "%s in %.3f s: %s; %s; %s" % (summary['config'], summary['duration_s'], stages, messages, latency)
+
+
+# ----- Aggregation --------------------------------------------------------------
+# Sessions in any process send ('start', None), ('close', summary) and
+# ('reject', reason) to the registry of the server process through a
+# multiprocessing queue.
+def publish_event(event):
+    if (registry is not None):
+        try:
+            registry.queue.put_nowait(event)
+        except Exception as e:
+            logging.debug("Could not publish session metrics: %s", e)
+
+class Registry:
+    def __init__(self):
+        self.queue     = multiprocessing.Queue()
+        self.lock      = threading.Lock()
+        self.active    = 0
+        self.sessions  = collections.Counter()           # config: sessions
+        self.durations = collections.Counter()           # config: seconds
+        self.stages    = collections.defaultdict(lambda: [0, 0.0, 0.0])
+        self.messages  = collections.defaultdict(lambda: [0, 0])
+        self.latency   = collections.defaultdict(lambda: [[0]*len(LATENCY_BUCKETS), 0, 0.0])  # buckets, count, sum
+        self.recent    = collections.deque(maxlen=METRICS_RECENT_SESSIONS)
+        self.rejected  = collections.Counter()           # reason: sessions
+
+    def start(self):
+        threading.Thread(target=self.run, name="metrics", daemon=True).start()
+
+    def run(self):
+        while True:
+            kind, summary = self.queue.get()
+            with self.lock:
+                if (kind == 'start'):
+                    self.active += 1
+                elif (kind == 'reject'):
+                    self.active -= 1
+                    self.rejected[summary] += 1
+                else:
+                    self.active -= 1
+                    self.add(summary)
+
+    def add(self, summary):
+        config = summary['config'] or ''
+        self.sessions[config]  += 1
+        self.durations[config] += summary['duration_s']
+        self.recent.append(summary)
+        for name, stage in summary['stages'].items():
+            total = self.stages[(config, name)]
+            total[0] += stage['calls']
+            total[1] += stage['wall_s']
+            total[2] += stage['cpu_s']
+        for name, message in summary['messages'].items():
+            total = self.messages[(config,) + tuple(name.split('_', 1))]
+            total[0] += message['count']
+            total[1] += message['bytes']
+        histogram = self.latency[config]
+        for latency in summary['latencies_s']:
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if (latency <= bound):
+                    histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += latency
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s%s %s" % (name, format_labels(labels), repr(float(value)) if isinstance(value, float) else value))
+
+        with self.lock:
+            metric('mrd_sessions_active', 'gauge', 'Sessions in progress', [({}, self.active)])
+            metric('mrd_sessions_total', 'counter', 'Sessions completed', [({'config': config}, count) for config, count in sorted(self.sessions.items())])
+            metric('mrd_session_seconds_total', 'counter', 'Duration of completed sessions', [({'config': config}, seconds) for config, seconds in sorted(self.durations.items())])
+            metric('mrd_sessions_rejected_total', 'counter', 'Sessions rejected by admission control', [({'reason': reason}, count) for reason, count in sorted(self.rejected.items())])
+            metric('mrd_stage_calls_total', 'counter', 'Calls of each stage', [({'config': config, 'stage': name}, stage[0]) for (config, name), stage in sorted(self.stages.items())])
+            metric('mrd_stage_seconds_total', 'counter', 'Wall time of each stage', [({'config': config, 'stage': name}, stage[1]) for (config, name), stage in sorted(self.stages.items())])
+            metric('mrd_stage_cpu_seconds_total', 'counter', 'CPU time of each stage', [({'config': config, 'stage': name}, stage[2]) for (config, name), stage in sorted(self.stages.items())])
+            metric('mrd_messages_total', 'counter', 'MRD messages', [({'config': config, 'direction': direction, 'type': kind}, total[0]) for (config, direction, kind), total in sorted(self.messages.items())])
+            metric('mrd_message_bytes_total', 'counter', 'Bytes of MRD messages', [({'config': config, 'direction': direction, 'type': kind}, total[1]) for (config, direction, kind), total in sorted(self.messages.items())])
+
+            metric('mrd_slice_latency_seconds', 'histogram', 'Last readout of a slice or incoming image until its image is sent', [])
+            for config, (buckets, count, total) in sorted(self.latency.items()):
+                for bound, value in zip(LATENCY_BUCKETS + ('+Inf',), buckets + [count]):
+                    lines.append("mrd_slice_latency_seconds_bucket%s %d" % (format_labels({'config': config, 'le': bound}), value))
+                lines.append("mrd_slice_latency_seconds_sum%s %r" % (format_labels({'config': config}), float(total)))
+                lines.append("mrd_slice_latency_seconds_count%s %d" % (format_labels({'config': config}), count))
+        return '\n'.join(lines) + '\n'
+
+    def recent_sessions(self):
+        with self.lock:
+            return list(self.recent)
+
+def format_labels(labels):
+    if (not labels):
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for key, value in labels.items()) + '}'
+
+
+# ----- Side port ------------------------------------------------------------------
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if (self.path == '/metrics'):
+            body, contentType = self.server.registry.render().encode(), 'text/plain; version=0.0.4'
+        elif (self.path == '/sessions'):
+            body, contentType = json.dumps(self.server.registry.recent_sessions()).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: " + format, *args)
+
+def serve(registry, address, port):
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
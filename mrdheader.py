@@ -0,0 +1,135 @@
+import ismrmrd
+import collections
+import hashlib
+import logging
+import threading
+
+# Number of distinct headers kept by the cache of each process
+MRD_HEADER_CACHE_SIZE = 32
+
+# Compact, parsed form of the MRD header XML (MRD_MESSAGE_METADATA_XML_TEXT).
+# The fields commonly needed by recons are extracted once:
+#   encodedMatrix, reconMatrix   (x, y, z) matrix sizes of the first encoding
+#   encodedFov, reconFov         (x, y, z) fields of view in mm
+#   lines                        kspace_encoding_step_1 maximum + 1
+#   partitions                   kspace_encoding_step_2 maximum + 1
+#   slices                       slice maximum + 1
+#   channels                     receiver channels
+# Fields that are not present in the XML are None.  The full ismrmrd.xsd
+# header is parsed on first access to "header".  str() returns the XML text.
+class MrdHeader:
+    def __init__(self, xml, digest=None):
+        self.xml           = xml
+        self.digest        = digest if digest is not None else header_digest(xml)
+        self.valid         = False
+        self.encodedMatrix = None
+        self.reconMatrix   = None
+        self.encodedFov    = None
+        self.reconFov      = None
+        self.lines         = None
+        self.partitions    = None
+        self.slices        = None
+        self.channels      = None
+        self._header       = None
+
+        try:
+            self._header = ismrmrd.xsd.CreateFromDocument(xml)
+        except Exception as e:
+            logging.debug("Metadata is not a valid MRD header: %s", e)
+            return
+
+        self.valid = True
+        if (len(self._header.encoding) > 0):
+            encoding = self._header.encoding[0]
+            self.encodedMatrix = xyz(encoding.encodedSpace.matrixSize)
+            self.reconMatrix   = xyz(encoding.reconSpace.matrixSize)
+            self.encodedFov    = xyz(encoding.encodedSpace.fieldOfView_mm)
+            self.reconFov      = xyz(encoding.reconSpace.fieldOfView_mm)
+            if (encoding.encodingLimits is not None):
+                self.lines      = limit_count(encoding.encodingLimits.kspace_encoding_step_1)
+                self.partitions = limit_count(encoding.encodingLimits.kspace_encoding_step_2)
+                self.slices     = limit_count(encoding.encodingLimits.slice)
+
+        if (self._header.acquisitionSystemInformation is not None):
+            self.channels = self._header.acquisitionSystemInformation.receiverChannels
+
+    def __str__(self):
+        return self.xml
+
+    # Headers are equal if their XML is, and not equal to the XML text itself,
+    # whose hash differs
+    def __eq__(self, other):
+        if isinstance(other, MrdHeader):
+            return self.digest == other.digest
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    @property
+    def header(self):
+        if (self._header is None) and (self.valid is True):
+            self._header = ismrmrd.xsd.CreateFromDocument(self.xml)
+        return self._header
+
+    # Only the compact fields are sent to other processes.  The full header is
+    # parsed again there if needed.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_header'] = None
+        return state
+
+
+def xyz(value):
+    return (value.x, value.y, value.z) if value is not None else None
+
+def limit_count(limit):
+    return (limit.maximum + 1) if limit is not None else None
+
+def header_digest(xml):
+    return hashlib.sha1(xml.encode('utf-8')).hexdigest()
+
+
+# Least recently used cache of MrdHeaders keyed by the digest of their XML
+class MrdHeaderCache:
+    def __init__(self, capacity=MRD_HEADER_CACHE_SIZE):
+        self.capacity = capacity
+        self.headers  = collections.OrderedDict()
+        self.lock     = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+
+    def get(self, xml):
+        digest = header_digest(xml)
+        with self.lock:
+            header = self.headers.get(digest)
+            if header is not None:
+                self.headers.move_to_end(digest)
+                self.hits += 1
+                return header
+            self.misses += 1
+
+        header = MrdHeader(xml, digest)
+
+        with self.lock:
+            self.headers[digest] = header
+            while (len(self.headers) > self.capacity):
+                self.headers.popitem(last=False)
+        return header
+
+    def clear(self):
+        with self.lock:
+            self.headers.clear()
+
+
+# Cache shared by all sessions handled by this process.  Pool workers and the
+# asyncio server keep it across sessions.
+cache = MrdHeaderCache()
+
+# Parse the MRD header XML, reusing the result for repeated protocols
+def parse(xml):
+    if isinstance(xml, MrdHeader):
+        return xml
+    if (xml is None):
+        xml = ""
+    return cache.get(xml)
@@ -0,0 +1,168 @@
+import constants
+import ismrmrd.hdf5
+import h5py
+import queue
+import threading
+import time
+import numpy as np
+
+# Target size in bytes of each block of messages.  Records are read from HDF5
+# with one hyperslab read per block.
+READ_BLOCK_SIZE = 16*1024*1024
+
+# Blocks serialized ahead of the sender
+READ_QUEUE_SIZE = 4
+
+ACQUISITION_ID = constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION)
+IMAGE_ID       = constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_ISMRMRD_IMAGE)
+
+# Reads the acquisitions or images of a group of an ISMRMRD HDF5 file, in the
+# layout of ismrmrd.Dataset and MrdWriter, and serializes them into MRD messages
+# from a background thread.  Records are read in large hyperslabs, or through a
+# memory map for contiguous datasets, and their header and data arrays are
+# copied straight into the message buffers, without an ismrmrd.Acquisition or
+# ismrmrd.Image per record.  Iterating over the reader returns blocks of
+# messages as (identifier, count, buffer) for Connection.send_serialized().
+#
+# Raw data is the acquisitions in /group/data.  Image data is each sub-group
+# with header, attributes and data datasets, in the order of their names.
+# Waveforms are not sent.  If reading fails, the error is raised by the
+# iteration.
+class MrdReader:
+    def __init__(self, path, group="dataset", blockSize=READ_BLOCK_SIZE, queueSize=READ_QUEUE_SIZE):
+        self.path      = path
+        self.blockSize = blockSize
+        self.file      = h5py.File(path, 'r')
+        self.group     = self.file[group]
+        self.queue     = queue.Queue(maxsize=queueSize)
+        self.error     = None
+        self.stopped   = False
+
+        # Statistics
+        self.messages  = 0
+        self.bytes     = 0
+        self.reads     = 0
+        self.busy      = 0.0
+
+        self.isRaw     = ('data' in self.group) and ('xml' in self.group)
+        self.images    = [name for name in sorted(self.group.keys()) if is_image_group(self.group[name])]
+
+        self.thread = threading.Thread(target=self.run, name="mrd-reader", daemon=True)
+        self.thread.start()
+
+    # Text of the MRD XML header, or None if the group has none
+    def xml_header(self):
+        if ('xml' not in self.group):
+            return None
+        xml = self.group['xml'][0]
+        return xml.decode('utf-8') if isinstance(xml, bytes) else xml
+
+    def __iter__(self):
+        while True:
+            block = self.queue.get()
+            if (block is None):
+                break
+            yield block
+        if (self.error is not None):
+            raise self.error
+
+    # Also stops reading if the blocks were not all taken, e.g. when sending
+    # failed
+    def close(self):
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.file.close()
+
+    def stats(self):
+        return {'messages': self.messages,
+                'bytes':    self.bytes,
+                'reads':    self.reads,
+                'busy_s':   self.busy}
+
+    # ----- Reader thread --------------------------------------------------------
+    def run(self):
+        try:
+            if (self.isRaw):
+                self.read_acquisitions(self.group['data'])
+            else:
+                for name in self.images:
+                    self.read_images(self.group[name])
+        except Exception as e:
+            self.error = e
+        self.queue.put(None)
+
+    def put(self, identifier, count, buffer, start):
+        self.messages += count
+        self.bytes    += len(buffer)
+        self.reads    += 1
+        self.busy     += time.perf_counter() - start
+        self.queue.put((identifier, count, buffer))
+
+    def records_per_block(self, recordBytes):
+        return max(self.blockSize//max(recordBytes, 1), 1)
+
+    def read_acquisitions(self, dataset):
+        if (len(dataset) == 0):
+            return
+        headerSize = ismrmrd.hdf5.acquisition_header_dtype.itemsize
+        first      = dataset[0]
+        count      = self.records_per_block(headerSize + first['data'].nbytes + first['traj'].nbytes)
+
+        for offset in range(0, len(dataset), count):
+            if (self.stopped):
+                return
+            start   = time.perf_counter()
+            records = dataset[offset:offset + count]
+            heads   = memoryview(np.ascontiguousarray(records['head']).view(np.uint8))
+            traj    = records['traj']
+            data    = records['data']
+
+            pieces = []
+            for index in range(len(records)):
+                pieces += (ACQUISITION_ID, heads[index*headerSize:(index+1)*headerSize], traj[index], data[index])
+            self.put(constants.MRD_MESSAGE_ISMRMRD_ACQUISITION, len(records), b''.join(pieces), start)
+
+    def read_images(self, group):
+        headers = map_dataset(group['header'])
+        data    = map_dataset(group['data'])
+        if (len(headers) == 0):
+            return
+        headerSize = ismrmrd.hdf5.image_header_dtype.itemsize
+        count      = self.records_per_block(headerSize + data.dtype.itemsize*int(np.prod(data.shape[1:])))
+
+        for offset in range(0, len(headers), count):
+            if (self.stopped):
+                return
+            start      = time.perf_counter()
+            heads      = np.array(headers[offset:offset + count])
+            attributes = [attribute.encode('utf-8') if isinstance(attribute, str) else attribute for attribute in group['attributes'][offset:offset + count]]
+            pixels     = np.ascontiguousarray(data[offset:offset + count])
+
+            # As in ismrmrd.Image.serialize_into(), the header has the length
+            # of the attributes that follow it
+            heads['attribute_string_len'] = [len(attribute) for attribute in attributes]
+            headView = memoryview(heads.view(np.uint8))
+
+            pieces = []
+            for index in range(len(heads)):
+                pieces += (IMAGE_ID, headView[index*headerSize:(index+1)*headerSize],
+                           constants.MrdMessageAttribLength.pack(len(attributes[index])), attributes[index], pixels[index])
+            self.put(constants.MRD_MESSAGE_ISMRMRD_IMAGE, len(heads), b''.join(pieces), start)
+
+
+def is_image_group(item):
+    return isinstance(item, h5py.Group) and ('header' in item) and ('attributes' in item) and ('data' in item)
+
+# A read-only memory map of a contiguous, uncompressed dataset.  Chunked (e.g.
+# resizable) datasets are returned as they are and read through HDF5.
+def map_dataset(dataset):
+    if ((dataset.chunks is not None) or dataset.dtype.hasobject):
+        return dataset
+    offset = dataset.id.get_offset()
+    if (offset is None):
+        return dataset
+    return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
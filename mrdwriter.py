@@ -0,0 +1,240 @@
+import ismrmrd
+import ismrmrd.hdf5
+import h5py
+import logging
+import queue
+import threading
+import time
+import numpy as np
+
+# Messages waiting to be written.  When the queue is full, the connection
+# waits for the writer (a stall) so that no data is lost.
+SAVE_QUEUE_SIZE = 256
+
+# Records written to HDF5 with one resize and one write
+SAVE_BATCH_SIZE = 1024
+
+# Bytes per HDF5 chunk of the acquisition, waveform and image header datasets.
+# Image data is chunked by image, as a chunk is allocated in full even if only
+# one image of it is written.
+SAVE_CHUNK_SIZE = 64*1024
+
+# HDF5 chunk cache size per dataset in bytes
+SAVE_CACHE_SIZE = 64*1024*1024
+
+# Settings of writers created without explicit ones, i.e. for --savedata
+defaultQueueSize = SAVE_QUEUE_SIZE
+defaultBatchSize = SAVE_BATCH_SIZE
+defaultChunkSize = SAVE_CHUNK_SIZE
+defaultCacheSize = SAVE_CACHE_SIZE
+
+# Like fftengine.configure(), this should be called before sessions are started
+def configure(queueSize=SAVE_QUEUE_SIZE, batchSize=SAVE_BATCH_SIZE, chunkSize=SAVE_CHUNK_SIZE, cacheSize=SAVE_CACHE_SIZE):
+    global defaultQueueSize, defaultBatchSize, defaultChunkSize, defaultCacheSize
+    defaultQueueSize = queueSize
+    defaultBatchSize = batchSize
+    defaultChunkSize = chunkSize
+    defaultCacheSize = cacheSize
+
+# Writes received MRD messages to an ISMRMRD HDF5 file from a background thread,
+# in the same layout as ismrmrd.Dataset.  Messages are queued as they are
+# parsed and the writer takes everything that is waiting, so that consecutive
+# acquisitions, waveforms and images of a series are appended with a single
+# resize and write instead of one per record.  The HDF5 file is only accessed
+# by the writer thread.  Queued messages must not be modified afterwards.
+#
+# close() writes the remaining messages, closes the file and logs the queue
+# depth and write throughput.  If writing fails, the error is logged and the
+# remaining messages are dropped; the session itself is not interrupted.
+#
+# The file is opened with the h5py mode given.  The default 'a' appends to an
+# existing file, as --savedata does with ismrmrd.Dataset; 'w' creates it anew.
+class MrdWriter:
+    def __init__(self, path, group="dataset", queueSize=None, batchSize=None, chunkSize=None, cacheSize=None, mode='a'):
+        self.path      = path
+        self.batchSize = batchSize or defaultBatchSize
+        self.chunkSize = chunkSize or defaultChunkSize
+        self.file      = h5py.File(path, mode, rdcc_nbytes=cacheSize or defaultCacheSize)
+        self.group     = self.file.require_group(group)
+        self.queue     = queue.Queue(maxsize=queueSize or defaultQueueSize)
+        self.failed    = False
+        self.closed    = False
+
+        # Statistics
+        self.messages  = 0
+        self.bytes     = 0
+        self.writes    = 0
+        self.stalls    = 0
+        self.maxDepth  = 0
+        self.busy      = 0.0
+        self.cpu       = 0.0
+
+        self.thread = threading.Thread(target=self.run, name="mrd-writer", daemon=True)
+        self.thread.start()
+
+    # ----- Called by the connection ---------------------------------------------
+    def write_config_file(self, configFile):
+        self.put(('config_file', configFile))
+
+    def write_config(self, config):
+        self.put(('config', config))
+
+    def write_xml_header(self, xml):
+        self.put(('xml', xml))
+
+    def append_acquisition(self, acquisition):
+        self.put(('data', acquisition))
+
+    def append_acquisitions(self, batch):
+        self.put(('data', batch))
+
+    def append_waveform(self, waveform):
+        self.put(('waveforms', waveform))
+
+    def append_image(self, image):
+        self.put(('images_%d' % image.image_series_index, image))
+
+    def put(self, item):
+        if (self.failed or self.closed):
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.stalls += 1
+            self.queue.put(item)
+        self.maxDepth = max(self.maxDepth, self.queue.qsize())
+
+    # Whether the next message would wait for the writer
+    def full(self):
+        return self.queue.full()
+
+    def close(self):
+        if (self.closed):
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        logging.info("Saved %d messages (%.1f MB) to %s in %d writes: %.1f MB/s while writing, queue depth up to %d of %d, %d stalls",
+                     self.messages, self.bytes/1e6, self.path, self.writes, self.bytes/1e6/max(self.busy, 1e-9), self.maxDepth, self.queue.maxsize, self.stalls)
+
+    def stats(self):
+        return {'messages':  self.messages,
+                'bytes':     self.bytes,
+                'writes':    self.writes,
+                'stalls':    self.stalls,
+                'max_depth': self.maxDepth,
+                'busy_s':    self.busy,
+                'cpu_s':     self.cpu}
+
+    # ----- Writer thread --------------------------------------------------------
+    def run(self):
+        done = False
+        while not done:
+            items = [self.queue.get()]
+            while (len(items) < self.batchSize):
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if items[-1] is None:
+                items.pop()
+                done = True
+
+            start, cpu = time.perf_counter(), time.thread_time()
+            try:
+                if (not self.failed):
+                    for name, records in runs(items):
+                        self.write(name, records)
+            except Exception as e:
+                logging.exception("Failed to save data to %s, dropping remaining messages: %s", self.path, e)
+                self.failed = True
+            self.busy += time.perf_counter() - start
+            self.cpu  += time.thread_time() - cpu
+
+    def write(self, name, records):
+        if name in ('config_file', 'config', 'xml'):
+            dataset = self.group.require_dataset(name, shape=(1,), dtype=h5py.special_dtype(vlen=bytes))
+            dataset[0] = bytes(records[-1], 'utf-8') if isinstance(records[-1], str) else records[-1]
+            self.count(1, len(records[-1]))
+        elif (name == 'data'):
+            for first in range(0, len(records), self.batchSize):
+                data = acquisition_records(records[first:first + self.batchSize])
+                self.append(self.group, 'data', data)
+                self.count(len(data), sum(record.nbytes for record in data['data']) + sum(record.nbytes for record in data['traj']))
+        elif (name == 'waveforms'):
+            data = waveform_records(records)
+            self.append(self.group, 'waveforms', data)
+            self.count(len(data), sum(record.nbytes for record in data['data']))
+        else:
+            self.append_images(self.group.require_group(name), records)
+
+    # rows is the number of records per chunk, by default as many as fit in
+    # chunkSize bytes
+    def append(self, group, name, records, rows=None):
+        if name not in group:
+            if (rows is None):
+                rows = max(1, self.chunkSize // (records.nbytes // len(records)))
+            group.create_dataset(name, (0,) + records.shape[1:], maxshape=(None,) + records.shape[1:], chunks=(rows,) + records.shape[1:], dtype=records.dtype)
+        dataset = group[name]
+        offset  = dataset.shape[0]
+        dataset.resize(offset + len(records), axis=0)
+        dataset[offset:] = records
+        self.writes += 1
+
+    def append_images(self, group, images):
+        # Images of a series are stacked, so they must all have the same shape
+        for first in range(0, len(images), self.batchSize):
+            part = images[first:first + self.batchSize]
+            dtype = ismrmrd.hdf5.get_hdf5type(part[0].data_type)
+            self.append(group, 'header', np.concatenate([np.frombuffer(image.getHead(), dtype=ismrmrd.hdf5.image_header_dtype) for image in part]))
+            self.append(group, 'attributes', np.array([image.attribute_string for image in part], dtype=h5py.special_dtype(vlen=str)))
+            self.append(group, 'data', np.stack([image.data.view(dtype) for image in part]), rows=1)
+            self.count(len(part), sum(image.data.nbytes for image in part))
+
+    def count(self, messages, nbytes):
+        self.messages += messages
+        self.bytes    += nbytes
+
+
+# Group consecutive items with the same destination into (name, [records])
+def runs(items):
+    name, records = None, []
+    for itemName, record in items:
+        if (itemName != name) and records:
+            yield name, records
+            records = []
+        name = itemName
+        records.append(record)
+    if records:
+        yield name, records
+
+# Structured array of ismrmrd.hdf5.acquisition_dtype for ismrmrd.Acquisitions
+# and connection.AcquisitionBatches
+def acquisition_records(items):
+    count = sum(1 if isinstance(item, ismrmrd.Acquisition) else len(item) for item in items)
+    records = np.empty(count, dtype=ismrmrd.hdf5.acquisition_dtype)
+    head, data, traj = records['head'], records['data'], records['traj']
+
+    index = 0
+    for item in items:
+        if isinstance(item, ismrmrd.Acquisition):
+            head[index] = np.frombuffer(item.getHead(), dtype=ismrmrd.hdf5.acquisition_header_dtype)[0]
+            data[index] = item.data.view(np.float32).reshape(-1)
+            traj[index] = item.traj.view(np.float32).reshape(-1)
+            index += 1
+        else:
+            head[index:index+len(item)] = item.head
+            for i in range(len(item)):
+                data[index+i] = item.data[i].view(np.float32).reshape(-1)
+                traj[index+i] = item.traj[i].reshape(-1)
+            index += len(item)
+    return records
+
+def waveform_records(waveforms):
+    records = np.empty(len(waveforms), dtype=ismrmrd.hdf5.waveform_dtype)
+    head, data = records['head'], records['data']
+    for index, waveform in enumerate(waveforms):
+        head[index] = np.frombuffer(waveform.getHead(), dtype=ismrmrd.hdf5.waveform_header_dtype)[0]
+        data[index] = waveform.data.view(np.uint32).reshape(-1)
+    return records
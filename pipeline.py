@@ -0,0 +1,236 @@
+import ismrmrd
+import concurrent.futures
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+
+import debugdump
+import imagebatch
+import metrics
+from kspace import KSpaceBuffer, slices
+
+# Number of slices or images that may wait between two stages.  When a queue
+# is full, the stage feeding it blocks, so a slow recon stops reading from the
+# socket and a slow client stops the recon.
+PIPELINE_DEPTH = 2
+
+# Seconds between checks for a failed stage while waiting on a queue
+POLL_INTERVAL = 0.1
+
+class PipelineStopped(Exception):
+    pass
+
+# Pipelined version of simplefft.process/invertcontrast.process.  A session is
+# split into three stages that run concurrently, connected by bounded queues:
+#   reader   receives messages and assembles slices with a KSpaceBuffer
+#   compute  runs processRaw(data, acquisition, config, metadata, dump) for
+#            each slice and processImage(image, config, metadata, dump) for
+#            each image
+#   sender   sends the resulting images
+# While slice N is reconstructed, slice N+1 is received and image N-1 is sent,
+# so a multi-slice session takes about max(receive, recon, send) time instead
+# of their sum.  The socket is read only by the reader and written only by the
+# sender.  numpy FFTs and socket I/O release the GIL, so threads are enough.
+#
+# With reconThreads > 0, the compute stage submits each slice to a thread pool
+# of that size instead of reconstructing it itself, so independent slices are
+# reconstructed in parallel.  The sender waits for the results in the order the
+# slices were received.  If limit is given (a ReconLimit shared by all
+# sessions of a server), each recon also holds one of its slots while running.
+#
+# With image batching and processImages, the compute stage collects images in
+# an imagebatch.ImageBatcher and runs processImages(images, config, metadata,
+# dump) for each batch, at the latest when the batch is due.
+class Pipeline:
+    def __init__(self, connection, config, metadata, processRaw, processImage=None, depth=PIPELINE_DEPTH, reconThreads=0, limit=None, processImages=None):
+        self.connection    = connection
+        self.config        = config
+        self.metadata      = metadata
+        self.processRaw    = processRaw
+        self.processImage  = processImage
+        self.processImages = processImages
+        self.reconThreads  = reconThreads
+        self.limit         = limit
+        self.dumps         = debugdump.Session(config)
+        self.metrics       = metrics.current()
+        self.received      = queue.Queue(maxsize=depth)
+        self.processed     = queue.Queue(maxsize=depth + reconThreads)
+        self.failed        = threading.Event()
+        self.error         = None
+
+    def run(self):
+        reader = threading.Thread(target=self.stage, args=[self.read], name="pipeline-reader", daemon=True)
+        sender = threading.Thread(target=self.stage, args=[self.send], name="pipeline-sender", daemon=True)
+        reader.start()
+        sender.start()
+
+        try:
+            self.stage(self.compute)
+            sender.join()
+        finally:
+            # The reader may be blocked on a full queue after a failure, but
+            # is a daemon thread and exits once the socket is closed
+            if (not self.failed.is_set()):
+                reader.join()
+            self.connection.send_close()
+            self.dumps.close()
+
+        if (self.error is not None):
+            raise self.error
+
+    # Run a stage, recording the first exception so that other stages stop
+    def stage(self, func):
+        try:
+            func()
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            if (not self.failed.is_set()):
+                self.error = e
+                self.failed.set()
+
+    def put(self, q, item):
+        while True:
+            if self.failed.is_set():
+                raise PipelineStopped()
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    # Raises queue.Empty if nothing arrived within timeout seconds
+    def get(self, q, timeout=None):
+        deadline = (time.perf_counter() + timeout) if (timeout is not None) else None
+        while True:
+            if self.failed.is_set():
+                raise PipelineStopped()
+            wait = POLL_INTERVAL if (deadline is None) else min(POLL_INTERVAL, max(deadline - time.perf_counter(), 0))
+            try:
+                return q.get(timeout=wait)
+            except queue.Empty:
+                if ((deadline is not None) and (time.perf_counter() >= deadline)):
+                    raise
+
+    # ----- Stages -------------------------------------------------------------
+    # Each stage passes None on to the next one when it is done
+    def read(self):
+        try:
+            for item in slices(self.connection, KSpaceBuffer(self.metadata)):
+                self.put(self.received, item)
+        finally:
+            if (not self.failed.is_set()):
+                self.put(self.received, None)
+
+    def compute(self):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.reconThreads, thread_name_prefix="pipeline-recon") if (self.reconThreads > 0) else None
+        futures  = []
+        batcher  = imagebatch.ImageBatcher() if ((self.processImages is not None) and imagebatch.enabled()) else None
+        try:
+            while True:
+                try:
+                    item = self.get(self.received, batcher.remaining() if (batcher is not None) else None)
+                except queue.Empty:
+                    # The pending batch of images is due
+                    self.submit_images(executor, futures, batcher.flush())
+                    continue
+
+                if ((batcher is not None) and isinstance(item, ismrmrd.Image)):
+                    for images in batcher.add(item):
+                        self.submit_images(executor, futures, images)
+                    continue
+                if ((batcher is not None) and (len(batcher) > 0)):
+                    self.submit_images(executor, futures, batcher.flush())
+
+                if item is None:
+                    break
+
+                if isinstance(item, ismrmrd.Image):
+                    if (self.processImage is None):
+                        logging.error("Unsupported data type %s", type(item).__name__)
+                        continue
+                    logging.info("Processing an image")
+                    func, args = self.processImage, (item, self.config, self.metadata, self.dumps.slice())
+                else:
+                    logging.info("Processing a group of k-space data")
+                    data, acquisition = item
+                    func, args = self.processRaw, (data, acquisition, self.config, self.metadata, self.dumps.slice())
+
+                self.submit(executor, futures, func, args)
+        finally:
+            if (not self.failed.is_set()):
+                self.put(self.processed, None)
+            # Submitted slices are still sent unless the session failed
+            if (executor is not None):
+                if self.failed.is_set():
+                    for future in futures:
+                        future.cancel()
+                executor.shutdown(wait=False)
+
+    # The sender receives either an image or a future of one.  futures only
+    # keeps the recons that have not finished, to cancel them if the session
+    # fails, so that finished images are not kept until the session ends.
+    def submit(self, executor, futures, func, args):
+        if (executor is not None):
+            futures[:] = [future for future in futures if not future.done()]
+            futures.append(executor.submit(self.recon, func, *args))
+            self.put(self.processed, futures[-1])
+        else:
+            self.put(self.processed, self.recon(func, *args))
+
+    def submit_images(self, executor, futures, images):
+        logging.info("Processing a batch of %d images", len(images))
+        self.submit(executor, futures, self.processImages, (images, self.config, self.metadata, self.dumps.slice()))
+
+    # Recon threads record their stages into the session's metrics
+    def recon(self, func, *args):
+        with self.metrics.bind():
+            if (self.limit is None):
+                return func(*args)
+            with self.limit:
+                return func(*args)
+
+    def send(self):
+        while True:
+            image = self.get(self.processed)
+            if image is None:
+                break
+            if isinstance(image, concurrent.futures.Future):
+                image = self.wait(image)
+
+            imagebatch.send(self.connection, image)
+
+    def wait(self, future):
+        while True:
+            if self.failed.is_set():
+                raise PipelineStopped()
+            try:
+                return future.result(timeout=POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                pass
+
+
+# Limit on the number of recons running at the same time across all sessions
+# of a server.  It must be created before session processes are forked so
+# that they share the same semaphore.
+class ReconLimit:
+    def __init__(self, maxRecons):
+        self.maxRecons = maxRecons
+        self.semaphore = multiprocessing.BoundedSemaphore(maxRecons)
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.semaphore.release()
+        return False
+
+
+def process(connection, config, metadata, processRaw, processImage=None, depth=PIPELINE_DEPTH, reconThreads=0, limit=None, processImages=None):
+    logging.info("Config: \n%s", config)
+    logging.info("Metadata: \n%s", metadata)
+
+    Pipeline(connection, config, metadata, processRaw, processImage, depth, reconThreads, limit, processImages).run()
@@ -0,0 +1,197 @@
+import collections
+import contextlib
+import logging
+import threading
+import ismrmrd
+import numpy as np
+
+import mrdheader
+
+# Recons by config name, and the warm contexts they keep per protocol.
+#
+# Each recon is a Recon subclass registered for the config names it handles
+# with @register.  The servers look up the recon of a session with lookup(),
+# which falls back to invertcontrast for unknown configs.
+#
+# A ReconContext holds what a recon would otherwise set up again for every
+# session: the serialized MetaAttributes of its images and preallocated working
+# buffers.  Contexts are keyed by recon and protocol (the digest of the MRD
+# header) and kept by each process across sessions, so that pool workers and
+# the recon processes of the asyncio server reuse them for repeated scans of a
+# protocol.  FFT plans and shift masks are already cached per shape by
+# fftengine.  The least recently used contexts are evicted once more than
+# cacheSize are kept or their buffers take more than cacheMemory bytes.
+
+# Contexts kept per process
+RECON_CACHE_SIZE = 8
+
+# Memory of the buffers of the contexts kept per process in bytes
+RECON_CACHE_MEMORY = 1024*1024*1024
+
+# Recon of configs that are not registered
+DEFAULT_RECON = 'invertcontrast'
+
+cacheSize   = RECON_CACHE_SIZE
+cacheMemory = RECON_CACHE_MEMORY
+
+# Like fftengine.configure(), this should be called before sessions are started
+def configure(size=RECON_CACHE_SIZE, memory=RECON_CACHE_MEMORY):
+    global cacheSize, cacheMemory
+    cacheSize   = size
+    cacheMemory = memory
+    cache.clear()
+
+registry = {}
+
+# Class decorator registering a recon for configs, e.g. @register('simplefft')
+def register(*configs):
+    def decorator(recon):
+        if (recon.name is None):
+            recon.name = configs[0]
+        for config in configs:
+            registry[config] = recon
+        return recon
+    return decorator
+
+def lookup(config):
+    return registry.get(config) or registry[DEFAULT_RECON]
+
+
+# A recon of whole sessions.  Recons that reconstruct slices or images set
+#   processRaw(data, acquisition, config, metadata, dump)
+#   processImage(image, config, metadata, dump)
+# which the pipelined and asyncio servers run for each slice or image, and
+# process(connection, config, metadata), which handles a session sequentially.
+# Recons without processRaw only consume their input.  With image batching
+# (see imagebatch.py), batches of images are passed to
+#   processImages(images, config, metadata, dump)
+# if set, which returns imagebatch.SerializedImages.
+class Recon:
+    name          = None
+    processRaw    = None
+    processImage  = None
+    processImages = None
+
+    # MetaAttributes of the images, serialized once per context
+    meta = None
+
+    # Called before the data of a session is read
+    @staticmethod
+    def start(connection):
+        pass
+
+    @staticmethod
+    def process(connection, config, metadata):
+        discard(connection)
+
+def discard(connection):
+    try:
+        for msg in connection:
+            if msg is None:
+                break
+    finally:
+        connection.send_close()
+
+@register('null')
+class Null(Recon):
+    pass
+
+@register('captureonly')
+class CaptureOnly(Recon):
+    @staticmethod
+    def start(connection):
+        connection.create_capture_file()
+
+@register('savedataonly')
+class SaveDataOnly(Recon):
+    @staticmethod
+    def start(connection):
+        if connection.savedata is True:
+            logging.debug("Saving data is already enabled")
+        else:
+            connection.savedata = True
+            connection.create_save_file()
+
+
+# Warm state of a recon for one protocol.  Buffers are taken with
+#   with context.buffer(shape, dtype) as buffer:
+# and returned to the context at the end of the block, so concurrent slices of
+# a session (or sessions of a protocol) each get their own.
+class ReconContext:
+    def __init__(self, recon, metadata):
+        self.recon      = recon
+        self.digest     = metadata.digest
+        self.attributes = ismrmrd.Meta(recon.meta).serialize() if (recon.meta is not None) else None
+        self.buffers    = collections.defaultdict(list)   # (shape, dtype): free arrays
+        self.nbytes     = 0
+        self.lock       = threading.Lock()
+
+    @contextlib.contextmanager
+    def buffer(self, shape, dtype):
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            free  = self.buffers[key]
+            array = free.pop() if free else None
+
+        if (array is None):
+            array = np.empty(shape, dtype=dtype)
+            with self.lock:
+                self.nbytes += array.nbytes
+            cache.trim()
+
+        try:
+            yield array
+        finally:
+            with self.lock:
+                self.buffers[key].append(array)
+
+
+# Least recently used cache of ReconContexts keyed by recon and protocol.
+# Evicted contexts are freed once the slices using their buffers are done.
+class ReconContextCache:
+    def __init__(self):
+        self.contexts = collections.OrderedDict()
+        self.lock     = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+
+    def get(self, recon, metadata):
+        key = (recon.name, metadata.digest)
+        with self.lock:
+            context = self.contexts.get(key)
+            if context is not None:
+                self.contexts.move_to_end(key)
+                self.hits += 1
+                return context
+            self.misses += 1
+
+        context = ReconContext(recon, metadata)
+        logging.debug("Created %s recon context for protocol %s", recon.name, metadata.digest)
+
+        with self.lock:
+            context = self.contexts.setdefault(key, context)
+        self.trim()
+        return context
+
+    # Evict the least recently used contexts beyond cacheSize or cacheMemory.
+    # The most recently used one is kept regardless of its size.
+    def trim(self):
+        with self.lock:
+            while (len(self.contexts) > 1):
+                if ((len(self.contexts) <= cacheSize) and (sum(context.nbytes for context in self.contexts.values()) <= cacheMemory)):
+                    break
+                key, context = self.contexts.popitem(last=False)
+                logging.debug("Evicted %s recon context for protocol %s (%.1f MB)", key[0], key[1], context.nbytes/1e6)
+
+    def clear(self):
+        with self.lock:
+            self.contexts.clear()
+
+
+# Cache shared by all sessions handled by this process
+cache = ReconContextCache()
+
+# Context of the recon of config for the protocol of metadata (an MrdHeader or
+# XML text)
+def context(config, metadata):
+    return cache.get(lookup(config), mrdheader.parse(metadata))
@@ -2,34 +2,90 @@
 import constants
 from connection import Connection
 
+import os
 import socket
 import logging
 import multiprocessing
+import multiprocessing.connection
+import time
+import numpy as np
 
+import fftengine
+import metrics
+import mrdheader
+import pipeline
+import recons
+
+# Recons are registered with recons when imported
 import simplefft
 import invertcontrast
 
+# Connections waiting to be accepted.  Scanners connecting at the same time
+# are refused or reset once this many are waiting.
+LISTEN_BACKLOG = 64
+
+# Sessions that may wait for admission (see Admission)
+ADMISSION_QUEUE_SIZE = 16
+
+# Seconds a session may wait for admission before it is rejected
+ADMISSION_TIMEOUT = 60
+
+# Memory estimate of a session (see estimate_memory()): a fixed part for the
+# session process and a multiple of its complex64 k-space for the recon's
+# working copies (the k-space buffer and the complex128 FFT output)
+SESSION_MEMORY_BASE   = 64*1024*1024
+SESSION_MEMORY_FACTOR = 3
+
+# Seconds to wait for a rejected client to stop sending
+REJECT_DRAIN_TIMEOUT = 10
+
 class Server:
     """
     Something something docstring.
     """
 
-    def __init__(self, address, port, savedata, savedataFolder):
+    def __init__(self, address, port, savedata, savedataFolder, workers=0, maxSessions=0, batchSize=0, pipelined=False, reconThreads=0, maxRecons=0,
+                 maxActive=0, maxQueued=ADMISSION_QUEUE_SIZE, memoryBudget=0, queueTimeout=ADMISSION_TIMEOUT):
         logging.info("Starting server and listening for data at %s:%d", address, port)
         if (savedata is True):
             logging.debug("Saving incoming data is enabled.")
 
         self.savedata = savedata
         self.savedataFolder = savedataFolder
+        self.workers = workers
+        self.maxSessions = maxSessions
+        self.batchSize = batchSize
+        self.pipelined = pipelined or (reconThreads > 0)
+        self.reconThreads = reconThreads
+        self.reconLimit = pipeline.ReconLimit(maxRecons) if (maxRecons > 0) else None
+        self.admission = Admission(maxActive, maxQueued, memoryBudget, queueTimeout) if ((maxActive > 0) or (memoryBudget > 0)) else None
+        if (self.admission is not None):
+            logging.info("Admitting %s sessions at once within %s, with up to %d more waiting %s", maxActive or "any number of",
+                         ("a memory budget of %d MB" % (memoryBudget//(1024*1024))) if (memoryBudget > 0) else "any memory",
+                         maxQueued, ("up to %g s" % queueTimeout) if (queueTimeout > 0) else "without limit")
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((address, port))
 
     def serve(self):
         logging.debug("Serving... ")
-        self.socket.listen(0)
+        self.socket.listen(LISTEN_BACKLOG)
+
+        if (self.workers > 0):
+            self.serve_pool()
+        else:
+            self.serve_fork()
 
+    # Spawn a new process for every incoming connection.  Exited session
+    # processes are reaped while waiting for connections.
+    def serve_fork(self):
+        processes = []
         while True:
+            ready = multiprocessing.connection.wait([self.socket] + [process.sentinel for process in processes])
+            self.reap(processes, "Session")
+            if (self.socket not in ready):
+                continue
+
             sock, (remote_addr, remote_port) = self.socket.accept()
 
             logging.info("Accepting connection from: %s:%d", remote_addr, remote_port)
@@ -37,13 +93,77 @@ class Server:
             process = multiprocessing.Process(target=self.handle, args=[sock])
             process.daemon = True
             process.start()
+            processes.append(process)
 
             logging.debug("Spawned process %d to handle connection.", process.pid)
 
+            # The child process owns the socket now
+            sock.close()
+
+    # Keep a fixed number of long-lived worker processes that each accept
+    # connections from the shared listening socket.  The kernel hands every
+    # incoming connection to one of the idle workers blocked in accept().
+    # Workers exit after maxSessions sessions (if non-zero) and are replaced.
+    def serve_pool(self):
+        logging.info("Starting pool of %d workers", self.workers)
+        if (self.maxSessions > 0):
+            logging.info("Workers are recycled after %d sessions", self.maxSessions)
+
+        pool = []
+        try:
+            while True:
+                while (len(pool) < self.workers):
+                    process = multiprocessing.Process(target=self.pool_worker)
+                    process.daemon = True
+                    process.start()
+                    pool.append(process)
+                    logging.debug("Spawned worker process %d", process.pid)
+
+                multiprocessing.connection.wait([process.sentinel for process in pool])
+                self.reap(pool, "Worker")
+        finally:
+            for process in pool:
+                process.terminate()
+
+    # Join the processes of the list that exited and remove them.  A process
+    # killed during a session did not release its admission, so it is released
+    # here.
+    def reap(self, processes, kind):
+        for process in [process for process in processes if not process.is_alive()]:
+            process.join()
+            logging.debug("%s process %d exited with code %s", kind, process.pid, process.exitcode)
+            if (self.admission is not None):
+                self.admission.reap(process.pid)
+            processes.remove(process)
+
+    def pool_worker(self):
+        self.warm_up()
+
+        sessions = 0
+        while ((self.maxSessions == 0) or (sessions < self.maxSessions)):
+            sock, (remote_addr, remote_port) = self.socket.accept()
+            logging.info("Worker %d accepting connection from: %s:%d", multiprocessing.current_process().pid, remote_addr, remote_port)
+
+            self.handle(sock)
+            sessions += 1
+
+        logging.debug("Worker %d retiring after %d sessions", multiprocessing.current_process().pid, sessions)
+
+    @staticmethod
+    def warm_up():
+        # numpy, ismrmrd and h5py are already imported by the parent.  Run a
+        # small transform so the FFT backend's internal caches are populated
+        # before the first session arrives.
+        fftengine.centered_ifft2(np.zeros((2, 8, 8), dtype=np.complex64))
+
     def handle(self, sock):
+        session    = metrics.session()
+        admitted   = False
+        connection = None
 
         try:
-            connection = Connection(sock, self.savedata, "", self.savedataFolder, "dataset")
+            connection = Connection(sock, self.savedata, "", self.savedataFolder, "dataset", batchSize=self.batchSize)
+            connection.metrics = session
 
             # First message is the config (file or text)
             config = next(connection)
@@ -53,48 +173,46 @@ class Server:
                 logging.info("Connection closed without any data received")
                 return
 
-            # Second messages is the metadata (text)
-            metadata = next(connection)
-
-            # Decide what program to use based on config
-            # As a shortcut, we accept the file name as text too.
-            if (config == "simplefft"):
-                logging.info("Starting simplefft processing based on config")
-                simplefft.process(connection, config, metadata)
-            elif (config == "invertcontrast"):
-                logging.info("Starting invertcontrast processing based on config")
-                invertcontrast.process(connection, config, metadata)
-            elif (config == "null"):
-                logging.info("No processing based on config")
-                try:
-                    for msg in connection:
-                        if msg is None:
-                            break
-                finally:
-                    connection.send_close()
-            elif (config == "savedataonly"):
-                logging.info("Save data, but no processing based on config")
-                if connection.savedata is True:
-                    logging.debug("Saving data is already enabled")
-                else:
-                    connection.savedata = True
-                    connection.create_save_file()
-
-                # Dummy loop with no processing
+            # Second messages is the metadata (text), parsed once per protocol
+            metadata = mrdheader.parse(next(connection))
+            session.config = config
+
+            # Wait until the session fits within the admission limits.  Until
+            # then, the client's data waits in the socket buffers.
+            if (self.admission is not None):
+                nbytes = estimate_memory(metadata)
                 try:
-                    for msg in connection:
-                        if msg is None:
-                            break
-                finally:
-                    connection.send_close()
-            else:
-                logging.info("Unknown config '%s'.  Falling back to 'invertcontrast'", config)
-                invertcontrast.process(connection, config, metadata)
+                    waited = self.admission.admit(nbytes)
+                except AdmissionRejected as e:
+                    session.reject(e.reason)
+                    self.reject(connection, sock, e)
+                    return
+                admitted = True
+                session.add(metrics.STAGE_QUEUE, waited, 0)
+                if (waited > 0):
+                    logging.info("Session admitted after waiting %.1f s", waited)
+
+            # Recons record their stages into the session of this thread
+            with session.bind():
+                self.process(connection, config, metadata)
 
         except Exception as e:
             logging.exception(e)
 
         finally:
+            # Sessions that fail before a close message was sent or received
+            # still write what was queued for the save file and capture and
+            # close them
+            if (connection is not None):
+                try:
+                    connection.close_files()
+                except Exception as e:
+                    logging.exception(e)
+
+            if admitted:
+                self.admission.release()
+            session.close()
+
             # Encapsulate shutdown in a try block because the socket may have
             # already been closed on the other side
             try:
@@ -104,3 +222,159 @@ class Server:
             sock.close()
             logging.info("Socket closed")
 
+    # Explain the rejection to the client and end the session.  What the client
+    # still sends is read and dropped, so that it receives the explanation
+    # instead of a connection reset.
+    def reject(self, connection, sock, rejection):
+        logging.warning("Rejecting session: %s", rejection)
+        connection.send_text(str(rejection))
+        connection.send_close()
+
+        sock.settimeout(REJECT_DRAIN_TIMEOUT)
+        buffer = bytearray(1024*1024)
+        try:
+            while (sock.recv_into(buffer) > 0):
+                pass
+        except OSError:
+            pass
+
+    def process(self, connection, config, metadata):
+        # Decide what program to use based on config
+        # As a shortcut, we accept the file name as text too.
+        recon = recons.lookup(config)
+        if (config in recons.registry):
+            logging.info("Starting %s processing based on config", recon.name)
+        else:
+            logging.info("Unknown config '%s'.  Falling back to '%s'", config, recon.name)
+
+        recon.start(connection)
+        if ((recon.processRaw is not None) and (self.pipelined is True)):
+            pipeline.process(connection, config, metadata, recon.processRaw, recon.processImage, reconThreads=self.reconThreads, limit=self.reconLimit, processImages=recon.processImages)
+        else:
+            recon.process(connection, config, metadata)
+
+
+# Estimated peak memory of a session in bytes, from the k-space of all its
+# slices as complex64: the encoded matrix size times channels and slices.
+# Headers without an encoding or receiver channels (e.g. of image series) only
+# count SESSION_MEMORY_BASE.
+def estimate_memory(metadata):
+    if ((metadata.encodedMatrix is None) or (metadata.channels is None)):
+        return SESSION_MEMORY_BASE
+    x, y, z = metadata.encodedMatrix
+    samples = x*y*max(z, 1)*metadata.channels*(metadata.slices or 1)
+    return SESSION_MEMORY_BASE + SESSION_MEMORY_FACTOR*samples*np.dtype(np.complex64).itemsize
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+# Admission control shared by all session processes of a server.  A session
+# is admitted once fewer than maxActive sessions are running (if non-zero) and
+# its estimated memory fits within memoryBudget bytes (if non-zero) next to
+# that of the running sessions.  Until then it waits, for at most timeout
+# seconds (0 for no limit) and with at most maxQueued other sessions.  Sessions
+# that would exceed the budget on their own, find the queue full or time out
+# are rejected.  Waiting sessions are admitted as soon as they fit, not
+# strictly in order of arrival.  Like ReconLimit, it must be created before
+# session processes are forked.
+#
+# Each waiting or admitted session holds a slot recording the pid of its
+# process and its estimated bytes (-1 while waiting).  A session process that
+# is killed cannot release its slot itself, so the server process calls reap()
+# with the pid of every session or worker process that exits.  Without a
+# maxActive, the number of sessions admitted at once is limited to what fits
+# in memoryBudget with SESSION_MEMORY_BASE each, the least estimate_memory()
+# returns.
+class Admission:
+    def __init__(self, maxActive=0, maxQueued=ADMISSION_QUEUE_SIZE, memoryBudget=0, timeout=ADMISSION_TIMEOUT):
+        self.maxActive    = maxActive
+        self.maxQueued    = maxQueued
+        self.memoryBudget = memoryBudget
+        self.timeout      = timeout
+        self.maxAdmitted  = maxActive if (maxActive > 0) else max(1, memoryBudget // SESSION_MEMORY_BASE)
+        self.maxSlots     = self.maxAdmitted + maxQueued
+        self.condition    = multiprocessing.Condition()
+        self.active       = multiprocessing.Value('i', 0, lock=False)
+        self.queued       = multiprocessing.Value('i', 0, lock=False)
+        self.reserved     = multiprocessing.Value('q', 0, lock=False)
+        self.pids         = multiprocessing.Array('i', self.maxSlots, lock=False)
+        self.sizes        = multiprocessing.Array('q', self.maxSlots, lock=False)
+
+    def fits(self, nbytes):
+        if (self.active.value >= self.maxAdmitted):
+            return False
+        if ((self.memoryBudget > 0) and (self.reserved.value + nbytes > self.memoryBudget)):
+            return False
+        return True
+
+    # Wait until a session of nbytes is admitted and return the seconds waited
+    # (0 if it was admitted right away).  Raises AdmissionRejected otherwise.
+    def admit(self, nbytes):
+        if ((self.memoryBudget > 0) and (nbytes > self.memoryBudget)):
+            raise AdmissionRejected('memory', "Session needs an estimated %d MB, more than the server's memory budget of %d MB" %
+                                    (nbytes//(1024*1024), self.memoryBudget//(1024*1024)))
+
+        start  = time.perf_counter()
+        waited = 0.0
+        with self.condition:
+            slot = self.slot(0)
+            if (not self.fits(nbytes)):
+                if (self.queued.value >= self.maxQueued):
+                    raise AdmissionRejected('queue', "Server is busy with %d sessions and %d more waiting.  Try again later" %
+                                            (self.active.value, self.queued.value))
+
+                self.take(slot, -1)
+                try:
+                    admitted = self.condition.wait_for(lambda: self.fits(nbytes), self.timeout if (self.timeout > 0) else None)
+                finally:
+                    self.free(slot)
+
+                if (not admitted):
+                    raise AdmissionRejected('timeout', "Timed out after %g s waiting for the server (%d sessions running with %d MB reserved)" %
+                                            (self.timeout, self.active.value, self.reserved.value//(1024*1024)))
+                waited = time.perf_counter() - start
+
+            self.take(slot, nbytes)
+        return waited
+
+    # Release the session of this process
+    def release(self):
+        with self.condition:
+            self.free(self.slot(os.getpid()))
+            self.condition.notify_all()
+
+    # Release the session of a process that exited, if it did not
+    def reap(self, pid):
+        with self.condition:
+            slot = self.slot(pid)
+            if (slot is None):
+                return
+            logging.warning("Releasing the admission of process %d, which exited during a session", pid)
+            self.free(slot)
+            self.condition.notify_all()
+
+    # ----- Slots, called with the condition held --------------------------------
+    def slot(self, pid):
+        for slot in range(self.maxSlots):
+            if (self.pids[slot] == pid):
+                return slot
+        return None
+
+    def take(self, slot, nbytes):
+        self.pids[slot]  = os.getpid()
+        self.sizes[slot] = nbytes
+        if (nbytes < 0):
+            self.queued.value += 1
+        else:
+            self.active.value   += 1
+            self.reserved.value += nbytes
+
+    def free(self, slot):
+        if (self.sizes[slot] < 0):
+            self.queued.value -= 1
+        else:
+            self.active.value   -= 1
+            self.reserved.value -= self.sizes[slot]
+        self.pids[slot] = 0
@@ -5,10 +5,13 @@ import itertools
 import logging
 import numpy as np
 import numpy.fft as fft
+import debugdump
+import kernels
+import metrics
+import recons
 from datetime import datetime
-
-# Folder for debug output files
-debugFolder = "/tmp/share/debug"
+from connection import AcquisitionBatch
+from kspace import KSpaceBuffer
 
 def groups(iterable, predicate):
     group = []
@@ -20,19 +23,27 @@ def groups(iterable, predicate):
             group = []
 
 
-def conditionalGroups(iterable, predicateAccept, predicateFinish):
-    group = []
+# Add accepted readouts to a KSpaceBuffer as they arrive and yield the
+# assembled (data, acquisition) of each slice once predicateFinish is met
+def conditionalSlices(iterable, kspace, predicateAccept, predicateFinish):
     try:
         for item in iterable:
             if item is None:
                 break
 
+            # Predicates are evaluated for all readouts of a batch at once
+            if isinstance(item, AcquisitionBatch):
+                for part, ended in item.split_after(predicateFinish(item)):
+                    kspace.add(part[predicateAccept(part)])
+                    if ((ended) and (len(kspace) > 0)):
+                        yield kspace.take()
+                continue
+
             if predicateAccept(item):
-                group.append(item)
+                kspace.add(item)
 
-            if predicateFinish(item):
-                yield group
-                group = []
+            if ((predicateFinish(item)) and (len(kspace) > 0)):
+                yield kspace.take()
     finally:
         iterable.send_close()
 
@@ -42,61 +53,56 @@ def process(connection, config, metadata):
     logging.info("Metadata: \n%s", metadata)
 
     # Discard phase correction lines and accumulate lines until "ACQ_LAST_IN_SLICE" is set
-    for group in conditionalGroups(connection, lambda acq: not acq.is_flag_set(ismrmrd.ACQ_IS_PHASECORR_DATA), lambda acq: acq.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)):
-        image = process_group(group, config, metadata)
-
-        logging.debug("Sending image to client:\n%s", image)
-        connection.send_image(image)
+    kspace = KSpaceBuffer(metadata)
+    dumps  = debugdump.Session(config)
+    try:
+        for data, acquisition in conditionalSlices(connection, kspace, lambda acq: np.logical_not(acq.is_flag_set(ismrmrd.ACQ_IS_PHASECORR_DATA)), lambda acq: acq.is_flag_set(ismrmrd.ACQ_LAST_IN_SLICE)):
+            image = process_group(data, acquisition, config, metadata, dumps.slice())
 
+            logging.debug("Sending image to client:\n%s", image)
+            connection.send_image(image)
+    finally:
+        dumps.close()
 
-def process_group(group, config, metadata):
-    # Create folder, if necessary
-    if not os.path.exists(debugFolder):
-        os.makedirs(debugFolder)
-        logging.debug("Created folder " + debugFolder + " for debug output files")
 
-    # Format data into single [cha RO PE] array
-    data = [acquisition.data for acquisition in group]
-    data = np.stack(data, axis=-1)
+# data is the [cha RO PE] k-space of one slice and acquisition is a readout
+# from it, used for the image header.  Intermediate arrays are saved to dump.
+def process_group(data, acquisition, config, metadata, dump=debugdump.disabled):
+    logging.debug("Raw data is size %s", data.shape)
+    dump.save("raw", data, debugdump.DUMP_ALL)
 
-    logging.debug("Raw data is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "raw.npy", data)
+    # Buffers and MetaAttributes are kept across sessions of the protocol
+    context = recons.context(config, metadata)
 
-    # Fourier Transform
-    data = fft.fftshift(data, axes=(1, 2))
-    data = fft.ifft2(data)
-    data = fft.ifftshift(data, axes=(1, 2))
+    # Fourier Transform into a buffer of the context.  With kernels.cropReadout,
+    # the readout oversampling is already removed here.
+    with context.buffer(kernels.image_shape(data.shape), kernels.complexType) as buffer:
+        with metrics.stage(metrics.STAGE_FFT):
+            data = kernels.ifft_image(data, out=buffer)
 
-    # Sum of squares coil combination
-    data = np.abs(data)
-    data = np.square(data)
-    data = np.sum(data, axis=0)
-    data = np.sqrt(data)
+        # Sum of squares coil combination
+        with metrics.stage(metrics.STAGE_COMBINE):
+            data = kernels.rss(data)
 
-    logging.debug("Image data is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "img.npy", data)
+    logging.debug("Image data is size %s", data.shape)
+    dump.save("img", data, debugdump.DUMP_ALL)
 
     # Normalize and convert to int16
-    data *= 32767/data.max()
-    data = np.around(data)
-    data = data.astype(np.int16)
+    with metrics.stage(metrics.STAGE_QUANTIZE):
+        data = kernels.quantize(data)
 
     # Remove phase oversampling
-    nRO = np.size(data,0)
-    data = data[int(nRO/4):int(nRO*3/4),:]
-    logging.debug("Image without oversampling is size %s" % (data.shape,))
-    np.save(debugFolder + "/" + "imgCrop.npy", data)
+    if (not kernels.cropReadout):
+        data = data[kernels.readout_fov(np.size(data,0)),:]
+    logging.debug("Image without oversampling is size %s", data.shape)
+    dump.save("imgCrop", data, debugdump.DUMP_IMAGES)
 
     # Format as ISMRMRD image data
-    image = ismrmrd.Image.from_array(data, acquisition=group[0])
+    image = ismrmrd.Image.from_array(data, acquisition=acquisition)
     image.image_index = 1
 
-    # Set ISMRMRD Meta Attributes
-    meta = ismrmrd.Meta({'DataRole':               'Image',
-                         'ImageProcessingHistory': ['FIRE', 'PYTHON'],
-                         'WindowCenter':           '16384',
-                         'WindowWidth':            '32768'})
-    xml = meta.serialize()
+    # Set ISMRMRD Meta Attributes, serialized once per context
+    xml = context.attributes
     logging.debug("Image MetaAttributes: %s", xml)
     logging.debug("Image data has %d elements", image.data.size)
 
@@ -104,3 +110,11 @@ def process_group(group, config, metadata):
     return image
 
 
+@recons.register('simplefft')
+class SimpleFft(recons.Recon):
+    processRaw = staticmethod(process_group)
+    process    = staticmethod(process)
+    meta       = {'DataRole':               'Image',
+                  'ImageProcessingHistory': ['FIRE', 'PYTHON'],
+                  'WindowCenter':           '16384',
+                  'WindowWidth':            '32768'}
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+# Synthetic MRD data for benchmarks and load tests, in memory or as MRD HDF5
+# files that client.py can send, e.g.
+#   python3 synthetic.py raw raw.h5 -c 16 -s 256 -l 128 -z 4
+#   python3 synthetic.py image images.h5 -x 256 -y 256 -n 10 -d int16
+# Raw data is either noise or a phantom with 2x readout oversampling, seen by
+# coils with smooth sensitivities.
+
+import mrdwriter
+
+import argparse
+import logging
+import ismrmrd
+import numpy as np
+
+# [cha RO PE] k-space of a phantom inside the central half of the readout,
+# with noise
+def make_phantom_kspace(channels, ro, pe, seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.linspace(-1, 1, ro, dtype=np.float32)[:, None]
+    y = np.linspace(-1, 1, pe, dtype=np.float32)[None, :]
+    phantom = ((4*x)**2 + (1.2*y)**2 < 0.8).astype(np.float32) + ((4*x - 0.3)**2 + (2*y)**2 < 0.2)
+
+    data = np.empty((channels, ro, pe), dtype=np.complex64)
+    for channel in range(channels):
+        angle = 2*np.pi*channel/channels
+        sensitivity = np.exp(-((x - 0.3*np.cos(angle))**2 + (y - 0.8*np.sin(angle))**2))
+        coil = phantom*sensitivity + 0.01*rng.standard_normal((ro, pe), dtype=np.float32)
+        data[channel] = np.fft.fftshift(np.fft.fft2(np.fft.ifftshift(coil)))
+    return data
+
+# Readouts of slices with lines in order, the last one of each slice flagged
+# ACQ_LAST_IN_SLICE
+def make_acquisitions(channels, samples, lines, slices=1, seed=0, phantom=False):
+    rng = np.random.default_rng(seed)
+    acquisitions = []
+    for slice in range(slices):
+        kspace = make_phantom_kspace(channels, samples, lines, seed + slice) if phantom else None
+        for line in range(lines):
+            if phantom:
+                data = np.ascontiguousarray(kspace[:, :, line])
+            else:
+                data = rng.standard_normal((channels, 2*samples), dtype=np.float32).view(np.complex64)
+            acq = ismrmrd.Acquisition.from_array(data)
+            acq.idx.kspace_encode_step_1 = line
+            acq.idx.slice = slice
+            acq.center_sample = samples//2
+            if (line == lines-1):
+                acq.set_flag(ismrmrd.ACQ_LAST_IN_SLICE)
+            acquisitions.append(acq)
+    return acquisitions
+
+# An image of random data: normal for floating point and complex types, 0 to
+# 4095 for integer types
+def make_image(channels, nx, ny, nz, dtype, seed=0):
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    if (dtype.kind == 'c'):
+        data = rng.standard_normal((channels, nz, ny, 2*nx), dtype=np.float32).view(np.complex64)
+    elif (dtype.kind == 'f'):
+        data = np.abs(rng.standard_normal((channels, nz, ny, nx), dtype=np.float32))
+    else:
+        data = rng.integers(0, 4096, (channels, nz, ny, nx))
+    image = ismrmrd.Image.from_array(data.astype(dtype))
+    image.attribute_string = ismrmrd.Meta({'DataRole': 'Image'}).serialize()
+    return image
+
+# A series of images, one per slice
+def make_images(count, channels, nx, ny, nz, dtype, seed=0):
+    images = []
+    for index in range(count):
+        image = make_image(channels, nx, ny, nz, dtype, seed + index)
+        image.image_index = index + 1
+        image.slice = index
+        images.append(image)
+    return images
+
+# MRD header of a 2D Cartesian acquisition with 2x readout oversampling
+def make_header(channels, samples, lines, slices=1):
+    return """<?xml version="1.0" encoding="utf-8"?>
+<ismrmrdHeader xmlns="http://www.ismrm.org/ISMRMRD">
+  <acquisitionSystemInformation><receiverChannels>%d</receiverChannels></acquisitionSystemInformation>
+  <experimentalConditions><H1resonanceFrequency_Hz>63500000</H1resonanceFrequency_Hz></experimentalConditions>
+  <encoding>
+    <encodedSpace><matrixSize><x>%d</x><y>%d</y><z>1</z></matrixSize><fieldOfView_mm><x>600</x><y>300</y><z>5</z></fieldOfView_mm></encodedSpace>
+    <reconSpace><matrixSize><x>%d</x><y>%d</y><z>1</z></matrixSize><fieldOfView_mm><x>300</x><y>300</y><z>5</z></fieldOfView_mm></reconSpace>
+    <trajectory>cartesian</trajectory>
+    <encodingLimits>
+      <kspace_encoding_step_1><minimum>0</minimum><maximum>%d</maximum><center>%d</center></kspace_encoding_step_1>
+      <slice><minimum>0</minimum><maximum>%d</maximum><center>0</center></slice>
+    </encodingLimits>
+  </encoding>
+</ismrmrdHeader>""" % (channels, samples, lines, samples//2, lines, lines-1, lines//2, slices-1)
+
+# Files are written in the layout of --savedata.  Image files have no header,
+# like those of image-only sessions.  An existing file is replaced.
+def write_raw(path, group, channels, samples, lines, slices, seed=0, phantom=True):
+    writer = mrdwriter.MrdWriter(path, group, mode='w')
+    writer.write_xml_header(make_header(channels, samples, lines, slices))
+    for slice in range(slices):
+        for acq in make_acquisitions(channels, samples, lines, 1, seed + slice, phantom):
+            acq.idx.slice = slice
+            writer.append_acquisition(acq)
+    writer.close()
+
+def write_images(path, group, count, channels, nx, ny, nz, dtype, seed=0):
+    writer = mrdwriter.MrdWriter(path, group, mode='w')
+    for image in make_images(count, channels, nx, ny, nz, dtype, seed):
+        writer.append_image(image)
+    writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic MRD raw data or images',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output.')
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    raw = subparsers.add_parser('raw', help='Raw data of 2D Cartesian slices',
+                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    raw.add_argument('outfile',                                           help='Output file')
+    raw.add_argument('-g', '--group',    type=str, default='dataset',     help='Output group')
+    raw.add_argument('-c', '--channels', type=int, default=16,            help='Receive channels')
+    raw.add_argument('-s', '--samples',  type=int, default=256,           help='Samples per readout, with 2x oversampling')
+    raw.add_argument('-l', '--lines',    type=int, default=128,           help='Phase encoding lines per slice')
+    raw.add_argument('-z', '--slices',   type=int, default=4,             help='Number of slices')
+    raw.add_argument('-N', '--noise',    action='store_true',             help='Noise instead of a phantom')
+    raw.add_argument('-r', '--seed',     type=int, default=0,             help='Random seed')
+
+    image = subparsers.add_parser('image', help='A series of images',
+                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    image.add_argument('outfile',                                         help='Output file')
+    image.add_argument('-g', '--group',    type=str, default='dataset',   help='Output group')
+    image.add_argument('-n', '--count',    type=int, default=10,          help='Number of images')
+    image.add_argument('-c', '--channels', type=int, default=1,           help='Channels per image')
+    image.add_argument('-x', '--nx',       type=int, default=256,         help='Matrix size (x)')
+    image.add_argument('-y', '--ny',       type=int, default=256,         help='Matrix size (y)')
+    image.add_argument('-z', '--nz',       type=int, default=1,           help='Matrix size (z)')
+    image.add_argument('-d', '--dtype',    type=str, default='int16',     help='Image data type')
+    image.add_argument('-r', '--seed',     type=int, default=0,           help='Random seed')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING)
+    if args.verbose:
+        logging.root.setLevel(logging.DEBUG)
+
+    if (args.command == 'raw'):
+        write_raw(args.outfile, args.group, args.channels, args.samples, args.lines, args.slices, args.seed, not args.noise)
+        print("Wrote %d slices of %d readouts to %s" % (args.slices, args.lines, args.outfile))
+    else:
+        write_images(args.outfile, args.group, args.count, args.channels, args.nx, args.ny, args.nz, args.dtype, args.seed)
+        print("Wrote %d images to %s" % (args.count, args.outfile))
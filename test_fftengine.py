@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+import fftengine
+
+# Even, odd and mixed sizes along the transformed axes
+SHAPES = [(2, 8, 6), (2, 7, 5), (2, 8, 5)]
+DTYPES = [np.complex64, np.complex128]
+
+def reference(data, axes):
+    return np.fft.fftshift(np.fft.ifftn(np.fft.ifftshift(data, axes=axes), axes=axes), axes=axes)
+
+def random_data(shape, dtype):
+    rng = np.random.default_rng(0)
+    return (rng.standard_normal(shape) + 1j*rng.standard_normal(shape)).astype(dtype)
+
+def tolerance(dtype):
+    return 1e-5 if (dtype == np.complex64) else 1e-12
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_centered_ifftn(shape, dtype):
+    data  = random_data(shape, dtype)
+    input = data.copy()
+    image = fftengine.centered_ifftn(data, axes=(1, 2))
+
+    assert image.dtype == dtype
+    np.testing.assert_allclose(image, reference(input, (1, 2)), atol=tolerance(dtype))
+    np.testing.assert_array_equal(data, input)
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_centered_ifftn_out(shape, dtype):
+    data  = random_data(shape, dtype)
+    out   = np.empty(shape, dtype=dtype)
+    image = fftengine.centered_ifftn(data, axes=(1, 2), out=out)
+
+    assert image is out
+    np.testing.assert_allclose(out, reference(data, (1, 2)), atol=tolerance(dtype))
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("dtype", DTYPES)
+def test_centered_ifftn_single_axis(shape, dtype):
+    data = random_data(shape, dtype)
+    np.testing.assert_allclose(fftengine.centered_ifftn(data.copy(), axes=(-1,), overwrite=True), reference(data, (-1,)), atol=tolerance(dtype))
+
+# Single precision input converted to double precision by the mask pass
+def test_centered_ifftn_dtype():
+    data  = random_data((2, 8, 6), np.complex64)
+    image = fftengine.centered_ifftn(data, axes=(1, 2), dtype=np.complex128)
+
+    assert image.dtype == np.complex128
+    np.testing.assert_allclose(image, reference(data.astype(np.complex128), (1, 2)), atol=1e-12)
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+# Wire captures: the bytes received on an MRD connection, written verbatim to
+# a sequential file (".mrd", or ".mrd.z" with zlib compression).  A capture is
+# a complete MRD stream from the config message to MRD_MESSAGE_CLOSE, so it can
+# be converted to the MRD_input_*.h5 layout of --savedata later with
+#   python3 wirecapture.py convert capture.mrd -o out.h5
+# or sent to a server again with
+#   python3 client.py capture.mrd
+
+import constants
+import connection as mrdconnection
+
+import argparse
+import collections
+import datetime
+import itertools
+import logging
+import os
+import zlib
+
+CAPTURE_EXTENSION            = '.mrd'
+CAPTURE_COMPRESSED_EXTENSION = '.mrd.z'
+
+# Received bytes are collected and written with one write() of at least this
+# size.  Compressed captures are read back in chunks of this size.
+CAPTURE_BUFFER_SIZE = 4*1024*1024
+
+# zlib level of compressed captures.  Level 1 is the fastest and already
+# compresses raw data noticeably.
+CAPTURE_COMPRESS_LEVEL = 1
+
+# Capture all sessions of a server (--capture)
+captureAll      = False
+captureFolder   = '/tmp/share/saved_data'
+captureCompress = False
+
+# Like fftengine.configure(), this should be called before sessions are started
+def configure(enabled=False, folder='/tmp/share/saved_data', compress=False):
+    global captureAll, captureFolder, captureCompress
+    captureAll      = enabled
+    captureFolder   = folder
+    captureCompress = compress
+    if enabled:
+        logging.info("Capturing received data of all sessions to %s%s", folder, " with zlib compression" if compress else "")
+
+def is_capture(path):
+    return path.endswith(CAPTURE_EXTENSION) or path.endswith(CAPTURE_COMPRESSED_EXTENSION)
+
+# Captures are appended to, so names must be unique across the sessions and
+# processes of a server
+captureCounter = itertools.count()
+
+def capture_path(folder, compress):
+    if (folder) and (not os.path.exists(folder)):
+        os.makedirs(folder, exist_ok=True)
+    name = "MRD_capture_%s_%d_%d" % (datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S"), os.getpid(), next(captureCounter))
+    return os.path.join(folder, name + (CAPTURE_COMPRESSED_EXTENSION if compress else CAPTURE_EXTENSION))
+
+# MRD messages that Connection.send_config_file/send_config_text/send_metadata
+# would send, for captures started after these were received
+def encode_config_file(filename):
+    return constants.MrdMessageIdentifier.pack(constants.MRD_MESSAGE_CONFIG_FILE) + constants.MrdMessageConfigurationFile.pack(filename.encode())
+
+def encode_text(identifier, text):
+    contents = ('%s\0' % text).encode()
+    return constants.MrdMessageIdentifier.pack(identifier) + constants.MrdMessageLength.pack(len(contents)) + contents
+
+
+# Appends bytes to a capture file.  Writes go through an O_APPEND file
+# descriptor once CAPTURE_BUFFER_SIZE bytes are collected, so the received
+# data is copied only once (or compressed) on the receiving thread.
+class CaptureWriter:
+    def __init__(self, path, compress=False, bufferSize=CAPTURE_BUFFER_SIZE):
+        self.path       = path
+        self.bufferSize = bufferSize
+        self.buffer     = bytearray()
+        self.compressor = zlib.compressobj(CAPTURE_COMPRESS_LEVEL) if compress else None
+        self.received   = 0
+        self.written    = 0
+        self.fd         = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def write(self, data):
+        self.received += len(data)
+        if (self.compressor is not None):
+            data = self.compressor.compress(data)
+        self.buffer += data
+        if (len(self.buffer) >= self.bufferSize):
+            self.flush()
+
+    def flush(self):
+        view = memoryview(self.buffer)
+        while (len(view) > 0):
+            count = os.write(self.fd, view)
+            self.written += count
+            view = view[count:]
+        view.release()
+        self.buffer = bytearray()
+
+    def close(self):
+        if (self.fd is None):
+            return
+        if (self.compressor is not None):
+            self.buffer += self.compressor.flush()
+        self.flush()
+        os.close(self.fd)
+        self.fd = None
+        logging.info("Captured %.1f MB to %s (%.1f MB on disk)", self.received/1e6, self.path, self.written/1e6)
+
+
+# Socket-like reader of a capture, so that a Connection can parse it as if it
+# was being received.  Sending is ignored.
+class CaptureSocket:
+    def __init__(self, path, bufferSize=CAPTURE_BUFFER_SIZE):
+        self.file         = open(path, 'rb')
+        self.bufferSize   = bufferSize
+        self.decompressor = zlib.decompressobj() if path.endswith(CAPTURE_COMPRESSED_EXTENSION) else None
+        self.pending      = b''
+
+    def recv_into(self, view):
+        if (self.decompressor is None):
+            return self.file.readinto(view)
+
+        while (len(self.pending) == 0):
+            compressed = self.file.read(self.bufferSize)
+            if (len(compressed) == 0):
+                self.pending = self.decompressor.flush()
+                if (len(self.pending) == 0):
+                    return 0
+                break
+            self.pending = self.decompressor.decompress(compressed)
+
+        count = min(len(view), len(self.pending))
+        view[0:count] = self.pending[0:count]
+        self.pending = self.pending[count:]
+        return count
+
+    def read_all(self, chunkSize=CAPTURE_BUFFER_SIZE):
+        buffer = bytearray(chunkSize)
+        view = memoryview(buffer)
+        while True:
+            count = self.recv_into(view)
+            if (count == 0):
+                return
+            yield view[0:count]
+
+    def sendmsg(self, buffers):
+        return sum(len(buffer) for buffer in buffers)
+
+    def close(self):
+        self.file.close()
+
+
+# Parse a capture and save it as --savedata would
+def convert(path, output, group="dataset", batchSize=256):
+    capture = CaptureSocket(path)
+    connection = mrdconnection.Connection(capture, True, output, "", group, batchSize=batchSize)
+    try:
+        for msg in connection:
+            if msg is None:
+                break
+    finally:
+        connection.close_save_file()
+        capture.close()
+
+# Count the messages of a capture by type
+def info(path):
+    capture = CaptureSocket(path)
+    connection = mrdconnection.Connection(capture, False)
+    counts = collections.Counter()
+    try:
+        for msg in connection:
+            if (msg is None) and (connection.is_exhausted is True):
+                break
+            counts[type(msg).__name__] += 1
+    finally:
+        capture.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert MRD wire captures',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output.')
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    convertParser = subparsers.add_parser('convert', help='Convert a capture to an MRD HDF5 file as saved by --savedata',
+                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    convertParser.add_argument('capture',                                   help='Capture file')
+    convertParser.add_argument('-o', '--outfile',   type=str,               help='Output file (default: capture name with .h5)')
+    convertParser.add_argument('-g', '--group',     type=str, default='dataset', help='Output group')
+    convertParser.add_argument('-b', '--batchSize', type=int, default=256,  help='Decode up to this many consecutive acquisitions at once')
+
+    infoParser = subparsers.add_parser('info', help='Count the messages of a capture')
+    infoParser.add_argument('capture', help='Capture file')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(message)s', level=logging.WARNING)
+    if args.verbose:
+        logging.root.setLevel(logging.DEBUG)
+
+    if (args.command == 'convert'):
+        outfile = args.outfile or (args.capture[:-len(CAPTURE_COMPRESSED_EXTENSION)] if args.capture.endswith(CAPTURE_COMPRESSED_EXTENSION) else os.path.splitext(args.capture)[0]) + '.h5'
+        convert(args.capture, outfile, args.group, args.batchSize)
+        print("Converted %s to %s" % (args.capture, outfile))
+    else:
+        for name, count in sorted(info(args.capture).items()):
+            print("%-24s %d" % (name, count))